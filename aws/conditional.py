@@ -0,0 +1,61 @@
+import json
+import random
+import time
+
+import botocore.exceptions
+
+# Read-modify-write of S3 objects with ETag conditions, so that concurrent
+# invocations of the Lambda function do not overwrite each other's changes.
+# A write only succeeds if the object is still the version that was read (or
+# still does not exist), otherwise the whole update is done again.
+
+# the first botocore whose S3 model knows IfMatch and IfNoneMatch for PutObject, older
+# ones reject every conditional write in the parameter validation
+MinBotocore = (1, 35, 69)
+
+MaxAttempts = 6
+BackoffBase = 0.05
+ConflictCodes = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+class ConflictError(Exception):
+    pass
+
+def is_conflict(e):
+    return e.response.get('Error', {}).get('Code') in ConflictCodes
+
+def not_modified(e):
+    # the error of a GET with IfNoneMatch for an object that is still that version
+    return e.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+def read_json_version(s3, bucket, key, default, etag = None):
+    # Returns a JSON object and its ETag, default and None if there is none yet. With the
+    # ETag of the copy the caller has, returns None and that ETag if it is still current.
+    args = dict(Bucket = bucket, Key = key)
+    if etag is not None:
+        args['IfNoneMatch'] = etag
+    try:
+        obj = s3.get_object(**args)
+    except botocore.exceptions.ClientError as e:
+        if etag is not None and not_modified(e):
+            return None, etag
+        return default, None
+    return json.load(obj['Body']), obj.get('ETag')
+
+def precondition(etag):
+    # arguments for put_object() for an object that was read with this ETag, None if it did not exist
+    return dict(IfMatch = etag) if etag is not None else dict(IfNoneMatch = '*')
+
+def retry_on_conflict(update, what, on_conflict = None, attempts = MaxAttempts):
+    # update() has to read, modify and conditionally write, it is repeated from scratch on a conflict
+    for attempt in range(attempts):
+        try:
+            return update()
+        except botocore.exceptions.ClientError as e:
+            if not is_conflict(e):
+                raise
+            print('Conflicting update of {}, attempt {} of {}'.format(what, attempt + 1, attempts))
+            if on_conflict is not None:
+                on_conflict()
+        if attempt + 1 < attempts:
+            time.sleep(random.uniform(0, BackoffBase * 2 ** attempt))
+    raise ConflictError('Gave up updating {} after {} conflicting writes'.format(what, attempts))
@@ -0,0 +1,370 @@
+import array
+import codecs
+import gzip
+import io
+import json
+import re
+import struct
+import sys
+
+# Reader/writer for the allreadings day files.
+#
+# Two formats are understood, the format of a file is detected from its contents:
+# * 'json': a JSON list of reading dicts (the original format)
+# * 'compact': a gzip compressed, column oriented binary encoding:
+#     header       magic, format version, number of readings
+#     timestamp    milliseconds, first value then deltas, zigzag varints
+#     temperature  int16 centi-degrees
+#     received     run length encoded milliseconds
+#     sensor       table of sensor ids, then run length encoded indices into it
+#     extras       JSON list of [row, {key: value}] for any other keys
+# Timestamps are kept to the millisecond and temperatures to 1/100 degree.
+#
+# iter_load() and dump() stream: JSON is decoded and encoded ChunkSize bytes at a
+# time. Compact files are decompressed ChunkSize bytes at a time as well, but the
+# columns have to be complete before the first reading can be put together, so
+# iter_load() holds the decoded columns of the whole day in arrays: 10 bytes per
+# reading for the timestamps and temperatures and 16 bytes per run of received and
+# sensor values, at most 42 bytes per reading, plus the extra keys. dump() holds the
+# encoded columns, about 5 bytes per reading. Neither holds the file itself or a list
+# of reading dicts.
+
+Magic = b'HDAY'
+GzipMagic = b'\x1f\x8b'
+Version = 1
+HeaderFormat = struct.Struct('<4sBI')
+Formats = ('compact', 'json')
+ColumnKeys = frozenset(('timestamp', 'temperature', 'received', 'sensor'))
+ChunkSize = 64 * 1024
+Whitespace = re.compile(r'\s*')
+
+def zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def unzigzag(z):
+    return z >> 1 if z & 1 == 0 else -(z >> 1) - 1
+
+def write_varint(out, n):
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n == 0:
+            out.append(b)
+            return
+        out.append(b | 0x80)
+
+def write_bytes(out, data):
+    write_varint(out, len(data))
+    out.extend(data)
+
+class Decoder():
+    # reads the encoded values from fileobj, chunk_size bytes at a time
+    def __init__(self, fileobj, chunk_size = ChunkSize):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.data = b''
+        self.pos = 0
+
+    def fill(self, n):
+        # makes sure that the next n bytes are in data
+        while len(self.data) - self.pos < n:
+            chunk = self.fileobj.read(max(self.chunk_size, n))
+            if len(chunk) == 0:
+                raise ValueError('Truncated compact day file')
+            self.data = self.data[self.pos:] + chunk
+            self.pos = 0
+
+    def varint(self):
+        n = 0
+        shift = 0
+        while True:
+            if self.pos == len(self.data):
+                self.fill(1)
+            b = self.data[self.pos]
+            self.pos += 1
+            n |= (b & 0x7f) << shift
+            if b & 0x80 == 0:
+                return n
+            shift += 7
+
+    def bytes(self, n = None):
+        if n is None:
+            n = self.varint()
+        self.fill(n)
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return chunk
+
+def to_millis(ts):
+    return int(round(ts * 1000))
+
+def from_millis(ms):
+    # whole seconds come back as int, like the reader sends them
+    return ms // 1000 if ms % 1000 == 0 else ms / 1000
+
+class CompactEncoder():
+    # collects the columns of the compact format one reading at a time
+    def __init__(self):
+        self.count = 0
+        self.timestamps = bytearray()
+        self.previous = 0
+        self.centi = array.array('h')
+        self.received = []
+        self.sensors = []
+        self.extras = []
+
+    def add(self, r):
+        ms = to_millis(r['timestamp'])
+        write_varint(self.timestamps, zigzag(ms - self.previous))
+        self.previous = ms
+        c = int(round(r['temperature'] * 100))
+        if c < -32768 or c > 32767:
+            raise ValueError('Temperature out of range for the compact day file format')
+        self.centi.append(c)
+        add_run(self.received, to_millis(r['received']) if 'received' in r else None)
+        add_run(self.sensors, r.get('sensor'))
+        if len(r.keys() - ColumnKeys) > 0:
+            self.extras.append([self.count, dict((k, v) for k, v in r.items() if k not in ColumnKeys)])
+        self.count += 1
+
+    def write(self, out):
+        # the columns are written one after the other, without copying them into one buffer
+        out.write(HeaderFormat.pack(Magic, Version, self.count))
+        out.write(self.timestamps)
+        if sys.byteorder != 'little':
+            self.centi.byteswap()
+        out.write(self.centi.tobytes())
+        buf = bytearray()
+        write_varint(buf, len(self.received))
+        previous = 0
+        for value, count in self.received:
+            write_varint(buf, count * 2 + (0 if value is None else 1))
+            if value is not None:
+                write_varint(buf, zigzag(value - previous))
+                previous = value
+        sensors = sorted(set(v for v, _ in self.sensors if v is not None))
+        write_varint(buf, len(sensors))
+        for s in sensors:
+            write_bytes(buf, s.encode())
+        index = dict((s, i + 1) for i, s in enumerate(sensors))
+        write_varint(buf, len(self.sensors))
+        for value, count in self.sensors:
+            write_varint(buf, 0 if value is None else index[value])
+            write_varint(buf, count)
+        write_bytes(buf, json.dumps(self.extras, separators = (',', ':')).encode() if self.extras else b'')
+        out.write(buf)
+
+def add_run(result, v):
+    # run length encoding: list of [value, count]
+    if len(result) > 0 and result[-1][0] == v:
+        result[-1][1] += 1
+    else:
+        result.append([v, 1])
+
+def dump_compact(readings, fileobj):
+    encoder = CompactEncoder()
+    for r in readings:
+        encoder.add(r)
+    with gzip.GzipFile(fileobj = fileobj, mode = 'wb', mtime = 0) as gz:
+        encoder.write(gz)
+
+def iter_compact(fileobj, chunk_size = ChunkSize):
+    # the columns are decoded up front, the reading dicts are only created as they are consumed
+    d = Decoder(gzip.GzipFile(fileobj = fileobj, mode = 'rb'), chunk_size)
+    magic, version, count = HeaderFormat.unpack(d.bytes(HeaderFormat.size))
+    if magic != Magic:
+        raise ValueError('Not a compact day file')
+    if version != Version:
+        raise ValueError('Unsupported day file format version {}'.format(version))
+    timestamps = array.array('q')
+    ms = 0
+    for _ in range(count):
+        ms += unzigzag(d.varint())
+        timestamps.append(ms)
+    centi = array.array('h', d.bytes(2 * count))
+    if sys.byteorder != 'little':
+        centi.byteswap()
+    # the runs are kept in arrays as well, there can be one for every reading; -1 marks
+    # the runs of readings without a received time
+    received, received_counts = array.array('q'), array.array('q')
+    value = 0
+    for _ in range(d.varint()):
+        tag = d.varint()
+        if tag & 1:
+            value += unzigzag(d.varint())
+        received.append(value if tag & 1 else -1)
+        received_counts.append(tag >> 1)
+    sensors = [None] + [d.bytes().decode() for _ in range(d.varint())]
+    sensor_index, sensor_counts = array.array('q'), array.array('q')
+    for _ in range(d.varint()):
+        sensor_index.append(d.varint())
+        sensor_counts.append(d.varint())
+    extras = d.bytes()
+    extras = dict((i, values) for i, values in json.loads(extras.decode())) if extras else dict()
+    received_values = expand_runs(received, received_counts, lambda ms: None if ms < 0 else from_millis(ms))
+    sensor_values = expand_runs(sensor_index, sensor_counts, sensors.__getitem__)
+    for row in range(count):
+        r = dict(timestamp = from_millis(timestamps[row]), temperature = centi[row] / 100)
+        rcv = next(received_values, None)
+        if rcv is not None:
+            r['received'] = rcv
+        sensor = next(sensor_values, None)
+        if sensor is not None:
+            r['sensor'] = sensor
+        if row in extras:
+            r.update(extras[row])
+        yield r
+
+def expand_runs(values, counts, convert):
+    for value, count in zip(values, counts):
+        value = convert(value)
+        for _ in range(count):
+            yield value
+
+def decode_compact(data):
+    return list(iter_compact(io.BytesIO(data)))
+
+class JsonReader():
+    # Incremental reader for a JSON document, ChunkSize bytes are read at a time.
+    def __init__(self, fileobj, head = b'', chunk_size = ChunkSize):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.append(head)
+
+    def append(self, data):
+        text = data if isinstance(data, str) else self.utf8.decode(data, final = len(data) == 0)
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+
+    def fill(self):
+        # returns False at the end of the input
+        if self.eof:
+            return False
+        data = self.fileobj.read(self.chunk_size)
+        self.eof = len(data) == 0
+        self.append(data)
+        return True
+
+    def peek(self):
+        # the next character that is not white space, '' at the end of the input
+        while True:
+            self.pos = Whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                v, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may go on in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return v
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+class Prefixed():
+    # file object that returns head before the rest of fileobj
+    def __init__(self, head, fileobj):
+        self.head = head
+        self.fileobj = fileobj
+
+    def read(self, n = -1):
+        if len(self.head) == 0:
+            return self.fileobj.read(n)
+        if n is None or n < 0:
+            data = self.head + self.fileobj.read()
+        elif n <= len(self.head):
+            data = self.head[:n]
+        else:
+            data = self.head + self.fileobj.read(n - len(self.head))
+        self.head = self.head[len(data):]
+        return data
+
+def iter_json(fileobj, head = b'', chunk_size = ChunkSize):
+    # yields the elements of a JSON list one at a time, a document that is not a list is yielded as a whole
+    reader = JsonReader(fileobj, head, chunk_size)
+    c = reader.peek()
+    if c == '':
+        return
+    if c != '[':
+        yield reader.value()
+        return
+    reader.pos += 1
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.value()
+        c = reader.peek()
+        reader.pos += 1
+        if c == ']':
+            return
+        if c != ',':
+            raise ValueError('Expected , or ] in a JSON list, found {!r}'.format(c))
+
+def iter_load(fileobj, chunk_size = ChunkSize):
+    head = fileobj.read(2)
+    if detect_format(head) == 'compact':
+        return iter_compact(Prefixed(head, fileobj), chunk_size)
+    return iter_json(fileobj, head, chunk_size)
+
+def dump_json(readings, fileobj, chunk_size = ChunkSize):
+    # same output as json.dumps() of the list
+    pending = ['[']
+    size = 1
+    for i, r in enumerate(readings):
+        item = json.dumps(r) if i == 0 else ', ' + json.dumps(r)
+        pending.append(item)
+        size += len(item)
+        if size >= chunk_size:
+            fileobj.write(''.join(pending).encode())
+            pending = []
+            size = 0
+    pending.append(']')
+    fileobj.write(''.join(pending).encode())
+
+def day_of_key(key):
+    # YYYYMMDD of a day file key, [partition]allreadings/dayYYYYMMDD.json
+    return key[-13:-5]
+
+def detect_format(data):
+    if isinstance(data, (bytes, bytearray)) and data[:2] == GzipMagic:
+        return 'compact'
+    return 'json'
+
+def loads(data):
+    if detect_format(data) == 'compact':
+        return decode_compact(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode()
+    return json.loads(data) if data.strip() else []
+
+def load(fileobj):
+    return loads(fileobj.read())
+
+def dump(readings, fileobj, fmt = 'compact'):
+    # readings can be any iterable, it is only iterated once
+    if fmt == 'compact':
+        dump_compact(readings, fileobj)
+    elif fmt == 'json':
+        dump_json(readings, fileobj)
+    else:
+        raise ValueError('Unknown day file format ' + fmt)
+
+def dumps(readings, fmt = 'compact'):
+    if fmt not in Formats:
+        raise ValueError('Unknown day file format ' + fmt)
+    buf = io.BytesIO()
+    dump(readings, buf, fmt)
+    return buf.getvalue()
+
+def content_type(fmt):
+    return 'application/json' if fmt == 'json' else 'application/octet-stream'
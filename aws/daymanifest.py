@@ -0,0 +1,91 @@
+import json
+import time
+
+import botocore.exceptions
+
+import conditional
+import dayfile
+
+# The manifest lists the day files of a partition, so range queries, backfills and
+# retention jobs can plan their work from one request instead of listing the bucket
+# and reading every day file:
+#
+# allreadings/manifest.json  {"days": {"YYYYMMDD": entry}}
+#
+# entry is {"count": readings, "first": timestamp, "last": timestamp, "bytes": size,
+# "etag": ETag, "format": "compact/1" or "json", "updated": time of the write}.
+# write_readings() and the compact and rebuild commands of local.py update the entries
+# of the day files they write, the newer entry of a day wins if they race. The manifest
+# command of local.py rebuilds it from the day files.
+
+ManifestKey = 'allreadings/manifest.json'
+
+def format_version(fmt):
+    return '{}/{}'.format(fmt, dayfile.Version) if fmt == 'compact' else fmt
+
+class Tally():
+    # counts the readings of an iterator as they pass through
+    def __init__(self, readings):
+        self.readings = readings
+        self.count = 0
+        self.first = None
+        self.last = None
+
+    def __iter__(self):
+        for r in self.readings:
+            ts = r['timestamp']
+            self.count += 1
+            self.first = ts if self.first is None else min(self.first, ts)
+            self.last = ts if self.last is None else max(self.last, ts)
+            yield r
+
+def make_entry(tally, size, etag, fmt, now = None):
+    return dict(count = tally.count, first = tally.first, last = tally.last, bytes = size, etag = etag,
+                format = format_version(fmt), updated = time.time() if now is None else now)
+
+def read_manifest_version(xenv, bucket, partition = ''):
+    return conditional.read_json_version(xenv.s3, bucket, partition + ManifestKey, dict(days = dict()))
+
+def read_manifest(xenv, bucket, partition = ''):
+    return read_manifest_version(xenv, bucket, partition)[0]
+
+def write_manifest(xenv, bucket, manifest, partition = '', **condition):
+    xenv.s3.put_object(Bucket = bucket, Key = partition + ManifestKey, Body = json.dumps(manifest, separators = (',', ':'), sort_keys = True).encode(),
+                       ContentType = 'application/json', **condition)
+
+def update_manifest(xenv, bucket, entries, partition = ''):
+    # entries: {day: entry} of the day files that were just written
+    if len(entries) == 0:
+        return
+    def update():
+        manifest, etag = read_manifest_version(xenv, bucket, partition)
+        days = manifest['days']
+        for day, entry in entries.items():
+            if entry['updated'] >= days.get(day, dict()).get('updated', 0):
+                days[day] = entry
+        write_manifest(xenv, bucket, manifest, partition, **conditional.precondition(etag))
+    conditional.retry_on_conflict(update, partition + ManifestKey)
+
+def rebuild_manifest(xenv, bucket, day_keys, partition = '', replace = False):
+    # Reads the given day files and replaces their entries. With replace the entries of
+    # the days that are not among them are dropped, for a list of all day files.
+    entries, missing = dict(), []
+    for key in day_keys:
+        try:
+            obj = xenv.s3.get_object(Bucket = bucket, Key = key)
+        except botocore.exceptions.ClientError:
+            print('No day file ' + key)
+            missing.append(dayfile.day_of_key(key))
+            continue
+        data = obj['Body'].read()
+        tally = Tally(dayfile.loads(data))
+        for _ in tally:
+            pass
+        entries[dayfile.day_of_key(key)] = make_entry(tally, len(data), obj.get('ETag'), dayfile.detect_format(data))
+    def update():
+        manifest, etag = read_manifest_version(xenv, bucket, partition)
+        days = dict() if replace else dict((d, e) for d, e in manifest['days'].items() if d not in missing)
+        days.update(entries)
+        write_manifest(xenv, bucket, dict(manifest, days = days), partition, **conditional.precondition(etag))
+    conditional.retry_on_conflict(update, partition + ManifestKey)
+    print('Rebuilt {}{} with {} day files'.format(partition, ManifestKey, len(entries)))
@@ -0,0 +1,70 @@
+import json
+import re
+
+import conditional
+
+# Several readers (devices) can share one deployment. A reader with a device id uploads
+# below observations/<device>/ and sends the id with direct invocations. The status, day
+# files, rollups and archived readings of a device are kept below devices/<device>/, the
+# readers without a device id use the top level as before.
+#
+# The manifest lists every device with the time of its latest reading, so the scheduled
+# check finds the devices that have gone quiet with a single request. The entries are
+# only refreshed every ManifestInterval seconds, a device that looks quiet in the
+# manifest is checked against its status before an alert is sent.
+
+Manifest = 'lambda_internal/devices.json'
+UploadPrefix = 'observations/'
+DevicePrefix = 'devices/{}/'
+DeviceId = re.compile('^[A-Za-z0-9_-]{1,64}$')
+ManifestInterval = 3600
+
+def partition(device):
+    # key prefix of the objects of a device
+    return DevicePrefix.format(device) if device else ''
+
+def upload_prefix(device):
+    # key prefix of the uploads of a device
+    return '{}{}/'.format(UploadPrefix, device) if device else UploadPrefix
+
+def valid_device(device):
+    return device == '' or DeviceId.match(device) is not None
+
+def device_of_key(key):
+    # observations/<device>/<file>, None if the device id is not valid
+    parts = key.split('/')
+    device = parts[1] if len(parts) == 3 else ''
+    return device if valid_device(device) else None
+
+def uploaded_by(key, device):
+    # False for the uploads of other devices, keys outside of the uploads are not filtered
+    return not key.startswith(UploadPrefix) or device_of_key(key) == device
+
+def read_manifest(xenv):
+    # returns {device: latest reading timestamp}, a warm container only fetches it if it has changed
+    manifest, etag = conditional.read_json_version(xenv.s3, xenv.lambda_bucket, Manifest, dict(devices = dict()),
+                                                   xenv.manifest_etag if xenv.manifest is not None else None)
+    if manifest is not None:
+        xenv.manifest, xenv.manifest_etag = manifest['devices'], etag
+    return xenv.manifest
+
+def outdated(manifest, latest):
+    # the devices whose manifest entry is new or ManifestInterval behind their latest reading
+    return dict((d, ts) for d, ts in latest.items() if ts >= manifest.get(d, -ManifestInterval) + ManifestInterval)
+
+def update_manifest(xenv, latest):
+    # latest: {device: latest reading timestamp}, most invocations do not need to write
+    if len(latest) == 0 or len(outdated(read_manifest(xenv), latest)) == 0:
+        return
+    def update():
+        manifest = dict(read_manifest(xenv))
+        manifest.update(outdated(manifest, latest))
+        resp = xenv.s3.put_object(Bucket = xenv.lambda_bucket, Key = Manifest, ContentType = 'application/json',
+                                  Body = json.dumps(dict(devices = manifest), separators = (',', ':')).encode(),
+                                  **conditional.precondition(xenv.manifest_etag))
+        xenv.manifest, xenv.manifest_etag = manifest, resp.get('ETag')
+    conditional.retry_on_conflict(update, Manifest)
+
+def quiet_devices(manifest, now, max_delay):
+    # max_delay(device) -> seconds
+    return sorted(d for d, ts in manifest.items() if now - ts > max_delay(d))
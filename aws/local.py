@@ -0,0 +1,234 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import tempfile
+import time
+
+import boto3
+import botocore.config
+
+import conditional
+import dayfile
+import daymanifest
+import devices
+import process_temp_readings
+import rollups
+
+# Runs the Lambda function and its maintenance commands locally, with the credentials of
+# an AWS profile. Kept out of process_temp_readings.py so the function does not load it.
+#
+#   python local.py --profile <profile> --bucket <bucket> rollups
+
+def init_local(profile, bucket, max_connections = 10):
+    xenv = process_temp_readings.ExecutionEnvironment()
+    xenv.s3 = boto3.Session(profile_name = profile).client('s3', config = botocore.config.Config(max_pool_connections = max_connections))
+    class MockSns():
+        def publish(self, Phonenumber, Message):
+            print('SNS message to {}: "{}"'.format(Phonenumber, Message))
+    xenv.lambda_bucket = bucket
+    xenv.get_sns_client = lambda: MockSns()
+    return xenv
+
+def put_day_file(xenv, bucket, key, readings, fmt = None, **condition):
+    # returns the manifest entry of the written file
+    fmt = fmt or process_temp_readings.DayFileFormat
+    with tempfile.SpooledTemporaryFile(max_size = process_temp_readings.SpoolSize) as body:
+        tally = daymanifest.Tally(readings)
+        dayfile.dump(tally, body, fmt)
+        size = body.tell()
+        resp = process_temp_readings.upload_day_file(xenv, bucket, key, body, fmt, **condition)
+    return daymanifest.make_entry(tally, size, resp.get('ETag'), fmt)
+
+def list_day_files(xenv, bucket, partition = ''):
+    pages = xenv.s3.get_paginator('list_objects_v2').paginate(Bucket = bucket, Prefix = partition + 'allreadings/day')
+    return [o['Key'] for page in pages for o in page.get('Contents', [])]
+
+def compact_day_file(xenv, bucket, key, fmt):
+    # returns the manifest entry of the rewritten file, None if it was left alone
+    obj = xenv.s3.get_object(Bucket = bucket, Key = key)
+    data = obj['Body'].read()
+    readings = dayfile.loads(data)
+    if len(readings) == 0:
+        return None
+    compacted = process_temp_readings.consolidate_readings(readings)
+    if len(compacted) == len(readings) and dayfile.detect_format(data) == fmt:
+        print('{}: no duplicates in {} readings'.format(key, len(readings)))
+        return None
+    entry = put_day_file(xenv, bucket, key, compacted, fmt, **conditional.precondition(obj['ETag']))
+    print('{}: removed {} duplicates, {} readings left, {} format'.format(key, len(readings) - len(compacted), len(compacted), fmt))
+    return entry
+
+def compact_day_files(xenv, bucket, keys, fmt = None, partition = ''):
+    # One-off cleanup of day files that collected duplicates before write_readings() removed them.
+    # Files that are not in the requested format yet are converted. The keys must belong to
+    # the partition, whose manifest gets the entries of the rewritten files. A file that the
+    # Lambda function writes in the meantime is compacted again.
+    fmt = fmt or process_temp_readings.DayFileFormat
+    entries = dict()
+    for key in keys:
+        entry = conditional.retry_on_conflict(lambda: compact_day_file(xenv, bucket, key, fmt), key)
+        if entry is not None:
+            entries[dayfile.day_of_key(key)] = entry
+    daymanifest.update_manifest(xenv, bucket, entries, partition)
+
+class RebuildCheckpoint():
+    # progress of a rebuild, kept in <workdir>/checkpoint.json
+    def __init__(self, workdir, prefixes):
+        self.fname = os.path.join(workdir, 'checkpoint.json')
+        self.spooldir = os.path.join(workdir, 'days')
+        os.makedirs(self.spooldir, exist_ok = True)
+        try:
+            with open(self.fname) as f:
+                values = json.load(f)
+        except FileNotFoundError:
+            values = dict(prefixes = prefixes, last_keys = dict(), listing_done = False, written = [], started = time.time())
+        if 'prefix' in values:
+            # written by a rebuild of a single prefix
+            values.update(prefixes = [values['prefix']], last_keys = {values.pop('prefix'): values.pop('last_key')})
+        if values['prefixes'] != prefixes:
+            raise Exception('{} belongs to a rebuild of {}, use a different work directory'.format(workdir, ' '.join(values['prefixes'])))
+        # the manifest entries of the written days, added to the manifest at the end
+        values.setdefault('entries', dict())
+        # the stored readings received after this are kept, checkpoints without it keep all
+        values.setdefault('started', 0)
+        self.__dict__.update(values)
+
+    def save(self):
+        values = dict(prefixes = self.prefixes, last_keys = self.last_keys, listing_done = self.listing_done, written = self.written,
+                      entries = self.entries, started = self.started)
+        with open(self.fname + '.tmp', 'w') as f:
+            json.dump(values, f)
+        os.replace(self.fname + '.tmp', self.fname)
+
+    def spool(self, readings):
+        # append the readings to one file per day, duplicates are removed when the day is written
+        for dt, dayreadings in process_temp_readings.split_by_date(readings).items():
+            with open(os.path.join(self.spooldir, dt.strftime('%Y%m%d.ndjson')), 'a') as f:
+                for r in dayreadings:
+                    print(json.dumps(r), file = f)
+
+    def spooled_days(self):
+        return sorted(f[:8] for f in os.listdir(self.spooldir) if f.endswith('.ndjson'))
+
+    def read_spool(self, day):
+        with open(os.path.join(self.spooldir, day + '.ndjson')) as f:
+            return [json.loads(line) for line in f]
+
+def fetch_observation(xenv, bucket, key):
+    obj = xenv.s3.get_object(Bucket = bucket, Key = key)
+    if obj['ContentLength'] == 0:
+        return [], 0
+    readings = process_temp_readings.read_observation(obj)
+    received = obj['LastModified'].timestamp()
+    for r in readings:
+        r.setdefault('received', received)
+    return readings, obj['ContentLength']
+
+def rebuild_prefixes(device):
+    # where the readings of a device are kept raw: its uploads to S3 and the archived
+    # batches of its direct invocations
+    prefixes = [devices.upload_prefix(device)]
+    if process_temp_readings.ArchivePrefix:
+        prefixes.append('{}{}/'.format(devices.partition(device), process_temp_readings.ArchivePrefix))
+    return prefixes
+
+def rebuild_archive(xenv, bucket, prefixes, workdir, workers = process_temp_readings.MaxWorkers, fmt = None, device = ''):
+    # Re-derive the day files of a device from its raw readings below all of the prefixes
+    # without touching the status or sending alerts. The day files are replaced, so the
+    # prefixes must cover every place its readings went to, see rebuild_prefixes(). The
+    # uploads of other devices below a prefix are skipped. Downloads are spooled by day in
+    # workdir first, so every day file is written exactly once. The readings the Lambda
+    # function stored after the rebuild started are kept, it may have written them after
+    # their uploads were listed. Rerun with the same workdir to resume.
+    partition = devices.partition(device)
+    checkpoint = RebuildCheckpoint(workdir, prefixes)
+    start = time.time()
+    nobjects = nbytes = nreadings = 0
+    if not checkpoint.listing_done:
+        paginator = xenv.s3.get_paginator('list_objects_v2')
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+            for prefix in prefixes:
+                for page in paginator.paginate(Bucket = bucket, Prefix = prefix, StartAfter = checkpoint.last_keys.get(prefix, '')):
+                    listed = [o['Key'] for o in page.get('Contents', [])]
+                    if len(listed) == 0:
+                        continue
+                    keys = [k for k in listed if devices.uploaded_by(k, device)]
+                    for readings, size in pool.map(lambda key: fetch_observation(xenv, bucket, key), keys):
+                        checkpoint.spool(readings)
+                        nreadings += len(readings)
+                        nbytes += size
+                    nobjects += len(keys)
+                    checkpoint.last_keys[prefix] = listed[-1]
+                    checkpoint.save()
+                    elapsed = max(time.time() - start, 0.001)
+                    print('{} objects, {} readings, {:.1f} MB downloaded, {:.1f} objects/s, {:.1f} readings/s'.format(nobjects, nreadings, nbytes / 1e6, nobjects / elapsed, nreadings / elapsed))
+        checkpoint.listing_done = True
+        checkpoint.save()
+    days = [d for d in checkpoint.spooled_days() if d not in checkpoint.written]
+    def write_day(day):
+        key = '{}allreadings/day{}.json'.format(partition, day)
+        spooled = checkpoint.read_spool(day)
+        def write():
+            stored, etag = process_temp_readings.read_day_file(xenv, bucket, key)
+            late = [r for r in stored if r.get('received', 0) >= checkpoint.started]
+            readings = process_temp_readings.consolidate_readings(spooled + late)
+            return put_day_file(xenv, bucket, key, readings, fmt, **conditional.precondition(etag))
+        return day, conditional.retry_on_conflict(write, key)
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+        for day, entry in pool.map(write_day, days):
+            checkpoint.written.append(day)
+            checkpoint.entries[day] = entry
+            checkpoint.save()
+            print('Wrote {}allreadings/day{}.json with {} readings'.format(partition, day, entry['count']))
+    daymanifest.update_manifest(xenv, bucket, checkpoint.entries, partition)
+    elapsed = max(time.time() - start, 0.001)
+    print('Rebuilt {} day files from {} objects in {:.1f}s ({:.1f} objects/s)'.format(len(days), nobjects, elapsed, nobjects / elapsed))
+    print('The rollups are not updated by a rebuild, use the rollups command for that.')
+
+def parse_commandline(cmdline):
+    # --profile <profile> file|schedule|compact|rollups|manifest|rebuild [--format compact|json] --bucket <bucket> --file filekey1 --file filekey2
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', default='default', help='Which aws profile to use')
+    parser.add_argument('--bucket', default='ktsr42.s3.heating', help='Which bucket to use for putfile events')
+    parser.add_argument('event', choices=['file', 'schedule', 'compact', 'rollups', 'manifest', 'rebuild'], help = 'Type of event to feed to the handler, compact to remove duplicates from the day files and convert them to --format, rollups to rebuild the rollups from the day files, manifest to rebuild the day file manifest or rebuild to regenerate the day files from the raw uploads')
+    parser.add_argument('--format', choices=dayfile.Formats, default=process_temp_readings.DayFileFormat, help = 'Day file format written by compact and rebuild')
+    parser.add_argument('--prefix', nargs='+', help = 'Prefixes of the raw readings for rebuild, default is the uploads and the archived direct invocations of --device; uploads of other devices below them are skipped. The day files are replaced with the readings found below all of them')
+    parser.add_argument('--workdir', default='rebuild', help = 'Directory for the downloaded readings and the checkpoint of rebuild, rerun with the same one to resume')
+    parser.add_argument('--workers', type=int, default=16, help = 'Number of concurrent downloads and uploads for rebuild')
+    parser.add_argument('--device', default='', help = 'Device whose day files and rollups compact, rollups, manifest and rebuild work on, default is the readers without a device id')
+    parser.add_argument('--file', nargs='*', default = [], help = 'Filename to put into a putfile event or day file to compact or rebuild the rollups or manifest entry for, default is all day files (may be repeated)')
+    args = parser.parse_args(cmdline)
+    if args.event == 'file':
+        if args.file == []:
+            parser.error('For file events you must supply at least one --file argument')
+    return args
+
+def main():
+    args = parse_commandline(sys.argv[1:])
+    xenv = init_local(args.profile, args.bucket, max(10, args.workers))
+    partition = devices.partition(args.device)
+    if args.event == 'rebuild':
+        rebuild_archive(xenv, args.bucket, args.prefix or rebuild_prefixes(args.device), args.workdir, args.workers, args.format, args.device)
+        return
+    if args.event == 'compact':
+        compact_day_files(xenv, args.bucket, args.file if args.file else list_day_files(xenv, args.bucket, partition), args.format, partition)
+        return
+    if args.event == 'rollups':
+        rollups.rebuild_rollups(xenv, args.bucket, args.file if args.file else list_day_files(xenv, args.bucket, partition), partition)
+        return
+    if args.event == 'manifest':
+        # without --file all entries are replaced
+        daymanifest.rebuild_manifest(xenv, args.bucket, args.file if args.file else list_day_files(xenv, args.bucket, partition), partition, replace = not args.file)
+        return
+    if args.event == 'schedule':
+        event = dict(source = 'aws.events')
+    else:
+        records = [dict(eventSource = 'aws:s3', s3 = dict(bucket=dict(name=args.bucket), object=dict(key=f))) for f in args.file]
+        event = dict(Records=records)
+    
+    process_temp_readings.process_events(xenv, event, None)
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,163 @@
-import argparse
+import collections
+import contextlib
+import copy
 import datetime
+import gzip
 import json
 import os
-import sys
+import tempfile
+import threading
 import time
 import urllib.parse
 
-import boto3
-import botocore.errorfactory
+import botocore.exceptions
+
+import conditional
+import dayfile
+import daymanifest
+import devices
+import rollups
+import rules
 
 ConfigFile = 'lambda_internal/receiver_config.json'
 LambdaStatus = 'lambda_internal/receiver_status.json'
 
 ConfigKeys = dict(minimum_temperature = float, repeat_alert_hours = int, phonenumber = str, max_delay = lambda v: int(v) * 60)
 
+# format for day files written by the lambda, files in either format can be read. The keys
+# end in .json either way, so only set DAYFILE_FORMAT=compact once every consumer of the
+# day files reads the compact format (dayfile.py).
+DayFileFormat = os.getenv('DAYFILE_FORMAT', 'json')
+
+# upper bound for concurrent S3 requests within one invocation
+MaxWorkers = 8
+# merged day files are spooled to /tmp above this size
+SpoolSize = 1024 * 1024
+
+# seconds a warm container uses its copy of the config before it asks S3 whether it has changed
+ConfigTtl = 300
+
+# events sent by the reader with the readings inline, see read_temp.invoke_lambda()
+ReaderEventSource = 'heating.reader'
+# the readings of direct invocations are archived below this prefix, empty to turn it off
+ArchivePrefix = os.getenv('ARCHIVE_PREFIX', 'rawreadings')
+
+# CloudWatch namespace of the per invocation metrics
+MetricsNamespace = 'Heating'
+
 def read_config(xenv):
+    now = time.time()
+    if xenv.config is not None and now < xenv.config_checked + ConfigTtl:
+        return xenv.config
+    args = dict(Bucket = xenv.lambda_bucket, Key = ConfigFile)
+    if xenv.config is not None and xenv.config_etag is not None:
+        args['IfNoneMatch'] = xenv.config_etag
+    try:
+        obj = xenv.s3.get_object(**args)
+    except botocore.exceptions.ClientError as e:
+        if 'IfNoneMatch' in args and conditional.not_modified(e):
+            xenv.config_checked = now
+            return xenv.config
+        raise
     class D(): pass
     cfg = D()
-    rawvals = json.load(xenv.s3.get_object(Bucket = xenv.lambda_bucket, Key = ConfigFile)['Body'])
+    rawvals = json.load(obj['Body'])
     for k in ConfigKeys.keys():
         cfg.__setattr__(k, ConfigKeys[k](rawvals[k]))
+    cfg.rules = rules.RuleSet(rawvals.get('rules'))
+    # "devices": {device id: {setting: value}} overrides settings for single devices
+    cfg.devices = dict()
+    for device, overrides in rawvals.get('devices', dict()).items():
+        dcfg = D()
+        dcfg.__dict__.update(cfg.__dict__)
+        for k in ConfigKeys.keys():
+            if k in overrides:
+                dcfg.__setattr__(k, ConfigKeys[k](overrides[k]))
+        if 'rules' in overrides:
+            dcfg.rules = rules.RuleSet(overrides['rules'])
+        cfg.devices[device] = dcfg
+    xenv.config_etag = obj.get('ETag')
+    xenv.config_checked = now
     return cfg
 
 
+class Metrics():
+    # Timings and counters of one invocation, printed as a single line in the
+    # CloudWatch embedded metric format so they can be graphed and searched.
+    def __init__(self, enabled = True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.values = collections.OrderedDict()
+        self.units = dict()
+        self.properties = dict()
+        self.dimensions = dict()
+
+    def add(self, name, value, unit = 'Count'):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def add_duration(self, name, seconds):
+        self.add(name + '_ms', seconds * 1000, 'Milliseconds')
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(name, time.perf_counter() - start)
+
+    def emit(self):
+        if not self.enabled:
+            return
+        line = dict(_aws = dict(Timestamp = int(time.time() * 1000),
+                                CloudWatchMetrics = [dict(Namespace = MetricsNamespace,
+                                                          Dimensions = [sorted(self.dimensions.keys())],
+                                                          Metrics = [dict(Name = n, Unit = self.units[n]) for n in self.values.keys()])]))
+        line.update(self.properties)
+        line.update(self.dimensions)
+        line.update((n, round(v, 3)) for n, v in self.values.items())
+        print(json.dumps(line))
+
+DisabledMetrics = Metrics(enabled = False)
+
+def metrics(xenv):
+    # only process_events() records metrics, local commands and direct calls do not
+    m = getattr(xenv, 'metrics', None)
+    return m if isinstance(m, Metrics) else DisabledMetrics
+
 class Status():
-    def __init__(self, temp_reading = 0, last_reading_ts = 0, last_alert_ts = 0):
+    def __init__(self, temp_reading = 0, last_reading_ts = 0, last_alert_ts = 0, sensors = None, rules = None):
         self.temp_reading = temp_reading
         self.last_reading_ts = last_reading_ts
         self.last_alert_ts = last_alert_ts
+        # sensor id -> [temperature, timestamp] of its latest reading
+        self.sensors = sensors if sensors is not None else dict()
+        # rule name -> sensor id -> state of the alert rule, see rules.RuleSet.evaluate()
+        self.rules = rules if rules is not None else dict()
 
     def create_json(self):
         values = dict(temperature_reading = self.temp_reading,
                       last_reading_timestamp = self.last_reading_ts,
                       last_alert_timestamp = self.last_alert_ts)
+        if self.sensors:
+            values['sensors'] = self.sensors
+        if self.rules:
+            values['rules'] = self.rules
         return json.dumps(values)
 
     @staticmethod
     def read_status(file):
         values = json.load(file)
         args = [float(values.get(k, 0)) for k in ('temperature_reading', 'last_reading_timestamp', 'last_alert_timestamp')]
-        return Status(*args)
+        return Status(*args, sensors = values.get('sensors'), rules = values.get('rules'))
+
+def reading_key(r):
+    # readings without a sensor id come from readers that only support a single sensor
+    return (r['timestamp'], r.get('sensor', ''))
 
 def split_by_date(readings):
     datemaps = dict()
@@ -50,86 +168,276 @@ def split_by_date(readings):
         datemaps[rd] = rl
     return datemaps
 
-def write_readings(xenv, bucket, datemaps):
-    for dt in datemaps.keys():
-        fname = dt.strftime('allreadings/day%Y%m%d.json')
-        try:
-            datereadings = json.load(xenv.s3.get_object(Bucket = bucket, Key = fname)['Body'])
-        except botocore.errorfactory.ClientError:
-            datereadings = []
-        datereadings.extend(datemaps[dt])
-        sortedreadings = sorted(datereadings, key = lambda x:x['timestamp'])
-        xenv.s3.put_object(Bucket = bucket, Key=fname, Body = json.dumps(sortedreadings).encode())
-                 
+def is_sorted(readings):
+    return all(reading_key(readings[i-1]) <= reading_key(readings[i]) for i in range(1, len(readings)))
+
+class UnsortedReadings(Exception):
+    pass
+
+def iter_merge(existing, new, added):
+    # Linear merge of two iterables sorted by reading_key(). A reading that is already
+    # stored wins over a new copy of it. The new readings that were not in there yet
+    # are appended to added. Raises UnsortedReadings if existing is out of order.
+    new = iter(new)
+    last = previous = None
+    pending = next(new, None)
+    for r in existing:
+        key = reading_key(r)
+        if previous is not None and key < previous:
+            raise UnsortedReadings()
+        previous = key
+        while pending is not None and reading_key(pending) < key:
+            if reading_key(pending) != last:
+                last = reading_key(pending)
+                added.append(pending)
+                yield pending
+            pending = next(new, None)
+        if key != last:
+            last = key
+            yield r
+    while pending is not None:
+        if reading_key(pending) != last:
+            last = reading_key(pending)
+            added.append(pending)
+            yield pending
+        pending = next(new, None)
+
+def run_concurrently(func, items):
+    # like map() on a bounded thread pool, the results keep the order of the items
+    items = list(items)
+    if len(items) <= 1:
+        return [func(i) for i in items]
+    # only imported for events with more than one record, day or rollup
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers = min(MaxWorkers, len(items))) as pool:
+        return list(pool.map(func, items))
+
+def read_day_file(xenv, bucket, key):
+    # returns an iterator over the readings in the day file, decoded as they are
+    # consumed, and the ETag of the file, None if there is none yet
+    try:
+        obj = xenv.s3.get_object(Bucket = bucket, Key = key)
+    except botocore.exceptions.ClientError:
+        return iter([]), None
+    metrics(xenv).add('bytes_read', obj.get('ContentLength', 0), 'Bytes')
+    return dayfile.iter_load(obj['Body']), obj.get('ETag')
+
+def merge_day_file(xenv, bucket, fname, newreadings):
+    # The stored readings are streamed through the merge into a spool file, so neither
+    # the old nor the new day file are held in memory as a whole. The new file is only
+    # written if nobody else has changed the day file in the meantime.
+    # Returns the added readings and the manifest entry of the new file, None if
+    # nothing was added.
+    m = metrics(xenv)
+    dayadded = []
+    with tempfile.SpooledTemporaryFile(max_size = SpoolSize) as body:
+        with m.phase('merge'):
+            stored, etag = read_day_file(xenv, bucket, fname)
+            try:
+                merged = daymanifest.Tally(iter_merge(stored, newreadings, dayadded))
+                dayfile.dump(merged, body, DayFileFormat)
+            except UnsortedReadings:
+                # files written before the merge was introduced are in arrival order
+                del dayadded[:]
+                body.seek(0)
+                body.truncate()
+                stored, etag = read_day_file(xenv, bucket, fname)
+                merged = daymanifest.Tally(iter_merge(sorted(stored, key = reading_key), newreadings, dayadded))
+                dayfile.dump(merged, body, DayFileFormat)
+        if len(dayadded) == 0:
+            return dayadded, None
+        size = body.tell()
+        resp = upload_day_file(xenv, bucket, fname, body, DayFileFormat, **conditional.precondition(etag))
+    return dayadded, daymanifest.make_entry(merged, size, resp.get('ETag'), DayFileFormat)
+
+def write_day_readings(xenv, bucket, dt, readings, partition = ''):
+    fname = partition + dt.strftime('allreadings/day%Y%m%d.json')
+    newreadings = readings if is_sorted(readings) else sorted(readings, key = reading_key)
+    dayadded, entry = conditional.retry_on_conflict(lambda: merge_day_file(xenv, bucket, fname, newreadings), fname,
+                                                    lambda: metrics(xenv).add('write_conflicts', 1))
+    if len(dayadded) == 0:
+        print('No new readings for {}'.format(fname))
+    return dayadded, entry
+
+def write_readings(xenv, bucket, datemaps, partition = ''):
+    # every day file is read and written independently, returns the added readings in date order
+    days = sorted(datemaps.keys())
+    written = run_concurrently(lambda dt: write_day_readings(xenv, bucket, dt, datemaps[dt], partition), days)
+    with metrics(xenv).phase('day_manifest'):
+        daymanifest.update_manifest(xenv, bucket, dict((dt.strftime('%Y%m%d'), entry) for dt, (_, entry) in zip(days, written) if entry is not None), partition)
+    return [r for dayadded, _ in written for r in dayadded]
+
+def upload_day_file(xenv, bucket, key, body, fmt, **condition):
+    metrics(xenv).add('bytes_written', body.tell(), 'Bytes')
+    body.seek(0)
+    return xenv.s3.put_object(Bucket = bucket, Key = key, Body = body, ContentType = dayfile.content_type(fmt), **condition)
 
 def consolidate_readings(readings):
     assert len(readings) > 0
-    sorted_readings = sorted(readings, key = lambda x:x['timestamp'])
+    sorted_readings = sorted(readings, key = reading_key)
     if len(readings) == 1:
         unique_indices = [0]
     else:
-        unique_indices = [0] + [i for i in range(1, len(sorted_readings)) if sorted_readings[i]['timestamp'] != sorted_readings[i-1]['timestamp']]
+        unique_indices = [0] + [i for i in range(1, len(sorted_readings)) if reading_key(sorted_readings[i]) != reading_key(sorted_readings[i-1])]
     return [sorted_readings[i] for i in unique_indices]
 
+def latest_readings(readings):
+    # readings must be sorted, returns sensor id -> latest reading
+    latest = dict()
+    for r in readings:
+        latest[r.get('sensor')] = r
+    return latest
+
+def update_sensor_status(sensors, latest):
+    tagged = [r for s, r in latest.items() if s is not None]
+    if len(tagged) == 0:
+        return sensors
+    sensors = dict(sensors)
+    for r in tagged:
+        if r['timestamp'] >= sensors.get(r['sensor'], [0, 0])[1]:
+            sensors[r['sensor']] = [r['temperature'], r['timestamp']]
+    return sensors
+
+def publish_alert(xenv, msg):
+    print("Sending alert '{}'".format(msg))
+    xenv.get_sns_client().publish(PhoneNumber=xenv.config.phonenumber, Message=msg)
+
 def send_alert(xenv, msg):
     now = time.time()
     if now > xenv.last_status.last_alert_ts + 3600 * xenv.config.repeat_alert_hours:
         finalmsg = datetime.datetime.fromtimestamp(now).strftime("%Y.%m.%d %H:%M:%S UTC: ") + msg
-        print("Sending alert '{}'".format(finalmsg))
-        xenv.get_sns_client().publish(PhoneNumber=xenv.config.phonenumber, Message=finalmsg)
+        if isinstance(getattr(xenv, 'outbox', None), list):
+            # process_events() publishes it once the status with the new alert timestamp is stored
+            xenv.outbox.append(finalmsg)
+        else:
+            publish_alert(xenv, finalmsg)
     else:
         print("Not sending alert " + msg)
     
-def process_temperature_reading(xenv, records):
-    latest_reading = dict(timestamp = 0)
+def read_observation(obj):
+    # current readers upload gzip compressed JSON, older ones plain JSON
+    body = obj['Body']
+    head = body.read(2)
+    if head == dayfile.GzipMagic:
+        return list(dayfile.iter_json(gzip.GzipFile(fileobj = dayfile.Prefixed(head, body), mode = 'rb')))
+    return list(dayfile.iter_json(body, head))
+
+def fetch_record(xenv, rec):
+    # returns the readings referenced by an event record, None if there are none
+    if rec.get('eventSource', '') != 'aws:s3':
+        print("Unknown event record: " + json.dumps(rec, indent=2))
+        return None
+    bucket = rec['s3']['bucket']['name']
+    key = urllib.parse.unquote_plus(rec['s3']['object']['key'])
+    try:
+        obj = xenv.s3.get_object(Bucket = bucket, Key = key)
+    except botocore.exceptions.ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        if code == 'NoSuchKey':
+            print('The event object references an invalid key: ' + key)
+            return None
+        if code == 'NoSuchBucket':
+            print('The event object references an invalid bucket: ' + bucket)
+            return None
+        raise
+    if obj['ContentLength'] > 0:
+        m = metrics(xenv)
+        m.add('bytes_read', obj['ContentLength'], 'Bytes')
+        with m.phase('parse'):
+            return read_observation(obj)
+    print('The file in the event is empty.')
+    return None
+
+def ingest_readings(xenv, records, partition = ''):
+    # Stores the readings of the S3 event records in the day files and rollups. Returns
+    # the readings consolidated and the time they were received, the status is not needed.
     all_readings = []
     now = time.time()
-    for rec in records:
-        if rec.get('eventSource', '') != 'aws:s3':
-            print("Unknown event record: " + json.dumps(rec, indent=2))
+    m = metrics(xenv)
+    with m.phase('fetch'):
+        fetched = run_concurrently(lambda rec: fetch_record(xenv, rec), records)
+    for rec, readings in zip(records, fetched):
+        if readings is None:
             continue
         bucket = rec['s3']['bucket']['name']
-        key = urllib.parse.unquote_plus(rec['s3']['object']['key'])
-        try:
-            obj = xenv.s3.get_object(Bucket = bucket, Key = key)
-        except botocore.errorfactory.NoSuchKey:
-            print('The event object references an invalid key: ' + key)
-            continue
-        except botocore.errorfactory.NoSuchBucket:
-            print('The event object references an invalid bucket: ' + bucket)
-            continue
-        if obj['ContentLength'] > 0:
-            readings = json.load(obj['Body'])
-        else:
-            print('The file in the event is empty.')
-            continue
-        
         for d in readings:
             d['received'] = now
         all_readings.extend(readings)
 
     if len(all_readings) == 0:
+        return [], now
+    return store_readings(xenv, bucket, all_readings, now, partition)
+
+def ingest_direct(xenv, event, partition = ''):
+    # like ingest_readings() for the readings of a direct invocation by the reader
+    now = time.time()
+    all_readings = [dict(r, received = now) for r in event.get('readings', [])]
+    if len(all_readings) == 0:
+        return [], now
+    cons_readings, now = store_readings(xenv, xenv.lambda_bucket, all_readings, now, partition)
+    if ArchivePrefix:
+        with metrics(xenv).phase('archive'):
+            archive_readings(xenv, xenv.lambda_bucket, all_readings, now, partition)
+    return cons_readings, now
+
+def archive_readings(xenv, bucket, readings, now, partition = ''):
+    # One object per invocation in the format of the reader uploads, outside of the
+    # observations prefix so that it does not trigger this function again.
+    # The rebuild command of local.py reads them together with the uploads.
+    key = '{}{}/{:%Y/%m/%d/%H%M%S}-{}.json'.format(partition, ArchivePrefix, datetime.datetime.utcfromtimestamp(now), os.urandom(4).hex())
+    body = gzip.compress(json.dumps(readings, separators = (',', ':')).encode())
+    metrics(xenv).add('bytes_written', len(body), 'Bytes')
+    xenv.s3.put_object(Bucket = bucket, Key = key, Body = body, ContentType = 'application/json', ContentEncoding = 'gzip')
+
+def store_readings(xenv, bucket, all_readings, now, partition = ''):
+    m = metrics(xenv)
+    with m.phase('consolidate'):
+        cons_readings = consolidate_readings(all_readings)
+        datemaps = split_by_date(cons_readings)
+    with m.phase('write_days'):
+        added = write_readings(xenv, bucket, datemaps, partition)
+    m.add('readings_received', len(all_readings))
+    m.add('readings_added', len(added))
+    m.add('duplicates_dropped', len(all_readings) - len(added))
+    if len(added) > 0:
+        with m.phase('rollups'):
+            failed = rollups.update_rollups(xenv, bucket, added, partition, run_concurrently)
+        if failed:
+            # the readings are stored, so retrying the invocation would not count them either
+            m.add('rollup_failures', len(failed))
+            days = ' '.join(partition + dt.strftime('allreadings/day%Y%m%d.json') for dt in sorted(datemaps.keys()))
+            print('{} miss readings, run the rollups command of local.py with --file {}'.format(', '.join(failed), days))
+    return cons_readings, now
+
+def evaluate_readings(xenv, cons_readings, now):
+    # the new status and alerts for readings stored by ingest_readings(), this is
+    # repeated with the newer status if another invocation changed it in the meantime
+    if len(cons_readings) == 0:
         send_alert(xenv, "Lambda event handler was invoked, but no temperature readings were processed.")
-        return Status(0,0,now)
+        return Status(0, 0, now, rules = xenv.last_status.rules)
 
-    cons_readings = consolidate_readings(all_readings)
-    write_readings(xenv, bucket, split_by_date(cons_readings))
-        
+    latest = latest_readings(cons_readings)
+    sensors = update_sensor_status(xenv.last_status.sensors, latest)
     latest_reading = cons_readings[-1]
 
-    temperature, timestamp, received = [latest_reading[k] for k in ('temperature','timestamp', 'received')]
-    if temperature < xenv.config.minimum_temperature and received == now:
-        ts = datetime.datetime.fromtimestamp(timestamp)
-        msg = "The latest temperature reading of {} (as of {:%Y.%m.%d %H:%M:%S}) has fallen below the threshold of {}".format(temperature, ts, xenv.config.minimum_temperature)
-        send_alert(xenv, msg)
-        return Status(temperature, timestamp, now)
+    temperature, timestamp = [latest_reading[k] for k in ('temperature','timestamp')]
+    if xenv.last_status.last_reading_ts > timestamp:
+        # another invocation has already stored a newer reading
+        temperature, timestamp = xenv.last_status.temp_reading, xenv.last_status.last_reading_ts
+    new_readings = [r for r in cons_readings if r['received'] == now]
+    rule_states, msgs = xenv.config.rules.evaluate(xenv.last_status.rules, new_readings, xenv.config.minimum_temperature)
+    if len(msgs) > 0:
+        send_alert(xenv, "; ".join(msgs))
+        return Status(temperature, timestamp, now, sensors, rule_states)
     delay = now - timestamp
     if xenv.config.max_delay * 60 < delay:
         send_alert(xenv, "Warning, received a delayed temperature reading. Delay is {}".format(datetime.timedelta(seconds=int(delay))))
-        return Status(temperature, timestamp, now)
+        return Status(temperature, timestamp, now, sensors, rule_states)
     
-    return Status(temperature, timestamp, xenv.last_status.last_alert_ts)
+    return Status(temperature, timestamp, xenv.last_status.last_alert_ts, sensors, rule_states)
 
+def process_temperature_reading(xenv, records):
+    return evaluate_readings(xenv, *ingest_readings(xenv, records))
 
 def process_scheduled_event(xenv, event):
     if xenv.last_status.last_reading_ts == 0:
@@ -139,26 +447,146 @@ def process_scheduled_event(xenv, event):
     delay = now - xenv.last_status.last_reading_ts
     if xenv.config.max_delay * 60 < delay:
         send_alert(xenv, "Failed to receive temperature readings for {}".format(datetime.timedelta(seconds=int(delay))))
-        return Status(xenv.last_status.temp_reading, xenv.last_status.last_reading_ts, now)
+        return Status(xenv.last_status.temp_reading, xenv.last_status.last_reading_ts, now, xenv.last_status.sensors, xenv.last_status.rules)
     return xenv.last_status
     
 
-def process_events(xenv, event, context):
-    xenv.config = read_config(xenv)
+def read_status(xenv, partition = ''):
+    # A warm container uses the status it wrote last without asking S3. The new status is
+    # written with its ETag, so if another container has changed it since, the write fails
+    # and process_device() reads it again.
+    if xenv.last_status is not None and xenv.status_etag is not None:
+        return xenv.last_status
     try:
-        xenv.last_status = Status.read_status(xenv.s3.get_object(Bucket = xenv.lambda_bucket, Key = LambdaStatus)['Body'])
-    except botocore.errorfactory.ClientError:
-        xenv.last_status = Status()
-    
+        obj = xenv.s3.get_object(Bucket = xenv.lambda_bucket, Key = partition + LambdaStatus)
+    except botocore.exceptions.ClientError:
+        xenv.status_etag = None
+        return Status()
+    xenv.status_etag = obj.get('ETag')
+    return Status.read_status(obj['Body'])
+
+def event_type(event):
     if 'Records' in event:
-        new_status = process_temperature_reading(xenv, event['Records'])
-    elif event.get('source', '') == 'aws.events':
-        new_status = process_scheduled_event(xenv, event)
-    else:
-        send_alert(xenv, "Lambda function received an unexpected event.")
-        print(json.dumps(event, indent=2))
-        new_status = Status(xenv.last_status.temp_reading, xenv.last_status.last_reading_ts, time.time())
-    xenv.s3.put_object(Bucket = xenv.lambda_bucket, Key = LambdaStatus, Body = new_status.create_json().encode())
+        return 'upload'
+    if event.get('source', '') == 'aws.events':
+        return 'schedule'
+    if event.get('source', '') == ReaderEventSource:
+        return 'reader'
+    return 'other'
+
+def device_config(cfg, device):
+    return cfg.devices.get(device, cfg)
+
+def device_env(xenv, device):
+    # The environment for the objects of one device, the readers without a device id use
+    # xenv itself. The container keeps the status of every device it has seen.
+    if device == '':
+        return xenv
+    dev = copy.copy(xenv)
+    dev.config = device_config(xenv.config, device)
+    dev.last_status, dev.status_etag = xenv.device_status.get(device, (None, None))
+    dev.outbox = None
+    return dev
+
+def records_by_device(records):
+    # the S3 event records by the device in the key of their object
+    batches = collections.OrderedDict()
+    for rec in records:
+        device = ''
+        if rec.get('eventSource', '') == 'aws:s3':
+            device = devices.device_of_key(urllib.parse.unquote_plus(rec['s3']['object']['key']))
+        if device is None:
+            print('Ignoring an upload with an invalid device id: ' + rec['s3']['object']['key'])
+            continue
+        batches.setdefault(device, []).append(rec)
+    return batches
+
+def process_device(xenv, kind, event, device, records = None):
+    # Stores and evaluates the readings of one device and updates its status. Returns the
+    # number of readings and the timestamp of the latest reading of the device.
+    dev = device_env(xenv, device)
+    partition = devices.partition(device)
+    m = metrics(xenv)
+    if kind == 'upload':
+        readings, received = ingest_readings(dev, records, partition)
+    elif kind == 'reader':
+        readings, received = ingest_direct(dev, event, partition)
+
+    def update_status():
+        # read, evaluate and conditionally write the status, repeated on a conflicting write
+        dev.outbox = []
+        with m.phase('status_read'):
+            dev.last_status = read_status(dev, partition)
+        if kind in ('upload', 'reader'):
+            new_status = evaluate_readings(dev, readings, received)
+        elif kind == 'schedule':
+            new_status = process_scheduled_event(dev, event)
+        else:
+            send_alert(dev, "Lambda function received an unexpected event.")
+            print(json.dumps(event, indent=2))
+            new_status = Status(dev.last_status.temp_reading, dev.last_status.last_reading_ts, time.time(), dev.last_status.sensors, dev.last_status.rules)
+        with m.phase('status_write'):
+            resp = dev.s3.put_object(Bucket = dev.lambda_bucket, Key = partition + LambdaStatus, Body = new_status.create_json().encode(),
+                                     **conditional.precondition(dev.status_etag))
+        return new_status, resp.get('ETag'), dev.outbox
+
+    def status_conflict():
+        # the cached status is outdated, the next attempt reads the current one
+        m.add('status_conflicts', 1)
+        dev.last_status = None
+
+    try:
+        new_status, etag, alerts = conditional.retry_on_conflict(update_status, partition + LambdaStatus, status_conflict)
+    finally:
+        dev.outbox = None
+    dev.last_status = new_status
+    dev.status_etag = etag
+    if device != '':
+        xenv.device_status[device] = (new_status, etag)
+    # only alerts of the evaluation that made it into the status are sent
+    for msg in alerts:
+        publish_alert(dev, msg if device == '' else 'Device {}: {}'.format(device, msg))
+    return (len(readings) if kind in ('upload', 'reader') else 0), new_status.last_reading_ts
+
+def process_events(xenv, event, context):
+    kind = event_type(event)
+    xenv.metrics = m = Metrics(xenv.metrics_enabled)
+    m.dimensions['EventType'] = kind
+    m.properties['cold_start'] = xenv.invocations == 0
+    if xenv.invocations == 0 and xenv.init_duration is not None:
+        m.add_duration('init', xenv.init_duration)
+    xenv.invocations += 1
+    start = time.perf_counter()
+    try:
+        with m.phase('config'):
+            xenv.config = read_config(xenv)
+        if kind == 'upload':
+            batches = list(records_by_device(event['Records']).items())
+        elif kind == 'reader':
+            if not devices.valid_device(event.get('device', '')):
+                raise ValueError('Invalid device id {}'.format(event['device']))
+            batches = [(event.get('device', ''), None)]
+        elif kind == 'schedule':
+            # the devices with a recent reading in the manifest need not be looked at
+            with m.phase('manifest'):
+                quiet = devices.quiet_devices(devices.read_manifest(xenv), time.time(), lambda d: device_config(xenv.config, d).max_delay * 60)
+            batches = [('', None)] + [(d, None) for d in quiet]
+        else:
+            batches = [('', None)]
+        # the devices of a batch are independent of each other
+        results = run_concurrently(lambda b: process_device(xenv, kind, event, *b), batches)
+        m.add('devices', len(batches))
+        if kind in ('upload', 'reader'):
+            with m.phase('manifest'):
+                devices.update_manifest(xenv, dict((d, ts) for (d, _), (_, ts) in zip(batches, results) if d != '' and ts > 0))
+            return dict(readings = sum(n for n, _ in results))
+        return dict()
+    except:
+        m.add('errors', 1)
+        raise
+    finally:
+        m.add_duration('total', time.perf_counter() - start)
+        m.emit()
 
 
 # differences between local and lamdba env:
@@ -166,57 +594,55 @@ def process_events(xenv, event, context):
 # * no sms (at least initially)
 
 class ExecutionEnvironment():
-    pass
+    def __init__(self):
+        # kept across invocations while the container stays warm
+        self.config = None
+        self.config_etag = None
+        self.config_checked = 0
+        self.last_status = None
+        self.status_etag = None
+        # device id -> (status, ETag) for the devices other than the one without an id
+        self.device_status = dict()
+        self.manifest = None
+        self.manifest_etag = None
+        # alerts waiting for the status update, see send_alert()
+        self.outbox = None
+        self.invocations = 0
+        # seconds init_lambda() took to create the clients, reported with the first invocation
+        self.init_duration = None
+        # set METRICS=off to stop printing the metrics line after every invocation
+        self.metrics_enabled = os.getenv('METRICS', 'on').lower() not in ('off', '0', 'false', 'no')
+
+# created on the first invocation in a container and reused by the following ones
+LambdaEnv = None
 
 def init_lambda():
-    xenv = ExecutionEnvironment()
-    xenv.s3 = boto3.client('s3')
-    xenv.lambda_bucket = os.getenv('CONFIG_BUCKET')
-    xenv.get_sns_client = lambda: boto3.client('sns')
-    return xenv
+    global LambdaEnv
+    if LambdaEnv is None:
+        start = time.perf_counter()
+        # botocore is imported here and without boto3, which would also load s3transfer
+        import botocore.session
+        session = botocore.session.get_session()
+        xenv = ExecutionEnvironment()
+        xenv.s3 = session.create_client('s3')
+        xenv.lambda_bucket = os.getenv('CONFIG_BUCKET')
+        sns = []
+        def get_sns_client():
+            if len(sns) == 0:
+                sns.append(session.create_client('sns'))
+            return sns[0]
+        xenv.get_sns_client = get_sns_client
+        xenv.init_duration = time.perf_counter() - start
+        LambdaEnv = xenv
+    return LambdaEnv
     
 
 def lambda_handler(event, context):
     try:
-        process_events(init_lambda(), event, context)
+        return process_events(init_lambda(), event, context)
     except Exception as e:
         print('Exception while processing event:')
         print(e)
-        
-def init_local(profile, bucket):
-    xenv = ExecutionEnvironment()
-    xenv.s3 = boto3.Session(profile_name = profile).client('s3')
-    class MockSns():
-        def publish(self, Phonenumber, Message):
-            print('SNS message to {}: "{}"'.format(Phonenumber, Message))
-    xenv.lambda_bucket = bucket
-    xenv.get_sns_client = lambda: MockSns()
-    return xenv
-
-def parse_commandline(cmdline):
-    # --profile <profile> file|schedule --bucket <bucket> --file filekey1 --file filekey2
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--profile', default='default', help='Which aws profile to use')
-    parser.add_argument('--bucket', default='ktsr42.s3.heating', help='Which bucket to use for putfile events')
-    parser.add_argument('event', choices=['file', 'schedule'], help = 'Type of event to feed to the handler')
-    parser.add_argument('--file', nargs='*', default = [], help = 'Filename to put into a putfile event (may be repeated)')
-    args = parser.parse_args(cmdline)
-    if args.event == 'file':
-        if args.file == []:
-            parser.error('For file events you must supply at least one --file argument')
-    return args
-
-def main():
-    args = parse_commandline(sys.argv[1:])
-    xenv = init_local(args.profile, args.bucket)
-    if args.event == 'schedule':
-        event = dict(source = 'aws.events')
-    else:
-        records = [dict(eventSource = 'aws:s3', s3 = dict(bucket=dict(name=args.bucket), object=dict(key=f))) for f in args.file]
-        event = dict(Records=records)
-    
-    process_events(xenv, event, None)
-
-if __name__ == '__main__':
-    main()
-    
+        # the reader uploads the readings to S3 instead if its invocation fails
+        if event_type(event) == 'reader':
+            raise
@@ -0,0 +1,124 @@
+import datetime
+import json
+
+import conditional
+import dayfile
+
+# Hourly and daily summaries of the readings, kept up to date as readings arrive.
+#
+# rollups/hourly/monthYYYYMM.json  {"sensors": {sensor: {"YYYYMMDDHH": stats}}}
+# rollups/daily/yearYYYY.json      {"sensors": {sensor: {"YYYYMMDD": stats}}}
+#
+# stats is [count, min, max, sum, first timestamp, last timestamp]. Stats can be
+# merged, so new readings only need to be added to what is there already.
+# Readings without a sensor id are kept under the sensor ''. The rollups of a device
+# are below its partition, see devices.partition().
+#
+# The readings are counted once, after write_readings() stored them. If a rollup cannot
+# be updated then, a retry of the invocation finds them stored already and they are
+# missing from that rollup until the rollups command of local.py rebuilds it.
+
+HourlyKey = 'rollups/hourly/month%Y%m.json'
+DailyKey = 'rollups/daily/year%Y.json'
+Resolutions = dict(hourly = (HourlyKey, '%Y%m%d%H'), daily = (DailyKey, '%Y%m%d'))
+
+def new_stats(r):
+    # a summary of the reader counts as all of its samples
+    if r.get('type') == 'summary':
+        return [r['count'], r['min'], r['max'], r['temperature'] * r['count'], r['start'], r['timestamp']]
+    t = r['temperature']
+    return [1, t, t, t, r['timestamp'], r['timestamp']]
+
+def add_reading(stats, r):
+    if stats is None:
+        return new_stats(r)
+    return merge_stats(stats, new_stats(r))
+
+def merge_stats(a, b):
+    if a is None:
+        return list(b)
+    return [a[0] + b[0], min(a[1], b[1]), max(a[2], b[2]), a[3] + b[3], min(a[4], b[4]), max(a[5], b[5])]
+
+def mean(stats):
+    return stats[3] / stats[0]
+
+def rollup_updates(readings):
+    # returns {object key: {sensor: {period: stats}}} for the given readings
+    updates = dict()
+    for r in readings:
+        ts = datetime.datetime.fromtimestamp(r['timestamp'])
+        for key_format, period_format in Resolutions.values():
+            periods = updates.setdefault(ts.strftime(key_format), dict()).setdefault(r.get('sensor', ''), dict())
+            period = ts.strftime(period_format)
+            periods[period] = add_reading(periods.get(period), r)
+    return updates
+
+def read_rollup(xenv, bucket, key):
+    return conditional.read_json_version(xenv.s3, bucket, key, dict(sensors = dict()))[0]
+
+def write_rollup(xenv, bucket, key, rollup, **condition):
+    xenv.s3.put_object(Bucket = bucket, Key = key, Body = json.dumps(rollup, separators = (',', ':')).encode(), ContentType = 'application/json', **condition)
+
+def update_rollup(xenv, bucket, key, sensors):
+    rollup, etag = conditional.read_json_version(xenv.s3, bucket, key, dict(sensors = dict()))
+    for sensor, periods in sensors.items():
+        stored = rollup['sensors'].setdefault(sensor, dict())
+        for period, stats in periods.items():
+            stored[period] = merge_stats(stored.get(period), stats)
+    write_rollup(xenv, bucket, key, rollup, **conditional.precondition(etag))
+
+def update_rollups(xenv, bucket, readings, partition = '', run = map):
+    # Readings must not have been counted before, i.e. only what write_readings() added.
+    # run is map() or a concurrent equivalent like process_temp_readings.run_concurrently().
+    # Returns the keys of the rollups that could not be updated.
+    def update(item):
+        key, sensors = partition + item[0], item[1]
+        try:
+            conditional.retry_on_conflict(lambda: update_rollup(xenv, bucket, key, sensors), key)
+        except Exception as e:
+            print('Could not update {}: {}'.format(key, e))
+            return key
+        return None
+    return [key for key in run(update, sorted(rollup_updates(readings).items())) if key is not None]
+
+def rebuild_rollups(xenv, bucket, day_keys, partition = ''):
+    # recompute the rollups of the given day files from their raw readings
+    days = []
+    readings = []
+    for key in day_keys:
+        days.append(dayfile.day_of_key(key))
+        readings.extend(dayfile.load(xenv.s3.get_object(Bucket = bucket, Key = key)['Body']))
+    updates = rollup_updates(readings)
+    for key_format, _ in Resolutions.values():
+        for day in days:
+            updates.setdefault(datetime.datetime.strptime(day, '%Y%m%d').strftime(key_format), dict())
+    def replace(key, sensors):
+        rollup, etag = conditional.read_json_version(xenv.s3, bucket, key, dict(sensors = dict()))
+        for stored in rollup['sensors'].values():
+            for period in [p for p in stored.keys() if p[:8] in days]:
+                del stored[period]
+        for sensor, periods in sensors.items():
+            rollup['sensors'].setdefault(sensor, dict()).update(periods)
+        rollup['sensors'] = dict((s, p) for s, p in rollup['sensors'].items() if len(p) > 0)
+        write_rollup(xenv, bucket, key, rollup, **conditional.precondition(etag))
+    for key, sensors in sorted(updates.items()):
+        key = partition + key
+        conditional.retry_on_conflict(lambda: replace(key, sensors), key)
+        print('Rebuilt ' + key)
+
+def range_stats(xenv, bucket, start, end, sensor = '', resolution = 'daily', partition = ''):
+    # stats per period for start <= period <= end (datetime.date or datetime.datetime)
+    key_format, period_format = Resolutions[resolution]
+    first, last = start.strftime(period_format), end.strftime(period_format)
+    keys = []
+    dt = datetime.date(start.year, start.month, 1)
+    while dt <= (end.date() if isinstance(end, datetime.datetime) else end):
+        key = dt.strftime(key_format)
+        if key not in keys:
+            keys.append(key)
+        dt = datetime.date(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+    result = dict()
+    for key in keys:
+        periods = read_rollup(xenv, bucket, partition + key)['sensors'].get(sensor, dict())
+        result.update((p, s) for p, s in periods.items() if first <= p <= last)
+    return result
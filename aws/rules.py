@@ -0,0 +1,224 @@
+import collections
+import datetime
+import math
+
+# Alert rules for the readings, configured in receiver_config.json:
+#
+#   "rules": [
+#       {"type": "threshold", "below": 3},
+#       {"type": "drop_rate", "per_hour": 1.5, "minutes": 60},
+#       {"type": "window_mean", "below": 5, "minutes": 180},
+#       {"type": "flatline", "minutes": 240, "tolerance": 0.1},
+#       {"type": "trend", "horizon_minutes": 180, "minutes": 120, "min_rate": 0.2, "confirm": 2},
+#       {"type": "threshold", "below": 8, "sensor": "28-0316a2796bff"},
+#       {"type": "flatline", "sensor": "28-0316a2796bff", "enabled": false}
+#   ]
+#
+# A rule with a sensor id replaces the rule of the same name (default: its type) for
+# that sensor, "" is the sensor of readings without an id. Without any rules there is
+# a single threshold rule. minimum_temperature is the default of 'below' for thresholds.
+#
+# Readers that sample at a high rate upload summary records ("type": "summary") with the
+# mean as temperature and the min, max and count of the samples taken between start and
+# timestamp. Thresholds check their min, the other rules follow the mean.
+#
+# Threshold rules only check the newest reading of each sensor in a batch. The other
+# rules keep a small state per sensor that is stored in the status and updated with
+# each new reading, so no history has to be read to evaluate them. Readings that are not
+# newer than the last one such a rule has seen are skipped, which also makes evaluating
+# the same readings twice harmless.
+
+def sensor_id(r):
+    return r.get('sensor', '')
+
+def is_summary(r):
+    return r.get('type') == 'summary'
+
+def format_ts(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime('%Y.%m.%d %H:%M:%S')
+
+def of_sensor(sensor):
+    return '' if sensor == '' else ' of sensor ' + sensor
+
+def smoothing(dt, minutes):
+    # weight of a new value for an exponential moving average with a time constant of minutes
+    return 1 - math.exp(-dt / (minutes * 60))
+
+class Rule():
+    # the rule only looks at the newest reading of a batch
+    latest_only = False
+
+    def __init__(self, spec):
+        self.name = spec.get('name', spec['type'])
+        self.sensor = spec.get('sensor')
+        self.enabled = spec.get('enabled', True)
+
+    def update(self, state, r, minimum_temperature):
+        # returns the new state and an alert message or None, state is None for the first reading
+        raise NotImplementedError()
+
+class Threshold(Rule):
+    # no state, so readings that arrive late are still checked
+    latest_only = True
+
+    def __init__(self, spec):
+        Rule.__init__(self, spec)
+        self.below = spec.get('below')
+
+    def update(self, state, r, minimum_temperature):
+        below = minimum_temperature if self.below is None else self.below
+        msg = None
+        sensor = '' if sensor_id(r) == '' else ' from sensor ' + sensor_id(r)
+        if is_summary(r):
+            if r['min'] < below:
+                msg = "The lowest temperature reading of {}{} (between {} and {}) has fallen below the threshold of {}".format(r['min'], sensor, format_ts(r['start']), format_ts(r['timestamp']), below)
+        elif r['temperature'] < below:
+            msg = "The latest temperature reading of {}{} (as of {}) has fallen below the threshold of {}".format(r['temperature'], sensor, format_ts(r['timestamp']), below)
+        return None, msg
+
+class DropRate(Rule):
+    # exponentially smoothed rate of change in degrees per hour
+    def __init__(self, spec):
+        Rule.__init__(self, spec)
+        self.per_hour = float(spec['per_hour'])
+        self.minutes = float(spec.get('minutes', 60))
+
+    def update(self, state, r, minimum_temperature):
+        if state is None:
+            return dict(last_ts = r['timestamp'], temperature = r['temperature'], rate = 0.0), None
+        dt = r['timestamp'] - state['last_ts']
+        rate = (r['temperature'] - state['temperature']) * 3600 / dt
+        rate = state['rate'] + smoothing(dt, self.minutes) * (rate - state['rate'])
+        msg = None
+        if rate <= -self.per_hour:
+            msg = "The temperature{} is dropping by {:.1f} degrees per hour, it was {} at {}".format(of_sensor(sensor_id(r)), -rate, r['temperature'], format_ts(r['timestamp']))
+        return dict(last_ts = r['timestamp'], temperature = r['temperature'], rate = rate), msg
+
+class WindowMean(Rule):
+    # exponentially weighted mean with a time constant of minutes, only checked once it covers that long
+    def __init__(self, spec):
+        Rule.__init__(self, spec)
+        self.below = float(spec['below'])
+        self.minutes = float(spec.get('minutes', 180))
+
+    def update(self, state, r, minimum_temperature):
+        if state is None:
+            return dict(last_ts = r['timestamp'], mean = r['temperature'], span = 0), None
+        dt = r['timestamp'] - state['last_ts']
+        mean = state['mean'] + smoothing(dt, self.minutes) * (r['temperature'] - state['mean'])
+        span = min(self.minutes * 60, state['span'] + dt)
+        msg = None
+        if span >= self.minutes * 60 and mean < self.below:
+            msg = "The mean temperature{} over the last {:g} minutes is {:.1f}, below {}".format(of_sensor(sensor_id(r)), self.minutes, mean, self.below)
+        return dict(last_ts = r['timestamp'], mean = mean, span = span), msg
+
+class Flatline(Rule):
+    # a sensor that reports the same value for a long time is probably stuck
+    def __init__(self, spec):
+        Rule.__init__(self, spec)
+        self.minutes = float(spec.get('minutes', 240))
+        self.tolerance = float(spec.get('tolerance', 0.1))
+
+    def update(self, state, r, minimum_temperature):
+        if state is None or abs(r['temperature'] - state['temperature']) > self.tolerance:
+            return dict(last_ts = r['timestamp'], temperature = r['temperature'], since = r['timestamp']), None
+        msg = None
+        if r['timestamp'] - state['since'] >= self.minutes * 60:
+            msg = "The sensor{} has reported {} since {}, it may be stuck".format(of_sensor(sensor_id(r)), state['temperature'], format_ts(state['since']))
+        return dict(state, last_ts = r['timestamp']), msg
+
+class Trend(Rule):
+    # Weighted least squares line through the readings, older ones weighted down with a time
+    # constant of minutes. Only the weighted sums are kept, with the time relative to the last
+    # reading. Alerts when the line crosses below (default minimum_temperature) within
+    # horizon_minutes. Against noise the trend has to cover minutes, fall by at least min_rate
+    # degrees per hour and predict the crossing for confirm readings in a row.
+    Sums = ('w', 'wt', 'wtt', 'wy', 'wty')
+
+    def __init__(self, spec):
+        Rule.__init__(self, spec)
+        self.below = spec.get('below')
+        self.horizon = float(spec['horizon_minutes']) * 60
+        self.minutes = float(spec.get('minutes', 120))
+        self.min_rate = float(spec.get('min_rate', 0.2))
+        self.confirm = int(spec.get('confirm', 2))
+
+    @staticmethod
+    def fit(state):
+        # slope in degrees per second and the temperature of the line at the last reading
+        w, wt, wtt, wy, wty = [state[k] for k in Trend.Sums]
+        det = w * wtt - wt * wt
+        if det <= 1e-9 * w * w:
+            return 0.0, wy / w
+        slope = (w * wty - wt * wy) / det
+        return slope, (wy - slope * wt) / w
+
+    def update(self, state, r, minimum_temperature):
+        y = r['temperature']
+        if state is None:
+            return dict(last_ts = r['timestamp'], w = 1.0, wt = 0.0, wtt = 0.0, wy = y, wty = 0.0, span = 0, hits = 0), None
+        dt = r['timestamp'] - state['last_ts']
+        decay = math.exp(-dt / (self.minutes * 60))
+        w, wt, wtt, wy, wty = [state[k] * decay for k in Trend.Sums]
+        # move the origin to the new reading, then add it at t = 0
+        wtt, wt, wty = wtt - 2 * dt * wt + dt * dt * w, wt - dt * w, wty - dt * wy
+        state = dict(last_ts = r['timestamp'], w = w + 1, wt = wt, wtt = wtt, wy = wy + y, wty = wty,
+                     span = min(self.minutes * 60, state['span'] + dt), hits = state['hits'] + 1)
+        below = minimum_temperature if self.below is None else self.below
+        slope, level = Trend.fit(state)
+        # already below is the threshold's business, a flat or rising line never crosses (with min_rate 0 the slope can be 0)
+        if state['span'] < self.minutes * 60 or slope >= 0 or slope * 3600 > -self.min_rate or level <= below or (below - level) / slope > self.horizon:
+            state['hits'] = 0
+            return state, None
+        msg = None
+        if state['hits'] >= self.confirm:
+            eta = (below - level) / slope
+            msg = "The temperature{} is falling by {:.1f} degrees per hour and expected to reach {} in about {} minutes".format(of_sensor(sensor_id(r)), -slope * 3600, below, int(eta // 60))
+        return state, msg
+
+RuleTypes = dict(threshold = Threshold, drop_rate = DropRate, window_mean = WindowMean, flatline = Flatline, trend = Trend)
+
+def make_rule(spec):
+    if spec.get('type') not in RuleTypes:
+        raise ValueError('Unknown alert rule type {}'.format(spec.get('type')))
+    try:
+        return RuleTypes[spec['type']](spec)
+    except KeyError as e:
+        raise ValueError('Alert rule {} needs a value for {}'.format(spec['type'], e))
+
+class RuleSet():
+    def __init__(self, specs = None):
+        self.rules = [make_rule(s) for s in specs or []] or [Threshold(dict(type = 'threshold'))]
+        self.names = set(r.name for r in self.rules)
+
+    def for_sensor(self, sensor):
+        chosen = collections.OrderedDict((r.name, r) for r in self.rules if r.sensor is None)
+        chosen.update((r.name, r) for r in self.rules if r.sensor == sensor)
+        return [r for r in chosen.values() if r.enabled]
+
+    def evaluate(self, states, readings, minimum_temperature):
+        # Returns the new rule states and the alert messages for the readings. states is
+        # {rule name: {sensor: state}} as returned by the previous call.
+        states = dict((name, dict(per_sensor)) for name, per_sensor in (states or dict()).items() if name in self.names)
+        by_sensor = collections.OrderedDict()
+        for r in sorted(readings, key = lambda r: (r['timestamp'], sensor_id(r))):
+            by_sensor.setdefault(sensor_id(r), []).append(r)
+        alerts = []
+        for sensor, sensor_readings in by_sensor.items():
+            for rule in self.for_sensor(sensor):
+                per_sensor = states.setdefault(rule.name, dict())
+                state = per_sensor.get(sensor)
+                new = [r for r in sensor_readings if state is None or r['timestamp'] > state['last_ts']]
+                if rule.latest_only:
+                    new = new[-1:]
+                alert = None
+                for r in new:
+                    state, msg = rule.update(state, r, minimum_temperature)
+                    if msg is not None:
+                        alert = (r['timestamp'], sensor, msg)
+                if state is not None:
+                    per_sensor[sensor] = state
+                if alert is not None:
+                    alerts.append(alert)
+        states = dict((name, per_sensor) for name, per_sensor in states.items() if per_sensor)
+        return states, [msg for _, _, msg in sorted(alerts)]
@@ -1,113 +1,491 @@
 import argparse
+import concurrent.futures
 import configparser
 import datetime
+import gzip
 import json
 import logging
 import logging.handlers
 import os
 import pathlib
+import random
+import signal
 import sys
+import threading
 import time
 import traceback
 
 import botocore.config as awsconfig
 import boto3
 
+import ringbuffer
+
 
 AwsParameters = ('region', 'key_file', 'bucket', 'path', 'prefix')
 
+# event source of direct invocations, the Lambda function recognizes its events by it
+ReaderEventSource = 'heating.reader'
+
+W1DevicesDir = '/sys/bus/w1/devices'
+
+# record type of the summaries of the samples taken between two uploads, see Sampler
+SummaryType = 'summary'
+
+class CrcError(Exception):
+    pass
+
 def read_current_temperature(srcfile):
     with open(srcfile) as tf:
         data = tf.read()
-    temperature_reading_line = data.split('\n')[1]
+    lines = data.split('\n')
+    # first line: '<raw bytes> : crc=<crc> YES|NO', second line: '<raw bytes> t=<milli degrees>'
+    if not lines[0].strip().endswith('YES'):
+        raise CrcError('CRC check failed for ' + srcfile)
+    temperature_reading_line = lines[1]
     (_, tag, temperature_reading) = temperature_reading_line.partition('t=')
     if tag != 't=':
         raise Exception('Could not parse temperature sensor file')
     return (int(time.time()), int(temperature_reading) / 1000)
 
-def get_last_reading_number(targetdir, prefix):
-    try:
-        old_readings = sorted((f for f in pathlib.Path(targetdir).iterdir() if f.name[:len(prefix)] == prefix), key=lambda f:f.stat().st_mtime, reverse=True)        
-        return int(old_readings[0].name[len(prefix):])
-    except IndexError:
-        return -1
+def read_sensor(srcfile, retries):
+    for attempt in range(retries + 1):
+        try:
+            return read_current_temperature(srcfile)
+        except CrcError:
+            if attempt == retries:
+                raise
+            logging.warning("CRC error reading {}, retrying".format(srcfile))
+
+def find_sensors(params):
+    # returns (sensor id, w1_slave file) pairs, the id is None for the single untagged Sensorfile
+    if params.sensors is None:
+        return [(None, params.sensorfile)]
+    if params.sensors == ['auto']:
+        ids = sorted(d.name for d in pathlib.Path(params.sensor_dir).glob('28-*'))
+    else:
+        ids = params.sensors
+    return [(i, os.path.join(params.sensor_dir, i, 'w1_slave')) for i in ids]
 
-def order(n0):
-    if n0 == 0:
+def read_sensors(sensors, retries):
+    # each DS18B20 conversion takes ~750ms, so all sensors are read at the same time
+    if len(sensors) == 0:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers = len(sensors)) as pool:
+        futures = [(sensor, pool.submit(read_sensor, srcfile, retries)) for sensor, srcfile in sensors]
+    readings = []
+    for sensor, future in futures:
+        try:
+            readings.append((sensor, future.result()))
+        except:
+            logging.error("Failed to read sensor {}:\n{}".format(sensor, traceback.format_exc()))
+    return readings
+
+def history_file(params, sensor):
+    if sensor is None:
+        return params.history_file
+    base, ext = os.path.splitext(params.history_file)
+    return "{}-{}{}".format(base, sensor, ext)
+
+def open_history(fname, capacity, srcdir = None, prefix = None):
+    if os.path.exists(fname):
+        history = ringbuffer.RingBuffer(fname)
+        if history.capacity != capacity:
+            logging.warning("History file {} holds {} readings, ignoring MaxReadings={}".format(fname, history.capacity, capacity))
+        return history
+    history = ringbuffer.RingBuffer.create(fname, capacity)
+    if srcdir is None:
+        return history
+    imported = ringbuffer.import_reading_files(history, srcdir, prefix)
+    if imported > 0:
+        logging.info("Imported {} readings from the {}* files in {}".format(imported, prefix, srcdir))
+    return history
+
+def write_reading(history, reading):
+    history.append(reading[0], int(round(reading[1] * 1000)))
+
+def read_history(history, after = 0, sensor = None):
+    readings = [dict(timestamp = ts, temperature = millidegrees / 1000) for ts, millidegrees in history.since(after)]
+    if sensor is not None:
+        for r in readings:
+            r['sensor'] = sensor
+    return readings
+
+def read_watermark(fname):
+    # timestamp of the newest reading that has been uploaded successfully
+    try:
+        with open(fname) as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
         return 0
-    o = -1
-    n = n0
-    while n > 0:
-        o += 1
-        n = n // 10
-    return o
-
-def write_reading(targetdir, prefix, maxreadings, reading):
-    num = (get_last_reading_number(targetdir, prefix) + 1) % maxreadings
-    fname = "{0}/{1}{3:0{2}}".format(targetdir, prefix, 1 + order(maxreadings), num)
-    with open(fname, "w") as f:
-        print("{0} {1}".format(*reading), file=f)
-    
-def create_aws_message(srcdir, prefix):
-    sdir = pathlib.Path(srcdir)
-    allreadings_t = [e.read_text().strip().split() for e in sdir.iterdir() if e.is_file() and e.name[:len(prefix)] == prefix]
-    kf = lambda x: x['timestamp']
-    return json.dumps(sorted((dict(timestamp=int(ts), temperature=float(r)) for ts, r in allreadings_t), key = kf), indent=2)
-
-def aws_upload(params, data, suffix=".json"):
-    fname = "{}/{}{:%Y%m%dT%H%m%S}{}".format(params.path, params.prefix, datetime.datetime.utcnow(), suffix)
+
+def write_watermark(fname, timestamp):
+    tmpname = fname + '.tmp'
+    with open(tmpname, 'w') as f:
+        print(timestamp, file=f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpname, fname)
+
+def reading_key(r):
+    return (r['timestamp'], r.get('sensor', ''))
+
+def coalesce(*batches):
+    # one sorted batch without the readings that are in more than one of them
+    unique = dict((reading_key(r), r) for batch in batches for r in batch)
+    return [unique[k] for k in sorted(unique.keys())]
+
+def read_spool(fname):
+    # readings that could not be uploaded yet, one JSON object per line
+    try:
+        with open(fname) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def write_spool(fname, readings, limit):
+    if len(readings) > limit:
+        logging.warning("Upload spool is full, dropping the {} oldest readings".format(len(readings) - limit))
+        readings = readings[len(readings) - limit:]
+    if len(readings) == 0:
+        if os.path.exists(fname):
+            os.remove(fname)
+        return
+    tmpname = fname + '.tmp'
+    with open(tmpname, 'w') as f:
+        for r in readings:
+            print(json.dumps(r), file=f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpname, fname)
+
+def tag_sensor(r, sensor):
+    if sensor is not None:
+        r['sensor'] = sensor
+    return r
+
+class Sampler():
+    # Keeps the count, min, max and sum of the samples of each sensor between two uploads,
+    # they are uploaded as one summary record per sensor. Samples below the threshold are
+    # kept as they are, the first one after a sample above asks for an upload right away.
+    def __init__(self, threshold = None):
+        self.threshold = threshold
+        self.stats = dict()
+        self.samples = []
+        self.below = set()
+
+    def add(self, sensor, reading):
+        # returns True if the samples should be uploaded now
+        ts, temperature = reading
+        if self.threshold is not None and temperature < self.threshold:
+            self.samples.append(tag_sensor(dict(timestamp = ts, temperature = temperature), sensor))
+            urgent = sensor not in self.below
+            self.below.add(sensor)
+            return urgent
+        self.below.discard(sensor)
+        s = self.stats.get(sensor)
+        if s is None:
+            self.stats[sensor] = [1, temperature, temperature, temperature, ts, ts]
+        else:
+            self.stats[sensor] = [s[0] + 1, min(s[1], temperature), max(s[2], temperature), s[3] + temperature, s[4], ts]
+        return False
+
+    def flush(self):
+        # the summaries and the kept samples, sorted, every sample is in exactly one of them
+        records = self.samples
+        for sensor, (count, low, high, total, start, end) in self.stats.items():
+            summary = dict(type = SummaryType, timestamp = end, temperature = round(total / count, 3),
+                           min = low, max = high, count = count, start = start)
+            records.append(tag_sensor(summary, sensor))
+        self.stats, self.samples = dict(), []
+        return sorted(records, key = reading_key)
+
+def retry_delay(params, attempt):
+    # exponential backoff with jitter, so readers that lost the network together do not retry together
+    return min(params.retry_delay_max, params.retry_delay * 2 ** attempt) * random.uniform(0.5, 1)
+
+def deliver(s3, lambda_client, params, pending):
+    # directly to the Lambda function if configured, S3 for large batches and if that fails
+    if lambda_client is not None and len(pending) <= params.direct_max_readings:
+        try:
+            invoke_lambda(lambda_client, params.aws_params, pending)
+            return
+        except:
+            logging.warning("Invoking {} failed, uploading to S3 instead: {}".format(params.aws_params.function, sys.exc_info()[1]))
+    aws_upload(s3, params.aws_params, create_aws_message(pending), compress = params.compress_uploads)
+
+def upload_pending(s3, params, pending, sleep = time.sleep, lambda_client = None):
+    # Returns True once the readings are delivered. sleep(seconds) waits between the
+    # attempts, it can return True to give up early.
+    for attempt in range(params.upload_retries + 1):
+        try:
+            deliver(s3, lambda_client, params, pending)
+            return True
+        except:
+            if attempt == params.upload_retries:
+                logging.error("Upload failed {} times, giving up for now:\n{}".format(attempt + 1, traceback.format_exc()))
+                return False
+            delay = retry_delay(params, attempt)
+            logging.warning("Upload failed, retrying in {:.1f} seconds: {}".format(delay, sys.exc_info()[1]))
+            if sleep(delay):
+                logging.info("Retries interrupted")
+                return False
+
+def create_aws_message(readings):
+    return json.dumps(readings, separators=(',', ':'))
+
+def create_s3_client(params):
+    config = awsconfig.Config(region_name=params.region)
+    return boto3.client('s3', aws_access_key_id = params.key_id, aws_secret_access_key = params.secret_key, config=config)
+
+def create_lambda_client(params):
+    # only needed if the readings are sent to the Lambda function directly
+    if params.function is None:
+        return None
     config = awsconfig.Config(region_name=params.region)
-    s3 = boto3.resource(service_name = 's3', aws_access_key_id = params.key_id, aws_secret_access_key = params.secret_key, config=config)
-    s3obj = s3.Object(params.bucket, fname)
-    s3obj.put(Body=data.encode())
+    return boto3.client('lambda', aws_access_key_id = params.key_id, aws_secret_access_key = params.secret_key, config=config)
+
+def invoke_lambda(client, params, readings):
+    # synchronous, so the readings only count as delivered once they are stored
+    event = dict(source = ReaderEventSource, readings = readings)
+    if params.device is not None:
+        event['device'] = params.device
+    payload = json.dumps(event, separators=(',', ':'))
+    resp = client.invoke(FunctionName = params.function, InvocationType = 'RequestResponse', Payload = payload.encode())
+    if 'FunctionError' in resp:
+        raise Exception('Lambda function failed: ' + resp['Payload'].read().decode())
+
+def aws_upload(s3, params, data, suffix=".json", compress=True):
+    path = params.path if params.device is None else params.path + '/' + params.device
+    fname = "{}/{}{:%Y%m%dT%H%M%S}{}".format(path, params.prefix, datetime.datetime.utcnow(), suffix)
+    if compress:
+        # the Lambda function recognizes gzip data, whatever the key says
+        s3.put_object(Bucket = params.bucket, Key = fname, Body = gzip.compress(data.encode()), ContentType = 'application/json', ContentEncoding = 'gzip')
+    else:
+        s3.put_object(Bucket = params.bucket, Key = fname, Body = data.encode(), ContentType = 'application/json')
 
 def read_config(fname):
     config = configparser.ConfigParser()
     config.read(fname)
     args = argparse.Namespace()
     sect_input = config['Input']
-    args.sensorfile = sect_input['Sensorfile']
+    # Sensors is 'auto' (every 28-* device on the 1-Wire bus) or a comma separated list of
+    # device ids. Without it the single Sensorfile is read and its readings are not tagged.
+    args.sensorfile = sect_input.get('Sensorfile')
+    sensors = sect_input.get('Sensors', 'auto' if args.sensorfile is None else None)
+    args.sensors = None if sensors is None else [x.strip() for x in sensors.split(',') if x.strip()]
+    args.sensor_dir = sect_input.get('SensorDir', W1DevicesDir)
+    args.crc_retries = int(sect_input.get('CrcRetries', '3'))
     args.local_history = sect_input['HistoryDir']
     args.local_file_prefix = sect_input['FilePrefix']
     args.max_readings = int(sect_input['MaxReadings'])
+    args.history_file = sect_input.get('HistoryFile', os.path.join(args.local_history, 'history.dat'))
+    args.watermark_file = sect_input.get('WatermarkFile', os.path.join(args.local_history, 'watermark'))
+    args.interval = int(sect_input.get('Interval', '1800'))
+    # the daemon can take a sample every SampleInterval seconds and upload a summary of them
+    # every Interval, plus the samples below AlertThreshold, those right away
+    sample_interval = sect_input.get('SampleInterval')
+    args.sample_interval = None if sample_interval is None else int(sample_interval)
+    alert_threshold = sect_input.get('AlertThreshold')
+    args.alert_threshold = None if alert_threshold is None else float(alert_threshold)
+    # failed uploads are retried UploadRetries times, after RetryDelay, 2*RetryDelay, ... seconds
+    # (at most RetryDelayMax), then the readings wait in SpoolFile for the next run
+    args.upload_retries = int(sect_input.get('UploadRetries', '4'))
+    args.retry_delay = float(sect_input.get('RetryDelay', '10'))
+    args.retry_delay_max = float(sect_input.get('RetryDelayMax', '300'))
+    args.spool_file = sect_input.get('SpoolFile', os.path.join(args.local_history, 'spool.ndjson'))
+    args.spool_limit = int(sect_input.get('SpoolLimit', '100000'))
+    # gzip the uploads, turn off for a Lambda function that predates compressed uploads
+    args.compress_uploads = sect_input.getboolean('CompressUploads', True)
+    # batches of up to DirectMaxReadings go straight to the Lambda function if [AWS] function is set
+    args.direct_max_readings = int(sect_input.get('DirectMaxReadings', '1000'))
     args.loglevel = sect_input['LogLevel']
     args.Logfiles = sect_input['Logfiles']
     aws_params = argparse.Namespace(key_id = None, secret_key = None, **{k:config['AWS'][k] for k in AwsParameters})
+    aws_params.function = config['AWS'].get('function')
+    # readers that share a deployment need a device id, the Lambda function keeps their data apart
+    aws_params.device = config['AWS'].get('device')
     keyfile = json.load(open(aws_params.key_file))
     aws_params.key_id = keyfile['AccessKey']['AccessKeyId']
     aws_params.secret_key = keyfile['AccessKey']['SecretAccessKey']
     args.aws_params = aws_params
     return args
     
-def main():
-    # read config file
-    global logger
-    params = read_config(sys.argv[1])
+def setup_logging(params):
     logHandler = logging.handlers.TimedRotatingFileHandler(params.Logfiles, when='midnight', backupCount=7)
     logging.basicConfig(level=getattr(logging, params.loglevel.upper()),
                         style='{',
                         format="{asctime} {levelname} {message}",
                         handlers = [logHandler])
 
+def take_reading(params, s3, sleep = time.sleep, lambda_client = None, sampler = None):
+    # with a sampler its summaries and samples are uploaded instead of a new reading
+    try:
+        sensors = find_sensors(params)
+        if sampler is None:
+            # read temperature
+            logging.info("Reading the current temperature of {} sensor(s)...".format(len(sensors)))
+            readings = read_sensors(sensors, params.crc_retries)
+            for sensor, reading in readings:
+                logging.info("Current temperature{} is {}".format('' if sensor is None else ' of ' + sensor, reading))
+            records = []
+        else:
+            # the history only has room for the mean of a summary
+            records = sampler.flush()
+            readings = [(r.get('sensor'), (r['timestamp'], r['temperature'])) for r in records]
+            logging.info("Collected {} summaries and samples".format(len(records)))
+
+        # write locally and collect what has not been acknowledged by a previous upload
+        watermark = read_watermark(params.watermark_file)
+        pending = []
+        for sensor, _ in sensors:
+            if sensor is None:
+                history = open_history(params.history_file, params.max_readings, params.local_history, params.local_file_prefix)
+            else:
+                history = open_history(history_file(params, sensor), params.max_readings)
+            with history:
+                for reading in (r for s, r in readings if s == sensor):
+                    write_reading(history, reading)
+                pending.extend(read_history(history, watermark, sensor))
+        # plus whatever earlier runs could not upload, all in one object
+        spooled = read_spool(params.spool_file)
+        pending = coalesce(pending, spooled, records)
+        if len(pending) == 0:
+            logging.info("No readings newer than {}, nothing to upload.".format(watermark))
+            return
+
+        logging.info("Uploading {} readings to S3 ({} from the spool)".format(len(pending), len(spooled)))
+        if not upload_pending(s3, params, pending, sleep, lambda_client):
+            write_spool(params.spool_file, pending, params.spool_limit)
+            logging.warning("Kept {} readings in {} for the next run".format(min(len(pending), params.spool_limit), params.spool_file))
+            return
+        write_watermark(params.watermark_file, max(watermark, pending[-1]['timestamp']))
+        if len(spooled) > 0:
+            write_spool(params.spool_file, [], params.spool_limit)
+        logging.info("Data uploaded successfully.")
+    except:
+        logging.critical(traceback.format_exc())
+
+class Daemon():
+    def __init__(self, configfile, params):
+        self.configfile = configfile
+        self.params = params
+        self.s3 = create_s3_client(params.aws_params)
+        self.lambda_client = create_lambda_client(params.aws_params)
+        self.wakeup = threading.Event()
+        self.reload_requested = False
+        self.stop_requested = False
+        self.sampler = Sampler(params.alert_threshold)
+        self.next_upload = None
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+        self.wakeup.set()
+
+    def request_stop(self, signum, frame):
+        self.stop_requested = True
+        self.wakeup.set()
+
+    def sleep(self, seconds):
+        # a signal cuts the upload retries short, the readings go to the spool
+        return self.wakeup.wait(seconds)
+
+    def reload(self):
+        logging.info("Reloading the configuration from " + self.configfile)
+        try:
+            params = read_config(self.configfile)
+        except:
+            logging.error("Keeping the current configuration, failed to read the new one:\n" + traceback.format_exc())
+            return
+        if params.aws_params != self.params.aws_params:
+            self.s3 = create_s3_client(params.aws_params)
+            self.lambda_client = create_lambda_client(params.aws_params)
+        logging.getLogger().setLevel(getattr(logging, params.loglevel.upper()))
+        self.sampler.threshold = params.alert_threshold
+        self.params = params
+
+    def sample(self):
+        # returns True if a sample asks for an upload right away
+        urgent = False
+        for sensor, reading in read_sensors(find_sensors(self.params), self.params.crc_retries):
+            logging.debug("Sample{} is {}".format('' if sensor is None else ' of ' + sensor, reading))
+            urgent = self.sampler.add(sensor, reading) or urgent
+        return urgent
+
+    def step(self):
+        # returns True if the readings were uploaded, False for a loop that only took a sample
+        if self.params.sample_interval is None:
+            take_reading(self.params, self.s3, self.sleep, self.lambda_client)
+            return True
+        now = time.monotonic()
+        if self.next_upload is None:
+            self.next_upload = now + self.params.interval
+        upload = self.sample() or now >= self.next_upload
+        if upload:
+            take_reading(self.params, self.s3, self.sleep, self.lambda_client, self.sampler)
+        while self.next_upload <= now:
+            self.next_upload += self.params.interval
+        return upload
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        if self.params.sample_interval is None:
+            logging.info("Starting, taking a reading every {} seconds".format(self.params.interval))
+        else:
+            logging.info("Starting, taking a sample every {} seconds and uploading them every {} seconds".format(self.params.sample_interval, self.params.interval))
+        next_run = time.monotonic()
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            delay = next_run - time.monotonic()
+            if delay > 0:
+                # signals cut the wait short, go back and look at the flags
+                if self.wakeup.wait(delay):
+                    self.wakeup.clear()
+                    continue
+            start = time.monotonic()
+            uploaded = self.step()
+            finish = time.monotonic()
+            interval = self.params.sample_interval or self.params.interval
+            if finish - start > interval:
+                logging.warning("Loop took {:.3f} seconds, longer than the interval of {} seconds".format(finish - start, interval))
+            else:
+                # the loops that only take a sample would flood the log
+                logging.log(logging.INFO if uploaded else logging.DEBUG, "Loop took {:.3f} seconds".format(finish - start))
+            next_run += interval
+            if next_run < finish:
+                missed = int((finish - next_run) // interval) + 1
+                logging.warning("Running behind schedule, skipping {} reading(s)".format(missed))
+                next_run += missed * interval
+        if self.params.sample_interval is not None and (self.sampler.stats or self.sampler.samples):
+            # the samples of the unfinished interval go to the history and the spool
+            take_reading(self.params, self.s3, self.sleep, self.lambda_client, self.sampler)
+        logging.info("Stopping.")
+
+def parse_commandline(cmdline):
+    parser = argparse.ArgumentParser("Read the temperature sensor and upload the readings to AWS S3")
+    parser.add_argument('--daemon', action='store_true', help='Keep running and take a reading every Interval seconds')
+    parser.add_argument('config', help='Reader configuration file')
+    return parser.parse_args(cmdline)
+
+def main():
+    args = parse_commandline(sys.argv[1:])
+    # read config file
+    params = read_config(args.config)
+    setup_logging(params)
+
+    if args.daemon:
+        Daemon(args.config, params).run()
+        return
     try:
-        # read temperature
-        logging.info("Reading the current temperature...")
-        reading = read_current_temperature(params.sensorfile)
-        logging.info("Current temperature is {}".format(reading))
-
-        # write locally
-        write_reading(params.local_history, params.local_file_prefix, params.max_readings, reading)
-
-        # create aws s3 object contents
-        logging.info("Create AWS file")
-        aws_msg = create_aws_message(params.local_history, params.local_file_prefix)
-
-        # upload to s3
-        logging.info("Uploading to S3")
-        aws_upload(params.aws_params, aws_msg)
-        logging.info("Data uploaded successfully, exiting.")
+        s3 = create_s3_client(params.aws_params)
+        lambda_client = create_lambda_client(params.aws_params)
     except:
         logging.critical(traceback.format_exc())
+        return
+    take_reading(params, s3, lambda_client = lambda_client)
 
 # FIXME: throttle boto3 retries for s3 gets
 if __name__ == '__main__':
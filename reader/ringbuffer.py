@@ -0,0 +1,147 @@
+import argparse
+import datetime
+import mmap
+import os
+import pathlib
+import struct
+import sys
+
+# File layout: a fixed header followed by 'capacity' fixed-width records.
+# The header holds the total number of records ever appended, the write
+# cursor is that count modulo the capacity.
+Magic = b'HRNG'
+Version = 1
+HeaderFormat = struct.Struct('<4sHHIQ')     # magic, version, record size, capacity, count
+RecordFormat = struct.Struct('<qi')         # timestamp (s), temperature (milli degrees C)
+
+class RingBuffer():
+    def __init__(self, fname, readonly = False):
+        self.fname = fname
+        self.readonly = readonly
+        self._file = open(fname, 'rb' if readonly else 'r+b')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        except ValueError:
+            self._file.close()
+            raise Exception('{} is not a temperature history file'.format(fname))
+        magic, version, recsize, self.capacity, _ = HeaderFormat.unpack_from(self._map, 0)
+        if magic != Magic or version != Version or recsize != RecordFormat.size:
+            self.close()
+            raise Exception('{} is not a temperature history file'.format(fname))
+        if len(self._map) < HeaderFormat.size + self.capacity * RecordFormat.size:
+            self.close()
+            raise Exception('History file {} is truncated'.format(fname))
+
+    @staticmethod
+    def create(fname, capacity):
+        if capacity < 1:
+            raise Exception('A history file needs room for at least one reading')
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(HeaderFormat.pack(Magic, Version, RecordFormat.size, capacity, 0))
+            f.write(bytes(capacity * RecordFormat.size))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, fname)
+        return RingBuffer(fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    @property
+    def count(self):
+        return HeaderFormat.unpack_from(self._map, 0)[4]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _record(self, n):
+        return RecordFormat.unpack_from(self._map, HeaderFormat.size + (n % self.capacity) * RecordFormat.size)
+
+    def append(self, timestamp, millidegrees):
+        count = self.count
+        RecordFormat.pack_into(self._map, HeaderFormat.size + (count % self.capacity) * RecordFormat.size, timestamp, millidegrees)
+        # the record has to be in place before the cursor moves past it
+        self._map.flush()
+        HeaderFormat.pack_into(self._map, 0, Magic, Version, RecordFormat.size, self.capacity, count + 1)
+        self._map.flush()
+
+    def last(self, n):
+        count = self.count
+        n = min(n, count, self.capacity)
+        return [self._record(i) for i in range(count - n, count)]
+
+    def since(self, timestamp):
+        # records are stored in the order they were taken, scan back from the newest one
+        count = self.count
+        first = count
+        while first > max(0, count - self.capacity) and self._record(first - 1)[0] > timestamp:
+            first -= 1
+        return [self._record(i) for i in range(first, count)]
+
+def read_reading_files(srcdir, prefix):
+    sdir = pathlib.Path(srcdir)
+    if not sdir.is_dir():
+        return []
+    readings = []
+    for e in sdir.iterdir():
+        if e.is_file() and e.name[:len(prefix)] == prefix and e.name[len(prefix):].isdigit():
+            ts, temperature = e.read_text().strip().split()
+            readings.append((int(ts), int(round(float(temperature) * 1000))))
+    return sorted(readings)
+
+def import_reading_files(ring, srcdir, prefix):
+    # migrate the readings from the old one-file-per-reading history
+    newest = ring.last(1)
+    after = newest[0][0] if newest else None
+    readings = [r for r in read_reading_files(srcdir, prefix) if after is None or r[0] > after]
+    for ts, millidegrees in readings[-ring.capacity:]:
+        ring.append(ts, millidegrees)
+    return min(len(readings), ring.capacity)
+
+def format_record(record):
+    ts, millidegrees = record
+    return "{:%Y.%m.%d %H:%M:%S} {:>10} {:8.3f}".format(datetime.datetime.fromtimestamp(ts), ts, millidegrees / 1000)
+
+def parse_commandline(cmdline):
+    parser = argparse.ArgumentParser("Inspect or create temperature history files")
+    sub = parser.add_subparsers(dest = 'command')
+    sub.required = True
+    p = sub.add_parser('info', help = 'Show the header of a history file')
+    p.add_argument('file')
+    p = sub.add_parser('dump', help = 'Print the readings in a history file, oldest first')
+    p.add_argument('file')
+    p.add_argument('--last', type = int, default = None, help = 'Only print the newest N readings')
+    p = sub.add_parser('import', help = 'Import readings from the old per-reading history files')
+    p.add_argument('file')
+    p.add_argument('srcdir')
+    p.add_argument('--prefix', default = 'reading', help = 'Filename prefix of the old history files')
+    p.add_argument('--capacity', type = int, default = 20, help = 'Number of records if the history file has to be created')
+    return parser.parse_args(cmdline)
+
+def main():
+    args = parse_commandline(sys.argv[1:])
+    if args.command == 'import':
+        ring = RingBuffer(args.file) if os.path.exists(args.file) else RingBuffer.create(args.file, args.capacity)
+        with ring:
+            print("Imported {} readings into {}".format(import_reading_files(ring, args.srcdir, args.prefix), args.file))
+        return
+    with RingBuffer(args.file, readonly = True) as ring:
+        if args.command == 'info':
+            print("{}: capacity {}, {} readings stored, {} appended in total".format(args.file, ring.capacity, len(ring), ring.count))
+            newest = ring.last(1)
+            if newest:
+                print("Newest reading: " + format_record(newest[0]))
+        else:
+            for r in ring.last(args.last if args.last is not None else ring.capacity):
+                print(format_record(r))
+
+if __name__ == '__main__':
+    main()
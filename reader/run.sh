@@ -2,5 +2,4 @@
 
 cd "$(dirname $BASH_SOURCE[0])"
 
-pipenv run python read_temp.py read_temp_config.ini
-
+pipenv run python read_temp.py "$@" read_temp_config.ini
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Benchmark of the cold start of the Lambda function: importing process_temp_readings,
+# creating the clients in init_lambda() and the first invocation against the in-memory
+# S3 stand-in, each run in a fresh interpreter. The imports are measured with
+# python -X importtime, the heaviest ones are listed to show where the time goes.
+# --save writes the results as a baseline, --baseline compares against one and exits
+# with 1 if a phase got slower or the total exceeds --budget milliseconds.
+#
+#   PYTHONPATH=aws:test python test/benchmark_coldstart.py --baseline test/coldstart_baseline.json
+#
+# --python runs another interpreter, e.g. the python3.12 of the Lambda runtime.
+
+Phases = ('import_ms', 'init_ms', 'invoke_ms')
+
+# run in the fresh interpreter, prints the phase durations as JSON
+ColdStart = '''
+import json, time
+start = time.perf_counter()
+import process_temp_readings
+imported = time.perf_counter()
+xenv = process_temp_readings.init_lambda()
+initialized = time.perf_counter()
+import fakeaws
+# the S3 model of botocore that the fake validates the requests with is not the function's time
+fakeaws.s3_model()
+xenv.s3, xenv.sns, xenv.lambda_bucket = fakeaws.FakeS3(), fakeaws.FakeSns(), 'eimer'
+xenv.get_sns_client = lambda: xenv.sns
+xenv.metrics_enabled = False
+xenv.s3.put('eimer', process_temp_readings.ConfigFile, json.dumps(fakeaws.DefaultConfig))
+now = time.time()
+xenv.s3.put('eimer', 'observations/obs1.json', json.dumps([dict(timestamp = int(now) - 60 * i, temperature = 10) for i in range(20)]))
+event = fakeaws.upload_event('eimer', 'observations/obs1.json')
+ready = time.perf_counter()
+process_temp_readings.lambda_handler(event, None)
+done = time.perf_counter()
+print(json.dumps(dict(import_ms = (imported - start) * 1000, init_ms = (initialized - imported) * 1000, invoke_ms = (done - ready) * 1000)))
+'''
+
+def environment():
+    env = dict(os.environ)
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(here, '..', 'aws'), here] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p]
+    env['PYTHONPATH'] = os.pathsep.join(paths)
+    # the clients are created without talking to AWS, but botocore needs a region
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('CONFIG_BUCKET', 'eimer')
+    return env
+
+def parse_importtime(output):
+    # returns (module, self us, cumulative us, depth) for the lines of -X importtime
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(own), int(cumulative), depth))
+    return imports
+
+def import_profile(python, module):
+    out = subprocess.run([python, '-X', 'importtime', '-c', 'import ' + module], env = environment(),
+                         stderr = subprocess.PIPE, universal_newlines = True, check = True).stderr
+    return parse_importtime(out)
+
+def cold_start(python):
+    out = subprocess.run([python, '-c', ColdStart], env = environment(), stdout = subprocess.PIPE,
+                         universal_newlines = True, check = True).stdout
+    return json.loads(out.splitlines()[-1])
+
+def run(python, runs, top):
+    samples = [cold_start(python) for _ in range(runs)]
+    result = dict((p, statistics.median(s[p] for s in samples)) for p in Phases)
+    result['total_ms'] = sum(result[p] for p in Phases)
+    for p in Phases + ('total_ms',):
+        print('{:10} {:8.1f}ms'.format(p, result[p]))
+    # the direct imports of the module and the modules with the most time of their own
+    imports = import_profile(python, 'process_temp_readings')
+    direct = sorted((i for i in imports if i[3] == 1), key = lambda i: -i[2])
+    print('\nDirect imports of process_temp_readings, cumulative:')
+    for name, _, cumulative, _ in direct[:top]:
+        print('  {:40} {:8.1f}ms'.format(name, cumulative / 1000))
+    print('\nModules with the most import time of their own:')
+    for name, own, _, _ in sorted(imports, key = lambda i: -i[1])[:top]:
+        print('  {:40} {:8.1f}ms'.format(name, own / 1000))
+    result['modules'] = len(imports)
+    return result
+
+def compare(result, baseline, tolerance, budget):
+    regressions = []
+    for p in Phases + ('total_ms',):
+        if result[p] > baseline[p] * (1 + tolerance) + 5:
+            regressions.append('{}: {:.1f}ms, baseline {:.1f}ms'.format(p, result[p], baseline[p]))
+    if result['modules'] > baseline['modules']:
+        regressions.append('{} modules imported, baseline {}'.format(result['modules'], baseline['modules']))
+    if budget is not None and result['total_ms'] > budget:
+        regressions.append('total: {:.1f}ms, budget {:.1f}ms'.format(result['total_ms'], budget))
+    return regressions
+
+def parse_commandline(cmdline):
+    parser = argparse.ArgumentParser("Benchmark the cold start of the Lambda function")
+    parser.add_argument('--python', default = sys.executable, help = 'Interpreter to measure')
+    parser.add_argument('--runs', type = int, default = 5, help = 'Fresh interpreters to start, the median is reported')
+    parser.add_argument('--top', type = int, default = 10, help = 'Number of imports to list')
+    parser.add_argument('--budget', type = float, help = 'Milliseconds the whole cold start may take')
+    parser.add_argument('--save', help = 'Write the results to this baseline file')
+    parser.add_argument('--baseline', help = 'Compare the results with this baseline file')
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'Allowed relative increase of each phase over the baseline')
+    return parser.parse_args(cmdline)
+
+def main():
+    args = parse_commandline(sys.argv[1:])
+    result = run(args.python, args.runs, args.top)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent = 2)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance, args.budget)
+    elif args.budget is not None:
+        regressions = compare(result, result, 0, args.budget)
+    for r in regressions:
+        print('REGRESSION ' + r)
+    if regressions:
+        sys.exit(1)
+    if args.baseline:
+        print('No regressions against ' + args.baseline)
+
+if __name__ == '__main__':
+    main()
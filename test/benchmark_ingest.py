@@ -0,0 +1,138 @@
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import resource
+import statistics
+import sys
+import time
+import unittest.mock
+
+import dayfile
+import fakeaws
+import process_temp_readings
+
+# Benchmark of process_events() for S3 upload events against the in-memory S3 stand-in.
+#
+# Sweeps the number of records per event, the size of the existing day file and the
+# share of uploaded readings that are already stored, and reports wall time, peak RSS
+# and S3 requests per scenario, the median of --runs runs for the times and sizes.
+# --save writes the results as a baseline, --baseline compares against one and exits
+# with 1 if a scenario got slower or makes more requests or transfers more bytes.
+#
+#   PYTHONPATH=aws:test python test/benchmark_ingest.py --baseline test/benchmark_baseline.json
+
+BatchSizes = (1, 4, 16)
+DayFileSizes = (0, 1000, 10000)
+DuplicateRatios = (0.0, 0.5, 0.95)
+ReadingsPerUpload = 20
+
+def scenario_name(batch, dayfile_size, duplicates):
+    return 'batch={} dayfile={} duplicates={}'.format(batch, dayfile_size, duplicates)
+
+def setup(batch, dayfile_size, duplicates, latency):
+    xenv = fakeaws.make_env(latency = latency)
+    xenv.metrics_enabled = False
+    bucket = xenv.lambda_bucket
+    # all readings are on one day, 10s apart, the uploads cover the most recent ones
+    day = datetime.datetime(2018, 3, 8)
+    now = day.timestamp() + 86000
+    stored = [dict(timestamp = now - 10 * i, temperature = 15 + (i % 37) * 0.25, received = now - 10 * (i // 20)) for i in range(dayfile_size, 0, -1)]
+    if stored:
+        xenv.s3.put(bucket, day.strftime('allreadings/day%Y%m%d.json'), dayfile.dumps(stored, process_temp_readings.DayFileFormat))
+    nuploaded = batch * ReadingsPerUpload
+    nduplicates = min(int(nuploaded * duplicates), len(stored))
+    uploaded = [dict(timestamp = r['timestamp'], temperature = r['temperature']) for r in stored[len(stored) - nduplicates:]]
+    uploaded += [dict(timestamp = now + 10 * i, temperature = 15 + (i % 23) * 0.25) for i in range(nuploaded - nduplicates)]
+    keys = []
+    for i in range(batch):
+        key = 'observations/obs{:04}.json'.format(i)
+        xenv.s3.put(bucket, key, json.dumps(uploaded[i::batch]))
+        keys.append(key)
+    return xenv, fakeaws.upload_event(bucket, *keys), now
+
+def run_scenario(params, queue):
+    batch, dayfile_size, duplicates, latency = params
+    xenv, event, now = setup(batch, dayfile_size, duplicates, latency)
+    xenv.s3.reset_counters()
+    fakeaws.s3_model()
+    with unittest.mock.patch('process_temp_readings.time.time', return_value = now + 60):
+        start = time.perf_counter()
+        process_temp_readings.process_events(xenv, event, None)
+        elapsed = time.perf_counter() - start
+    queue.put(dict(name = scenario_name(batch, dayfile_size, duplicates),
+                   wall_time = elapsed,
+                   peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   s3_calls = sum(xenv.s3.calls.values()),
+                   s3_bytes_read = xenv.s3.bytes_read,
+                   s3_bytes_written = xenv.s3.bytes_written))
+
+def run(latency, runs):
+    # every run of a scenario is a fresh process so its peak RSS is its own
+    results = []
+    ctx = multiprocessing.get_context('fork')
+    for params in itertools.product(BatchSizes, DayFileSizes, DuplicateRatios):
+        measured = []
+        for _ in range(runs):
+            queue = ctx.Queue()
+            p = ctx.Process(target = run_scenario, args = (params + (latency,), queue))
+            p.start()
+            measured.append(queue.get())
+            p.join()
+        result = dict(measured[0], wall_time = statistics.median(m['wall_time'] for m in measured),
+                      peak_rss_kb = int(statistics.median(m['peak_rss_kb'] for m in measured)))
+        for k in ('s3_calls', 's3_bytes_read', 's3_bytes_written'):
+            result[k] = max(m[k] for m in measured)
+        results.append(result)
+        print('{name:45} {wall_time:8.3f}s {peak_rss_kb:8d}kB {s3_calls:4d} calls {s3_bytes_read:9d}B read {s3_bytes_written:9d}B written'.format(**result))
+        sys.stdout.flush()
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    base = dict((r['name'], r) for r in baseline['results'])
+    for r in results:
+        b = base.get(r['name'])
+        if b is None:
+            continue
+        if r['wall_time'] > b['wall_time'] * (1 + tolerance) + 0.005:
+            regressions.append('{}: wall time {:.3f}s, baseline {:.3f}s'.format(r['name'], r['wall_time'], b['wall_time']))
+        if r['s3_calls'] > b['s3_calls']:
+            regressions.append('{}: {} S3 calls, baseline {}'.format(r['name'], r['s3_calls'], b['s3_calls']))
+        for k, what in (('s3_bytes_read', 'read'), ('s3_bytes_written', 'written')):
+            if r[k] > b[k]:
+                regressions.append('{}: {}B {}, baseline {}B'.format(r['name'], r[k], what, b[k]))
+        if r['peak_rss_kb'] > b['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('{}: peak RSS {}kB, baseline {}kB'.format(r['name'], r['peak_rss_kb'], b['peak_rss_kb']))
+    return regressions
+
+def parse_commandline(cmdline):
+    parser = argparse.ArgumentParser("Benchmark the Lambda ingest path against an in-memory S3")
+    parser.add_argument('--latency', type = float, default = 0.01, help = 'Seconds added to every S3 request')
+    parser.add_argument('--runs', type = int, default = 5, help = 'Runs of every scenario, the median time and RSS are compared')
+    parser.add_argument('--save', help = 'Write the results to this baseline file')
+    parser.add_argument('--baseline', help = 'Compare the results with this baseline file')
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'Allowed relative increase of wall time and RSS over the baseline')
+    return parser.parse_args(cmdline)
+
+def main():
+    args = parse_commandline(sys.argv[1:])
+    results = run(args.latency, args.runs)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(latency = args.latency, runs = args.runs, results = results), f, indent = 2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['latency'] != args.latency:
+            print('The baseline was measured with a latency of {}s'.format(baseline['latency']))
+        regressions = compare(results, baseline, args.tolerance)
+        for r in regressions:
+            print('REGRESSION ' + r)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against ' + args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import collections
+import datetime
+import fnmatch
+import hashlib
+import io
+import json
+import threading
+import time
+
+import botocore.exceptions
+import botocore.session
+import botocore.validate
+
+import process_temp_readings
+
+# In-memory stand-ins for the S3 and SNS clients used by process_temp_readings,
+# with request latency, byte counters and failure injection. The parameters of every
+# request are validated against the S3 service model of the installed botocore, like
+# a real client does, so a parameter that botocore does not know fails here as well.
+
+S3Model = []
+
+def s3_model():
+    # loaded on first use, the benchmarks load it before they start timing
+    if len(S3Model) == 0:
+        S3Model.append(botocore.session.get_session().get_service_model('s3'))
+    return S3Model[0]
+
+def validate_request(operation, params):
+    botocore.validate.validate_parameters(params, s3_model().operation_model(operation).input_shape)
+
+def client_error(code, operation, status = 400):
+    return botocore.exceptions.ClientError(dict(Error = dict(Code = code, Message = code), ResponseMetadata = dict(HTTPStatusCode = status)), operation)
+
+class FakeObject():
+    def __init__(self, data, content_type = None, content_encoding = None, metadata = None):
+        self.data = data
+        self.etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.metadata = metadata or dict()
+
+class FakeS3():
+    def __init__(self, latency = 0):
+        # latency: seconds added to every request, or a function (operation, key) -> seconds
+        self.latency = latency
+        self.objects = dict()
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.failures = []
+
+    def fail(self, operation, key = '*', code = 'InternalError', times = 1):
+        # make the next 'times' calls of operation on keys matching the pattern fail
+        self.failures.append([operation, key, code, times])
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.bytes_read = 0
+            self.bytes_written = 0
+
+    def _request(self, operation, params):
+        validate_request(operation, dict((k, v) for k, v in params.items() if v is not None))
+        key = params.get('Key', params.get('Prefix', ''))
+        delay = self.latency(operation, key) if callable(self.latency) else self.latency
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            self.calls[operation] += 1
+            for f in self.failures:
+                if f[0] == operation and f[3] > 0 and fnmatch.fnmatchcase(key, f[1]):
+                    f[3] -= 1
+                    raise client_error(f[2], operation, 500)
+
+    def put(self, Bucket, Key, data, **kwargs):
+        # store an object without counting a request
+        with self.lock:
+            self.objects[(Bucket, Key)] = FakeObject(data if isinstance(data, bytes) else data.encode(), **kwargs)
+
+    def data(self, Bucket, Key):
+        return self.objects[(Bucket, Key)].data
+
+    def get_object(self, Bucket, Key, IfNoneMatch = None, IfMatch = None):
+        self._request('GetObject', dict(Bucket = Bucket, Key = Key, IfNoneMatch = IfNoneMatch, IfMatch = IfMatch))
+        with self.lock:
+            obj = self.objects.get((Bucket, Key))
+            if obj is None:
+                raise client_error('NoSuchKey', 'GetObject', 404)
+            if IfMatch is not None and IfMatch != obj.etag:
+                raise client_error('PreconditionFailed', 'GetObject', 412)
+            if IfNoneMatch is not None and IfNoneMatch == obj.etag:
+                raise client_error('304', 'GetObject', 304)
+            self.bytes_read += len(obj.data)
+        resp = dict(Body = io.BytesIO(obj.data), ContentLength = len(obj.data), ETag = obj.etag,
+                    LastModified = obj.last_modified, Metadata = dict(obj.metadata))
+        if obj.content_type is not None:
+            resp['ContentType'] = obj.content_type
+        if obj.content_encoding is not None:
+            resp['ContentEncoding'] = obj.content_encoding
+        return resp
+
+    def head_object(self, Bucket, Key):
+        self._request('HeadObject', dict(Bucket = Bucket, Key = Key))
+        with self.lock:
+            obj = self.objects.get((Bucket, Key))
+            if obj is None:
+                raise client_error('404', 'HeadObject', 404)
+        return dict(ContentLength = len(obj.data), ETag = obj.etag, LastModified = obj.last_modified, Metadata = dict(obj.metadata))
+
+    def put_object(self, Bucket, Key, Body, IfMatch = None, IfNoneMatch = None, ContentType = None, ContentEncoding = None, Metadata = None):
+        self._request('PutObject', dict(Bucket = Bucket, Key = Key, Body = Body, IfMatch = IfMatch, IfNoneMatch = IfNoneMatch,
+                                        ContentType = ContentType, ContentEncoding = ContentEncoding, Metadata = Metadata))
+        data = Body.read() if hasattr(Body, 'read') else Body
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            current = self.objects.get((Bucket, Key))
+            if IfMatch is not None and (current is None or current.etag != IfMatch):
+                raise client_error('PreconditionFailed', 'PutObject', 412)
+            if IfNoneMatch == '*' and current is not None:
+                raise client_error('PreconditionFailed', 'PutObject', 412)
+            obj = FakeObject(data, ContentType, ContentEncoding, Metadata)
+            self.objects[(Bucket, Key)] = obj
+            self.bytes_written += len(data)
+        return dict(ETag = obj.etag)
+
+    def list_objects_v2(self, Bucket, Prefix = '', StartAfter = '', ContinuationToken = None, MaxKeys = 1000):
+        self._request('ListObjectsV2', dict(Bucket = Bucket, Prefix = Prefix, StartAfter = StartAfter, ContinuationToken = ContinuationToken, MaxKeys = MaxKeys))
+        start = ContinuationToken or StartAfter
+        with self.lock:
+            keys = sorted(k for b, k in self.objects.keys() if b == Bucket and k.startswith(Prefix) and k > start)
+            objs = [self.objects[(Bucket, k)] for k in keys[:MaxKeys]]
+        resp = dict(KeyCount = len(objs), IsTruncated = len(keys) > MaxKeys,
+                    Contents = [dict(Key = k, Size = len(o.data), ETag = o.etag, LastModified = o.last_modified) for k, o in zip(keys, objs)])
+        if len(objs) == 0:
+            del resp['Contents']
+        if resp['IsTruncated']:
+            resp['NextContinuationToken'] = keys[MaxKeys - 1]
+        return resp
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        s3 = self
+        class Paginator():
+            def paginate(self, **kwargs):
+                while True:
+                    page = s3.list_objects_v2(**kwargs)
+                    yield page
+                    if not page['IsTruncated']:
+                        return
+                    kwargs['ContinuationToken'] = page['NextContinuationToken']
+        return Paginator()
+
+class FakeSns():
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, PhoneNumber, Message):
+        self.messages.append((PhoneNumber, Message))
+
+class FakeLogs():
+    # CloudWatch Logs with pages of page_size, streams is {name: [event]}
+    def __init__(self, streams, page_size = 2):
+        self.streams = streams
+        self.page_size = page_size
+        self.calls = []
+
+    def describe(self, name):
+        events = self.streams[name]
+        stream = dict(logStreamName = name)
+        if events:
+            stream.update(lastEventTimestamp = events[-1]['timestamp'], lastIngestionTime = events[-1]['timestamp'] + 1000)
+        return stream
+
+    def get_log_events(self, logGroupName, logStreamName, startFromHead, startTime = None, endTime = None, nextToken = None):
+        self.calls.append(('get_log_events', logStreamName, nextToken))
+        events = [e for e in self.streams[logStreamName] if (startTime is None or e['timestamp'] >= startTime) and (endTime is None or e['timestamp'] < endTime)]
+        offset = int(nextToken[2:]) if nextToken else 0
+        page = events[offset:offset + self.page_size]
+        # like CloudWatch, the last page returns the token it was given
+        token = 'f/{}'.format(offset + len(page)) if page else (nextToken or 'f/0')
+        return dict(events = page, nextForwardToken = token)
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_log_streams'
+        logs = self
+        class Paginator():
+            def paginate(self, logGroupName, orderBy, descending):
+                logs.calls.append((operation, logGroupName))
+                streams = sorted((logs.describe(n) for n in logs.streams), key = lambda s: s.get('lastEventTimestamp', 0), reverse = descending)
+                for i in range(0, len(streams), logs.page_size):
+                    yield dict(logStreams = streams[i:i + logs.page_size])
+        return Paginator()
+
+DefaultConfig = dict(minimum_temperature = 3, repeat_alert_hours = 3, phonenumber = '+15550000000', max_delay = 15)
+
+def make_env(bucket = 'eimer', latency = 0, config = None, s3 = None):
+    # pass the s3 of another environment to simulate a second container
+    xenv = process_temp_readings.ExecutionEnvironment()
+    xenv.s3 = s3 if s3 is not None else FakeS3(latency)
+    xenv.sns = FakeSns()
+    xenv.get_sns_client = lambda: xenv.sns
+    xenv.lambda_bucket = bucket
+    xenv.s3.put(bucket, process_temp_readings.ConfigFile, json.dumps(config or DefaultConfig))
+    return xenv
+
+def upload_event(bucket, *keys):
+    return dict(Records = [dict(eventSource = 'aws:s3', s3 = dict(bucket = dict(name = bucket), object = dict(key = k))) for k in keys])
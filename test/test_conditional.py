@@ -0,0 +1,35 @@
+import conditional
+import fakeaws
+
+import json
+import os
+
+import botocore
+import botocore.exceptions
+import botocore.session
+import botocore.stub
+
+def version(v):
+    return tuple(int(x) for x in v.lstrip('=').split('.')[:3])
+
+def test_precondition_parameters():
+    # a real client validates the parameters against the S3 model before it sends anything
+    s3 = botocore.session.get_session().create_client('s3', region_name = 'us-east-1', aws_access_key_id = 'x', aws_secret_access_key = 'x')
+    with botocore.stub.Stubber(s3) as stub:
+        for etag in ('"d41d8cd98f00b204e9800998ecf8427e"', None):
+            args = dict(Bucket = 'eimer', Key = 'lambda_internal/receiver_status.json', Body = b'{}', ContentType = 'application/json', **conditional.precondition(etag))
+            stub.add_response('put_object', dict(ETag = '"1"'), args)
+            assert s3.put_object(**args)['ETag'] == '"1"'
+    # the in-memory stand-in used by the other tests validates the same way
+    try:
+        fakeaws.validate_request('PutObject', dict(Bucket = 'eimer', Key = 'k', Body = b'', IfVersion = '1'))
+        assert False
+    except botocore.exceptions.ParamValidationError:
+        pass
+
+def test_locked_botocore():
+    # the Lambda function and the local commands need a botocore that can write conditionally
+    assert version(botocore.__version__) >= conditional.MinBotocore
+    with open(os.path.join(os.path.dirname(__file__), '..', 'Pipfile.lock')) as f:
+        locked = json.load(f)['default']['botocore']['version']
+    assert version(locked) >= conditional.MinBotocore
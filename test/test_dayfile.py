@@ -0,0 +1,144 @@
+import dayfile
+
+from datetime import *
+import gzip
+import io
+import json
+import tempfile
+import tracemalloc
+
+def sample_readings():
+    base = datetime(2018,3,8,22,33,44).timestamp()
+    received = base + 3600.25
+    rdgs = [dict(timestamp=int(base) + 600 * i, temperature=round(20 - 0.25 * i, 2), received=received) for i in range(50)]
+    rdgs[10]['received'] = received + 1800
+    for r in rdgs[20:30]:
+        r['sensor'] = '28-0316a2796bff'
+    rdgs[25]['sensor'] = '28-b'
+    rdgs[40]['type'] = 'summary'
+    rdgs[40]['count'] = 3
+    del rdgs[45]['received']
+    return rdgs
+
+def test_roundtrip():
+    rdgs = sample_readings()
+    data = dayfile.dumps(rdgs)
+    assert dayfile.detect_format(data) == 'compact'
+    assert dayfile.loads(data) == rdgs
+    assert len(data) * 10 < len(json.dumps(rdgs))
+    # the timestamps of readings from the PI are whole seconds and stay int
+    assert all(isinstance(r['timestamp'], int) for r in dayfile.loads(data))
+
+def test_precision():
+    rdgs = [dict(timestamp=1520548424.123456, temperature=22.0625, received=1520548500.5),
+            dict(timestamp=1520548400.5, temperature=-3.125, received=1520548500.5)]
+    decoded = dayfile.loads(dayfile.dumps(rdgs))
+    assert decoded[0]['timestamp'] == 1520548424.123
+    assert decoded[1]['timestamp'] == 1520548400.5
+    assert abs(decoded[0]['temperature'] - 22.0625) < 0.01
+    assert decoded[1]['temperature'] == -3.12 or decoded[1]['temperature'] == -3.13
+    assert decoded[0]['received'] == 1520548500.5
+
+def test_json_format():
+    rdgs = sample_readings()
+    for data in (json.dumps(rdgs), json.dumps(rdgs).encode(), dayfile.dumps(rdgs, 'json')):
+        assert dayfile.detect_format(data) == 'json'
+        assert dayfile.loads(data) == rdgs
+    assert dayfile.loads(b'') == []
+    assert dayfile.loads(dayfile.dumps([])) == []
+
+def test_version_check():
+    data = bytearray(gzip.decompress(dayfile.dumps(sample_readings())))
+    data[4] = dayfile.Version + 1
+    try:
+        dayfile.loads(gzip.compress(bytes(data)))
+        assert False
+    except ValueError:
+        pass
+
+def test_streaming_json():
+    rdgs = sample_readings()
+    data = json.dumps(rdgs, indent = 1).encode()
+    # every chunk boundary, including ones inside numbers and strings
+    for chunk_size in (1, 2, 3, 7, 64):
+        assert list(dayfile.iter_json(io.BytesIO(data), chunk_size = chunk_size)) == rdgs
+    assert list(dayfile.iter_load(io.StringIO(json.dumps(rdgs)))) == rdgs
+    assert list(dayfile.iter_load(io.BytesIO(b' [ ] '))) == []
+    assert list(dayfile.iter_load(io.BytesIO(b''))) == []
+    assert list(dayfile.iter_json(io.BytesIO('[{"sensor": "\u00e4ä"}, 12345]'.encode()), chunk_size = 1)) == [dict(sensor='ää'), 12345]
+    for broken in (b'[{"timestamp": 1}', b'[1 2]', b'[1,'):
+        try:
+            list(dayfile.iter_json(io.BytesIO(broken), chunk_size = 2))
+            assert False
+        except ValueError:
+            pass
+
+def test_prefixed():
+    f = dayfile.Prefixed(b'ab', io.BytesIO(b'cdef'))
+    assert f.read(1) == b'a'
+    assert f.read(3) == b'bcd'
+    assert f.read() == b'ef'
+    assert f.read(5) == b''
+
+def test_streaming_dump():
+    rdgs = sample_readings()
+    for fmt in dayfile.Formats:
+        buf = io.BytesIO()
+        dayfile.dump(iter(rdgs), buf, fmt)
+        assert buf.getvalue() == dayfile.dumps(rdgs, fmt)
+        assert list(dayfile.iter_load(io.BytesIO(buf.getvalue()))) == rdgs
+    assert dayfile.dumps(rdgs, 'json') == json.dumps(rdgs).encode()
+
+def stream_peak(n):
+    # peak memory of copying a JSON day file of n readings from one stream to another
+    base = datetime(2018,3,8).timestamp()
+    data = dayfile.dumps((dict(timestamp=base + i, temperature=(i % 400) / 10, received=base + i // 20 * 20) for i in range(n)), 'json')
+    with tempfile.TemporaryFile() as out:
+        tracemalloc.start()
+        try:
+            dayfile.dump(dayfile.iter_load(io.BytesIO(data)), out, 'json')
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert out.tell() == len(data)
+    return peak, len(data)
+
+def test_streaming_memory():
+    small, _ = stream_peak(2000)
+    large, size = stream_peak(20000)
+    # bounded by the chunk size, not by the size of the file
+    assert large < 2 * small
+    assert large < size / 3
+
+def test_streaming_compact():
+    rdgs = sample_readings()
+    data = dayfile.dumps(rdgs, 'compact')
+    for chunk_size in (1, 3, 64):
+        assert list(dayfile.iter_compact(io.BytesIO(data), chunk_size)) == rdgs
+    truncated = gzip.compress(gzip.decompress(data)[:-5])
+    try:
+        list(dayfile.iter_load(io.BytesIO(truncated)))
+        assert False
+    except ValueError:
+        pass
+
+def compact_peak(n):
+    # peak memory of reading a compact day file of n readings, the received time and the
+    # sensor change with every reading, so every reading is a run of its own
+    base = datetime(2018,3,8).timestamp()
+    data = dayfile.dumps((dict(timestamp=base + i, temperature=(i % 400) / 10, received=base + i, sensor='28-{}'.format(i % 3)) for i in range(n)), 'compact')
+    tracemalloc.start()
+    try:
+        count = sum(1 for _ in dayfile.iter_load(io.BytesIO(data)))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert count == n
+    return peak
+
+def test_streaming_memory_compact():
+    small = compact_peak(2000)
+    large = compact_peak(20000)
+    # the decoded columns take at most 42 bytes per reading (plus what the arrays
+    # allocate ahead), a list of the reading dicts would take several hundred
+    assert (large - small) / 18000 < 50
@@ -0,0 +1,62 @@
+import dump_log
+import fakeaws
+import process_temp_readings
+
+import contextlib
+import io
+import json
+import sys
+
+from unittest.mock import *
+
+def metrics_line(kind, cold, **values):
+    # the line the Lambda function prints after an invocation
+    m = process_temp_readings.Metrics()
+    m.dimensions['EventType'] = kind
+    m.properties['cold_start'] = cold
+    for name, value in values.items():
+        m.add(name, value, 'Milliseconds')
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        m.emit()
+    return out.getvalue()
+
+def test_percentile():
+    values = list(range(10, 0, -1))
+    assert [dump_log.percentile(values, p) for p in (0, 10, 50, 90, 99, 100)] == [1, 1, 5, 9, 10, 10]
+    assert dump_log.percentile(range(1, 101), 99) == 99
+    assert dump_log.percentile([7], 50) == 7
+    assert dump_log.percentile([1, 2], 50) == 1
+
+def test_metrics_lines():
+    events = [dict(timestamp = 1, message = 'START RequestId: 1\n'),
+              dict(timestamp = 2, message = metrics_line('s3', True, total_ms = 5)),
+              dict(timestamp = 3, message = '{"_aws": truncated\n'),
+              dict(timestamp = 4, message = '{"not": "metrics"}\n')]
+    lines = list(dump_log.metrics_lines(events))
+    assert len(lines) == 1
+    assert (lines[0]['EventType'], lines[0]['cold_start'], lines[0]['total_ms']) == ('s3', True, 5)
+
+def test_summarize_metrics(capsys):
+    lines = [json.loads(metrics_line('s3', False, total_ms = i, merge_ms = 10 * i)) for i in range(1, 11)]
+    lines.append(json.loads(metrics_line('s3', True, total_ms = 300)))
+    dump_log.summarize_metrics(lines)
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == 's3 cold (1 invocations)'
+    assert out[2].split() == ['total_ms', '300.0', '300.0', '300.0', '300.0']
+    assert out[3] == 's3 warm (10 invocations)'
+    assert out[5].split() == ['merge_ms', '50.0', '90.0', '100.0', '100.0']
+    assert out[6].split() == ['total_ms', '5.0', '9.0', '10.0', '10.0']
+
+def test_main_metrics(capsys):
+    logs = fakeaws.FakeLogs(dict(
+        a = [dict(timestamp = 1000 + i, message = metrics_line('scheduled', False, total_ms = i)) for i in range(1, 5)],
+        b = [dict(timestamp = 900, message = 'START RequestId: 1\n'), dict(timestamp = 901, message = metrics_line('scheduled', False, total_ms = 20))]))
+    with patch.object(dump_log.boto3, 'Session') as session, \
+         patch.object(sys, 'argv', ['dump_log.py', '--metrics', '--streams', '2', 'heating']):
+        session.return_value.client.return_value = logs
+        dump_log.main()
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == 'scheduled warm (5 invocations)'
+    assert out[2].split() == ['total_ms', '3.0', '20.0', '20.0', '20.0']
+    assert ('describe_log_streams', '/aws/lambda/heating') in logs.calls
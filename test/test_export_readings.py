@@ -0,0 +1,112 @@
+import dayfile
+import export_readings
+import fakeaws
+
+from datetime import *
+import io
+import json
+import time
+
+from unittest.mock import *
+
+def day_readings(day, *temperatures, sensor = None):
+    ts = datetime(day.year, day.month, day.day, tzinfo = timezone.utc).timestamp()
+    rdgs = [dict(timestamp = ts + 600 * i, temperature = t) for i, t in enumerate(temperatures)]
+    for r in rdgs:
+        if sensor is not None:
+            r['sensor'] = sensor
+    return rdgs
+
+def store(s3, day, readings, fmt = 'json'):
+    out = io.BytesIO()
+    dayfile.dump(readings, out, fmt)
+    s3.put('eimer', day.strftime('allreadings/day%Y%m%d.json'), out.getvalue())
+
+def export(s3, tmpdir, first, last, **kwargs):
+    stats = dict()
+    cache = export_readings.DayCache(str(tmpdir), 'eimer')
+    with patch.object(s3, 'get_object', wraps = s3.get_object) as get_object:
+        readings = list(export_readings.export_days(s3, cache, 'eimer', first, last, stats = stats, **kwargs))
+    cache.save()
+    return readings, stats, [c[1] for c in get_object.call_args_list]
+
+def test_finished():
+    now = datetime(2018, 3, 10, 12, tzinfo = timezone.utc).timestamp()
+    assert export_readings.finished(date(2018, 3, 7), now)
+    assert not export_readings.finished(date(2018, 3, 8), now)
+    assert not export_readings.finished(date(2018, 3, 10), now)
+
+def test_export_finished_days(tmpdir):
+    s3 = fakeaws.FakeS3()
+    first = date(2018, 3, 7)
+    store(s3, first, day_readings(first, 1, 2))
+    store(s3, first + timedelta(days = 2), day_readings(first + timedelta(days = 2), 3), 'compact')
+    readings, stats, gets = export(s3, tmpdir, first, first + timedelta(days = 2))
+    assert [r['temperature'] for r in readings] == [1, 2, 3]
+    assert stats == dict(cached = 0, requests = 3, downloads = 2)
+    assert len(gets) == 3
+    # finished days, also the one without a file, come from the cache without asking S3
+    readings, stats, gets = export(s3, tmpdir, first, first + timedelta(days = 2))
+    assert [r['temperature'] for r in readings] == [1, 2, 3]
+    assert stats == dict(cached = 2, requests = 0, downloads = 0)
+    assert gets == []
+    # unless they are revalidated
+    readings, stats, gets = export(s3, tmpdir, first, first + timedelta(days = 2), revalidate = True)
+    assert stats == dict(cached = 2, requests = 3, downloads = 0)
+    assert [g.get('IfNoneMatch') for g in gets] == [s3.objects[('eimer', 'allreadings/day20180307.json')].etag, None,
+                                                   s3.objects[('eimer', 'allreadings/day20180309.json')].etag]
+
+def test_export_unfinished_days(tmpdir):
+    s3 = fakeaws.FakeS3()
+    today = datetime.utcfromtimestamp(time.time()).date()
+    key = today.strftime('allreadings/day%Y%m%d.json')
+    store(s3, today, day_readings(today, 1, 2))
+    readings, stats, gets = export(s3, tmpdir, today, today)
+    assert [r['temperature'] for r in readings] == [1, 2]
+    etag = s3.objects[('eimer', key)].etag
+    # a day that can still change is checked with the cached ETag, the 304 is served from the cache
+    readings, stats, gets = export(s3, tmpdir, today, today)
+    assert gets == [dict(Bucket = 'eimer', Key = key, IfNoneMatch = etag)]
+    assert stats == dict(cached = 1, requests = 1, downloads = 0)
+    assert [r['temperature'] for r in readings] == [1, 2]
+    assert s3.bytes_read == len(s3.data('eimer', key))
+    # a changed day file is downloaded again
+    store(s3, today, day_readings(today, 1, 2, 3))
+    readings, stats, gets = export(s3, tmpdir, today, today)
+    assert gets == [dict(Bucket = 'eimer', Key = key, IfNoneMatch = etag)]
+    assert stats == dict(cached = 0, requests = 1, downloads = 1)
+    assert [r['temperature'] for r in readings] == [1, 2, 3]
+
+def test_export_sensor(tmpdir):
+    s3 = fakeaws.FakeS3()
+    day = date(2018, 3, 7)
+    store(s3, day, sorted(day_readings(day, 1, 2, sensor = 'a') + day_readings(day, 5, 6, sensor = 'b'), key = lambda r: r['timestamp']))
+    readings, _, _ = export(s3, tmpdir, day, day, sensor = 'b')
+    assert [r['temperature'] for r in readings] == [5, 6]
+
+def test_day_cache(tmpdir):
+    cache = export_readings.DayCache(str(tmpdir), 'eimer')
+    assert cache.lookup('allreadings/day20180307.json') == (False, None)
+    data = json.dumps([]).encode()
+    etag = fakeaws.FakeObject(data).etag
+    cache.put('allreadings/day20180307.json', etag, data)
+    cache.put('allreadings/day20180308.json', None)
+    try:
+        cache.put('allreadings/day20180309.json', etag, b'[1]')
+        assert False
+    except ValueError:
+        pass
+    cache.save()
+    cache = export_readings.DayCache(str(tmpdir), 'eimer')
+    assert cache.lookup('allreadings/day20180307.json') == (True, etag)
+    assert cache.lookup('allreadings/day20180308.json') == (True, None)
+    assert cache.lookup('allreadings/day20180309.json') == (False, None)
+
+def test_downsample():
+    rdgs = [dict(timestamp = 3600 + 600 * i, temperature = i) for i in range(7)]
+    rdgs.insert(3, dict(timestamp = 5400, temperature = 10, sensor = 'a'))
+    rdgs.append(dict(timestamp = 7300, temperature = 2, count = 3, type = 'summary', start = 7200))
+    assert list(export_readings.downsample(rdgs, 3600)) == [
+        dict(timestamp = 3600, temperature = 2.5, count = 6),
+        dict(timestamp = 7200, temperature = 3.0, count = 4),
+        dict(timestamp = 3600, temperature = 10.0, count = 1, sensor = 'a')]
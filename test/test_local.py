@@ -0,0 +1,147 @@
+import dayfile
+import daymanifest
+import devices
+import fakeaws
+import local
+
+from datetime import *
+import gzip
+import json
+import os
+
+import botocore.exceptions
+
+def test_rebuild_archive(tmpdir):
+    base = datetime(2018,3,8,23,0)
+    xenv = fakeaws.make_env()
+    for i in range(6):
+        # every upload repeats the previous reading, like the old reader did
+        rdgs = [dict(timestamp=(base + timedelta(minutes=30 * j)).timestamp(), temperature=j) for j in (i - 1, i) if j >= 0]
+        xenv.s3.put('eimer', 'observations/obs{:02}.json'.format(i), json.dumps(rdgs))
+    # the uploads of a device below the same prefix are not part of the top level
+    xenv.s3.put('eimer', 'observations/pi-a/obs00.json', json.dumps([dict(timestamp=base.timestamp(), temperature=20)]))
+    # the archived direct invocations go into the same day files
+    archived = dict(timestamp=(base + timedelta(minutes=180)).timestamp(), temperature=6, received=(base + timedelta(minutes=181)).timestamp())
+    xenv.s3.put('eimer', 'rawreadings/2018/03/09/020100-0a0b0c0d.json', gzip.compress(json.dumps([archived]).encode()), content_encoding = 'gzip')
+    xenv.s3.put('eimer', 'devices/pi-a/rawreadings/2018/03/08/230100-0a0b0c0d.json', gzip.compress(json.dumps([dict(archived, timestamp=(base + timedelta(minutes=30)).timestamp(), temperature=21)]).encode()))
+    modified = datetime(2018,3,9,23,0,tzinfo=timezone.utc)
+    for obj in xenv.s3.objects.values():
+        obj.last_modified = modified
+    xenv.s3.fail('PutObject', 'allreadings/day20180309.json', times = 1)
+    workdir = str(tmpdir.join('work'))
+    try:
+        local.rebuild_archive(xenv, 'eimer', local.rebuild_prefixes(''), workdir, 1)
+        assert False
+    except botocore.exceptions.ClientError as e:
+        assert e.response['Error']['Code'] == 'InternalError'
+    # the uploads and the two day files
+    assert xenv.s3.calls['GetObject'] == 9
+    assert daymanifest.read_manifest(xenv, 'eimer') == dict(days = dict())
+    # resuming does not download again and only writes what is missing
+    xenv.s3.reset_counters()
+    local.rebuild_archive(xenv, 'eimer', local.rebuild_prefixes(''), workdir, 2)
+    # the missing day file and the manifest
+    assert xenv.s3.calls['GetObject'] == 2
+    assert xenv.s3.calls['PutObject'] == 2
+    rdgs = dayfile.loads(xenv.s3.data('eimer', 'allreadings/day20180308.json'))
+    assert rdgs == [dict(timestamp=base.timestamp(), temperature=0, received=modified.timestamp()),
+                    dict(timestamp=(base + timedelta(minutes=30)).timestamp(), temperature=1, received=modified.timestamp())]
+    rdgs = dayfile.loads(xenv.s3.data('eimer', 'allreadings/day20180309.json'))
+    assert rdgs[-1] == archived
+    assert [r['temperature'] for r in rdgs] == [2, 3, 4, 5, 6]
+    # the days written before the interruption are in the manifest as well
+    days = daymanifest.read_manifest(xenv, 'eimer')['days']
+    assert sorted(days.keys()) == ['20180308', '20180309']
+    assert [days[d]['count'] for d in sorted(days.keys())] == [2, 5]
+    assert days['20180309']['etag'] == xenv.s3.objects[('eimer', 'allreadings/day20180309.json')].etag
+    assert days['20180309']['bytes'] == len(xenv.s3.data('eimer', 'allreadings/day20180309.json'))
+    assert days['20180309']['last'] == archived['timestamp']
+    # a work directory belongs to its prefixes
+    try:
+        local.rebuild_archive(xenv, 'eimer', ['observations/'], workdir, 1)
+        assert False
+    except Exception as e:
+        assert 'observations/ rawreadings/' in str(e)
+    # a device is rebuilt from its own uploads and archive into its partition
+    xenv.s3.reset_counters()
+    assert local.rebuild_prefixes('pi-a') == [devices.upload_prefix('pi-a'), 'devices/pi-a/rawreadings/']
+    local.rebuild_archive(xenv, 'eimer', local.rebuild_prefixes('pi-a'), str(tmpdir.join('pi-a')), 1, device = 'pi-a')
+    assert xenv.s3.calls['GetObject'] == 4
+    assert dayfile.loads(xenv.s3.data('eimer', 'devices/pi-a/allreadings/day20180308.json')) == [dict(timestamp=base.timestamp(), temperature=20, received=modified.timestamp()),
+                                                                                                    dict(archived, timestamp=(base + timedelta(minutes=30)).timestamp(), temperature=21)]
+    assert list(daymanifest.read_manifest(xenv, 'eimer', devices.partition('pi-a'))['days'].keys()) == ['20180308']
+    assert sorted(daymanifest.read_manifest(xenv, 'eimer')['days'].keys()) == ['20180308', '20180309']
+
+def concurrent_write(s3, key, write):
+    # calls write() right after the first GET of key, like a Lambda invocation in between
+    get_object = s3.get_object
+    def get(Bucket, Key, **kwargs):
+        resp = get_object(Bucket = Bucket, Key = Key, **kwargs)
+        if Key == key and not write.done:
+            write.done = True
+            write()
+        return resp
+    write.done = False
+    s3.get_object = get
+
+def test_rebuild_concurrent_write(tmpdir):
+    base = datetime(2018,3,8,12,0)
+    xenv = fakeaws.make_env()
+    xenv.s3.put('eimer', 'observations/obs00.json', json.dumps([dict(timestamp=base.timestamp(), temperature=1)]))
+    # readings stored before the rebuild are replaced, the ones the Lambda function adds during it are kept
+    stale = dict(timestamp=(base + timedelta(minutes=10)).timestamp(), temperature=2, received=base.timestamp())
+    xenv.s3.put('eimer', 'allreadings/day20180308.json', json.dumps([stale]))
+    late = dict(timestamp=(base + timedelta(minutes=20)).timestamp(), temperature=3, received=datetime.now().timestamp() + 1)
+    concurrent_write(xenv.s3, 'allreadings/day20180308.json',
+                     lambda: xenv.s3.put('eimer', 'allreadings/day20180308.json', json.dumps([stale, late])))
+    local.rebuild_archive(xenv, 'eimer', ['observations/'], str(tmpdir), 1)
+    assert [r['temperature'] for r in dayfile.loads(xenv.s3.data('eimer', 'allreadings/day20180308.json'))] == [1, 3]
+    assert xenv.s3.calls['PutObject'] == 3
+
+def test_rebuild_checkpoint(tmpdir):
+    # a checkpoint of a rebuild of a single prefix is resumed as one of that prefix
+    workdir = str(tmpdir)
+    with open(os.path.join(workdir, 'checkpoint.json'), 'w') as f:
+        json.dump(dict(prefix = 'observations/', last_key = 'observations/obs03.json', listing_done = False, written = []), f)
+    checkpoint = local.RebuildCheckpoint(workdir, ['observations/'])
+    assert checkpoint.last_keys == {'observations/': 'observations/obs03.json'}
+    checkpoint.save()
+    assert local.RebuildCheckpoint(workdir, ['observations/']).last_keys == {'observations/': 'observations/obs03.json'}
+
+def test_compact_day_files():
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    rdgs = [dict(timestamp=ts + 60 * i, temperature=i, received=ts + i) for i in range(3)]
+    inflated = sorted(rdgs * 3, key = lambda r: r['timestamp'])
+    xenv = fakeaws.make_env()
+    xenv.s3.put('eimer', 'allreadings/day20180308.json', json.dumps(inflated))
+    xenv.s3.put('eimer', 'allreadings/day20180309.json', json.dumps(rdgs))
+    local.compact_day_files(xenv, 'eimer', ['allreadings/day20180308.json', 'allreadings/day20180309.json'], 'json')
+    assert xenv.s3.data('eimer', 'allreadings/day20180308.json') == json.dumps(rdgs).encode()
+    assert xenv.s3.objects[('eimer', 'allreadings/day20180308.json')].content_type == 'application/json'
+    # the file without duplicates is left alone
+    days = daymanifest.read_manifest(xenv, 'eimer')['days']
+    assert list(days.keys()) == ['20180308']
+    assert days['20180308']['count'] == 3
+    assert days['20180308']['etag'] == xenv.s3.objects[('eimer', 'allreadings/day20180308.json')].etag
+
+    # converting to the compact format rewrites files without duplicates as well
+    local.compact_day_files(xenv, 'eimer', ['allreadings/day20180309.json'], 'compact')
+    data = xenv.s3.data('eimer', 'allreadings/day20180309.json')
+    assert dayfile.detect_format(data) == 'compact'
+    assert dayfile.loads(data) == rdgs
+    days = daymanifest.read_manifest(xenv, 'eimer')['days']
+    assert sorted(days.keys()) == ['20180308', '20180309']
+    assert days['20180309']['format'] == daymanifest.format_version('compact')
+    assert days['20180309']['bytes'] == len(data)
+
+def test_compact_concurrent_write():
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    rdgs = [dict(timestamp=ts + 60 * i, temperature=i, received=ts + i) for i in range(3)]
+    xenv = fakeaws.make_env()
+    xenv.s3.put('eimer', 'allreadings/day20180308.json', json.dumps(rdgs * 2))
+    # the readings written between the read and the write of compact are not lost
+    concurrent_write(xenv.s3, 'allreadings/day20180308.json',
+                     lambda: xenv.s3.put('eimer', 'allreadings/day20180308.json', json.dumps(rdgs * 2 + [dict(rdgs[2], timestamp=ts + 600)])))
+    local.compact_day_files(xenv, 'eimer', ['allreadings/day20180308.json'], 'json')
+    assert [r['timestamp'] for r in dayfile.loads(xenv.s3.data('eimer', 'allreadings/day20180308.json'))] == [ts, ts + 60, ts + 120, ts + 600]
+    assert daymanifest.read_manifest(xenv, 'eimer')['days']['20180308']['count'] == 4
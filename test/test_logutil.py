@@ -0,0 +1,110 @@
+import fakeaws
+import logutil
+
+import threading
+import time
+
+def events(name, *timestamps):
+    return [dict(timestamp = ts, message = '{} {}\n'.format(name, ts)) for ts in timestamps]
+
+def test_iter_stream_events():
+    logs = fakeaws.FakeLogs(dict(a = events('a', 1, 2, 3, 4, 5)))
+    assert [e['timestamp'] for e in logutil.iter_stream_events(logs, 'g', 'a')] == [1, 2, 3, 4, 5]
+    # three pages and the empty one that returns the token it was given
+    assert [c[2] for c in logs.calls] == [None, 'f/2', 'f/4', 'f/5']
+    logs.calls = []
+    assert [e['timestamp'] for e in logutil.iter_stream_events(logs, 'g', 'a', start = 2, end = 4)] == [2, 3]
+    assert len(logs.calls) == 2
+    logs = fakeaws.FakeLogs(dict(a = []))
+    assert list(logutil.iter_stream_events(logs, 'g', 'a')) == []
+    assert [c[2] for c in logs.calls] == [None, 'f/0']
+
+def test_iter_streams():
+    logs = fakeaws.FakeLogs(dict(a = events('a', 10), b = events('b', 30), c = events('c', 20), d = events('d', 5), e = []))
+    assert [s['logStreamName'] for s in logutil.iter_streams(logs, 'g')] == ['b', 'c', 'a', 'd', 'e']
+    assert [s['logStreamName'] for s in logutil.iter_streams(logs, 'g', limit = 2)] == ['b', 'c']
+    assert [s['logStreamName'] for s in logutil.iter_streams(logs, 'g', start = 10)] == ['b', 'c', 'a']
+    assert [s['logStreamName'] for s in logutil.iter_streams(logs, 'g', limit = 2, start = 25)] == ['b']
+
+def test_stream_events_streams():
+    logs = fakeaws.FakeLogs(dict(a = events('a', 1, 2, 3, 4, 5)))
+    stream = logs.describe('a')
+    it = logutil.stream_events(logs, 'g', stream)
+    assert next(it)['timestamp'] == 1
+    # the first page is out before the rest of the stream is read
+    assert len(logs.calls) == 1
+    assert [e['timestamp'] for e in it] == [2, 3, 4, 5]
+
+def test_stream_cache(tmpdir):
+    logs = fakeaws.FakeLogs(dict(old = events('old', 1000, 2000, 3000), new = events('new', 5000)))
+    cache = logutil.StreamCache(str(tmpdir), '/aws/lambda/eimer')
+    now = 5 + logutil.ClosedAfter
+    old, new = logs.describe('old'), logs.describe('new')
+    assert cache.closed(old, now)
+    assert not cache.closed(new, now)
+    assert cache.get(old) is None
+    cache.put(old, events('old', 1000, 2000, 3000))
+    assert list(cache.get(old)) == events('old', 1000, 2000, 3000)
+
+def test_stream_events_cache(tmpdir):
+    logs = fakeaws.FakeLogs(dict(old = events('old', 1000, 2000, 3000), new = events('new', int(time.time() * 1000))))
+    cache = logutil.StreamCache(str(tmpdir), 'g')
+    old, new = logs.describe('old'), logs.describe('new')
+    reads = lambda name: len([c for c in logs.calls if c[1] == name and c[2] is None])
+    assert list(logutil.stream_events(logs, 'g', old, cache)) == events('old', 1000, 2000, 3000)
+    assert list(logutil.stream_events(logs, 'g', old, cache)) == events('old', 1000, 2000, 3000)
+    assert reads('old') == 1
+    # an open stream can still get events, it is read again every time
+    for _ in range(2):
+        assert len(list(logutil.stream_events(logs, 'g', new, cache))) == 1
+    assert cache.get(new) is None
+    assert reads('new') == 2
+    # a time range bypasses the cache
+    assert list(logutil.stream_events(logs, 'g', old, cache, start = 2000)) == events('old', 2000, 3000)
+    assert reads('old') == 2
+
+def test_bounded_map():
+    def slow(i):
+        time.sleep(0.01 * (5 - i))
+        return i * i
+    assert list(logutil.bounded_map(slow, range(5), 3)) == [(i, i * i) for i in range(5)]
+    assert list(logutil.bounded_map(slow, [], 3)) == []
+
+def test_stream_map():
+    def count(i):
+        time.sleep(0.01 * (5 - i))
+        return iter(range(i))
+    assert [(i, list(it)) for i, it in logutil.stream_map(count, range(5), 3)] == [(i, list(range(i))) for i in range(5)]
+
+def test_stream_map_streams():
+    # the first result is passed on while it is produced, the next one is read ahead
+    release = threading.Event()
+    started = []
+    def produce(i):
+        started.append(i)
+        yield i
+        assert release.wait(5)
+        yield i
+    results = logutil.stream_map(produce, range(3), 2)
+    i, it = next(results)
+    assert (i, next(it)) == (0, 0)
+    for _ in range(500):
+        if len(started) == 2:
+            break
+        time.sleep(0.01)
+    assert started == [0, 1]
+    release.set()
+    assert list(it) == [0]
+    assert [(i, list(it)) for i, it in results] == [(1, [1, 1]), (2, [2, 2])]
+
+def test_stream_map_error():
+    def fail(i):
+        yield i
+        raise ValueError(i)
+    i, it = next(logutil.stream_map(fail, range(1), 2))
+    assert next(it) == 0
+    try:
+        next(it)
+        assert False
+    except ValueError as e:
+        assert e.args == (0,)
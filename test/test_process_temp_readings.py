@@ -1,19 +1,46 @@
+import dayfile
+import daymanifest
+import devices
+import fakeaws
+import local
 import process_temp_readings
+import rules
 
 from datetime import *
 import copy
+import gzip
 import io
 import json
 import sys
+import threading
 import time
 
 import botocore.errorfactory
+import botocore.exceptions
 
 from unittest.mock import *
 
+def capture_puts(s3):
+    # the day files are uploaded from spool files, keep their contents for the asserts
+    puts = dict()
+    def put_object(Bucket, Key, Body, **kwargs):
+        puts[Key] = Body if isinstance(Body, bytes) else Body.read()
+        return dict()
+    s3.put_object.side_effect = put_object
+    return puts
+
+def without_day_manifest(get_object):
+    # for the mocks that return a day file for every key
+    def get(Bucket, Key):
+        if Key.endswith(daymanifest.ManifestKey):
+            raise botocore.exceptions.ClientError(dict(Error = dict(Code = 'NoSuchKey')), 'GetObject')
+        return get_object(Bucket, Key)
+    return get
+
 def test_read_config():
-    mock_xenv = Mock()
+    mock_xenv = process_temp_readings.ExecutionEnvironment()
     mock_xenv.s3 = Mock()
+    mock_xenv.lambda_bucket = 'eimer'
     cfg = dict(minimum_temperature = 42, repeat_alert_hours = 3, phonenumber = "lololo", max_delay = 10)
     mock_xenv.s3.get_object.return_value = dict(Body = io.StringIO(json.dumps(cfg)))
     rcfg = process_temp_readings.read_config(mock_xenv)
@@ -21,6 +48,56 @@ def test_read_config():
         assert rcfg.__getattribute__(k) == cfg[k]
     assert rcfg.max_delay == 600
 
+def test_read_config_cached():
+    xenv = process_temp_readings.ExecutionEnvironment()
+    xenv.s3 = Mock()
+    xenv.lambda_bucket = 'eimer'
+    cfg = dict(minimum_temperature = 42, repeat_alert_hours = 3, phonenumber = "lololo", max_delay = 10)
+    xenv.s3.get_object.return_value = dict(Body = io.StringIO(json.dumps(cfg)), ETag = '"v1"')
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = 1000
+        xenv.config = process_temp_readings.read_config(xenv)
+        xenv.s3.get_object.assert_called_once_with(Bucket = 'eimer', Key = process_temp_readings.ConfigFile)
+        assert xenv.config.minimum_temperature == 42
+
+        # within the TTL the cached config is used without asking S3
+        xenv.s3.get_object.reset_mock()
+        mock_time.return_value = 1000 + process_temp_readings.ConfigTtl - 1
+        assert process_temp_readings.read_config(xenv) is xenv.config
+        assert xenv.s3.get_object.call_count == 0
+
+        # after the TTL it is revalidated with its etag
+        mock_time.return_value = 1000 + process_temp_readings.ConfigTtl + 1
+        xenv.s3.get_object.side_effect = botocore.exceptions.ClientError(dict(Error = dict(Code = '304')), 'GetObject')
+        assert process_temp_readings.read_config(xenv) is xenv.config
+        xenv.s3.get_object.assert_called_once_with(Bucket = 'eimer', Key = process_temp_readings.ConfigFile, IfNoneMatch = '"v1"')
+        xenv.s3.get_object.reset_mock()
+        assert process_temp_readings.read_config(xenv) is xenv.config
+        assert xenv.s3.get_object.call_count == 0
+
+def test_read_status_cached():
+    xenv = process_temp_readings.ExecutionEnvironment()
+    xenv.s3 = Mock()
+    xenv.lambda_bucket = 'eimer'
+    xenv.s3.get_object.side_effect = botocore.exceptions.ClientError(dict(Error = dict(Code = 'NoSuchKey')), 'GetObject')
+    status = process_temp_readings.read_status(xenv)
+    assert status.last_reading_ts == 0
+    xenv.s3.get_object.assert_called_once_with(Bucket = 'eimer', Key = process_temp_readings.LambdaStatus)
+
+    # a warm container does not ask S3, the conditional write of the status finds out if it changed
+    xenv.last_status = process_temp_readings.Status(1, 2, 3)
+    xenv.status_etag = '"v2"'
+    xenv.s3.get_object.reset_mock()
+    assert process_temp_readings.read_status(xenv) is xenv.last_status
+    assert xenv.s3.get_object.call_count == 0
+
+    xenv.last_status = None
+    xenv.s3.get_object.side_effect = None
+    xenv.s3.get_object.return_value = dict(Body = io.StringIO('{"temperature_reading": 4, "last_reading_timestamp": 5}'), ETag = '"v3"')
+    status = process_temp_readings.read_status(xenv)
+    assert status.temp_reading == 4
+    assert xenv.status_etag == '"v3"'
+
 def test_Status():
     st = process_temp_readings.Status(100.01, 123456)
     assert st.temp_reading == 100.01
@@ -88,19 +165,64 @@ def test_write_readings():
             raise botocore.errorfactory.ClientError({}, 'test')
         else:
             raise Exception('Unexpected key in mock get_object(): ' + Key)
-    xenv.s3.get_object.side_effect = get_object
+    xenv.s3.get_object.side_effect = without_day_manifest(get_object)
+    puts = capture_puts(xenv.s3)
     process_temp_readings.write_readings(xenv, 'eimer', datemaps)
-    assert xenv.s3.put_object.call_count == 2
+    # both day files and the manifest
+    assert xenv.s3.put_object.call_count == 3
+    assert sorted(json.loads(puts['allreadings/manifest.json'])['days'].keys()) == ['20180308', '20180309']
+    # the day files are written concurrently, in no particular order
+    puts = dict((k, dayfile.loads(v)) for k, v in puts.items())
     print('\n1')
-    print_readings(json.loads(xenv.s3.put_object.mock_calls[0][2]['Body']))
+    print_readings(puts['allreadings/day20180308.json'])
     print('2')
-    print_readings(json.loads(xenv.s3.put_object.mock_calls[1][2]['Body']))
-    act_readings1 = json.loads(xenv.s3.put_object.mock_calls[0][2]['Body'])
+    print_readings(puts['allreadings/day20180309.json'])
+    act_readings1 = puts['allreadings/day20180308.json']
     assert act_readings1 == [rdgs1[0], exstrdgs[0], rdgs1[1], exstrdgs[1], rdgs1[2]]
-    act_readings2 = json.loads(xenv.s3.put_object.mock_calls[1][2]['Body'])
+    act_readings2 = puts['allreadings/day20180309.json']
     assert act_readings2 == rdgs2
-    
-    
+
+
+def test_write_readings_dedup():
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    stored = [dict(timestamp=ts + 60 * i, temperature=i, received=ts) for i in range(5)]
+    xenv = Mock()
+    xenv.s3.get_object.side_effect = without_day_manifest(lambda Bucket, Key: dict(Body=io.StringIO(json.dumps(stored))))
+    puts = capture_puts(xenv.s3)
+    # a batch that was uploaded before adds nothing and does not rewrite the day file
+    resent = [dict(r, received=ts + 600) for r in stored[2:]]
+    assert process_temp_readings.write_readings(xenv, 'eimer', {date(2018,3,8): resent}) == []
+    assert xenv.s3.put_object.call_count == 0
+
+    newer = dict(timestamp=ts + 300, temperature=5, received=ts + 600)
+    tagged = dict(timestamp=ts + 60, temperature=1, received=ts + 600, sensor='28-a')
+    added = process_temp_readings.write_readings(xenv, 'eimer', {date(2018,3,8): [tagged] + resent + [newer]})
+    assert added == [tagged, newer]
+    written = dayfile.loads(puts['allreadings/day20180308.json'])
+    assert written == stored[:2] + [tagged] + stored[2:] + [newer]
+
+def test_iter_merge():
+    existing = [dict(timestamp=t) for t in (1, 2, 2, 4)]
+    new = [dict(timestamp=t, new=True) for t in (0, 2, 3, 4, 5)]
+    added = []
+    merged = list(process_temp_readings.iter_merge(existing, new, added))
+    assert [r['timestamp'] for r in merged] == [0, 1, 2, 3, 4, 5]
+    assert [r.get('new', False) for r in merged] == [True, False, False, True, False, True]
+    assert [r['timestamp'] for r in added] == [0, 3, 5]
+
+def test_write_readings_unsorted_day_file():
+    # day files from before the merge are in arrival order, they are sorted on the next write
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    stored = [dict(timestamp=ts + 60 * i, temperature=i, received=ts) for i in (3, 0, 1, 4, 1)]
+    xenv = Mock()
+    xenv.s3.get_object.side_effect = without_day_manifest(lambda Bucket, Key: dict(Body=io.BytesIO(json.dumps(stored).encode())))
+    puts = capture_puts(xenv.s3)
+    new = [dict(timestamp=ts + 60 * i, temperature=i, received=ts + 600) for i in (2, 3)]
+    assert process_temp_readings.write_readings(xenv, 'eimer', {date(2018,3,8): new}) == new[:1]
+    assert [r['timestamp'] for r in dayfile.loads(puts['allreadings/day20180308.json'])] == [ts + 60 * i for i in range(5)]
+    # the day file twice and the manifest
+    assert xenv.s3.get_object.call_count == 3
+
 def test_consolidate_readings():
     received = datetime(2018,3,8,23,23,59).timestamp()
     ts11 = datetime(2018,3,8,22,33,44)
@@ -130,11 +252,10 @@ def test_process_temperature_reading():
     xenv.s3.get_object.side_effect = [dict(Body=io.StringIO(jsonrdgs), ContentLength=len(jsonrdgs)), dict(Body=io.StringIO(jsonrdgs), ContentLength=len(jsonrdgs))]
     xenv.config = Mock()
     xenv.config.minimum_temperature = 3
+    xenv.config.rules = rules.RuleSet()
     xenv.config.max_delay = 3
     xenv.config.repeat_alert_hours = 3    
-    xenv.last_status.last_alert_ts = 42
-    xenv.last_status.temp_reading = None
-    xenv.last_reading_ts = None
+    xenv.last_status = process_temp_readings.Status(None, 0, 42)
     currenttime = ts13.timestamp() + 10
     consdict = dict()
     rdgswithts = [copy.copy(d) for d in rdgs1]
@@ -144,14 +265,15 @@ def test_process_temperature_reading():
     
     with patch('process_temp_readings.send_alert') as mock_send_alert, \
          patch('process_temp_readings.time.time') as mock_time, \
-         patch('process_temp_readings.write_readings') as mock_write_readings:
+         patch('process_temp_readings.write_readings') as mock_write_readings, \
+         patch('process_temp_readings.rollups.update_rollups') as mock_update_rollups:
         mock_time.return_value = currenttime
         status = process_temp_readings.process_temperature_reading(xenv, events)
         assert mock_send_alert.call_count == 0
         assert status.temp_reading == rdgs1[2]['temperature']
         assert status.last_reading_ts == rdgs1[2]['timestamp']
         assert status.last_alert_ts == 42
-        mock_write_readings.assert_called_with(xenv, 'eimer', consdict)
+        mock_write_readings.assert_called_with(xenv, 'eimer', consdict, '')
 
         # delay alert
         mock_send_alert.reset_mock()
@@ -219,7 +341,38 @@ def test_process_temperature_reading():
         assert status.temp_reading == rdgs1[2]['temperature']
         assert status.last_reading_ts == rdgs1[2]['timestamp']
         assert status.last_alert_ts == 42
-        mock_write_readings.assert_called_with(xenv, 'eimer', consdict)
+        mock_write_readings.assert_called_with(xenv, 'eimer', consdict, '')
+
+def test_fetch_records_concurrently():
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    def get_object(Bucket, Key):
+        time.sleep(0.2)
+        if Key == 'missing':
+            raise botocore.exceptions.ClientError(dict(Error = dict(Code = 'NoSuchKey')), 'GetObject')
+        if Bucket == 'nobucket':
+            raise botocore.exceptions.ClientError(dict(Error = dict(Code = 'NoSuchBucket')), 'GetObject')
+        body = json.dumps([dict(timestamp=ts + int(Key), temperature=int(Key))])
+        return dict(Body=io.StringIO(body), ContentLength=len(body))
+    xenv = Mock()
+    xenv.s3.get_object.side_effect = get_object
+    xenv.config.minimum_temperature = 3
+    xenv.config.rules = rules.RuleSet()
+    xenv.config.max_delay = 3
+    xenv.last_status = process_temp_readings.Status(0, 0, 42)
+    keys = [('eimer', str(i)) for i in range(5, -1, -1)] + [('eimer', 'missing'), ('nobucket', '7')]
+    events = [dict(eventSource='aws:s3', s3=dict(bucket=dict(name=b), object=dict(key=k))) for b, k in keys]
+    with patch('process_temp_readings.send_alert') as mock_send_alert, \
+         patch('process_temp_readings.time.time') as mock_time, \
+         patch('process_temp_readings.write_readings') as mock_write_readings, \
+         patch('process_temp_readings.rollups.update_rollups'):
+        mock_time.return_value = ts + 10
+        start = time.monotonic()
+        status = process_temp_readings.process_temperature_reading(xenv, events)
+        assert time.monotonic() - start < 1
+        assert mock_send_alert.call_count == 0
+        assert status.last_reading_ts == ts + 5
+        written = mock_write_readings.call_args[0][2][date(2018,3,8)]
+        assert [r['temperature'] for r in written] == [0, 1, 2, 3, 4, 5]
 
 def test_process_scheduled_event():
     now = time.time()
@@ -270,58 +423,409 @@ def test_send_alert():
         
     
 def test_process_events():
-    xenv = Mock()
+    xenv = process_temp_readings.ExecutionEnvironment()
+    xenv.s3 = Mock()
     xenv.lambda_bucket = 'eimer'
     xenv.s3.get_object.return_value = t = dict(Body='config_body')
     with patch('process_temp_readings.read_config') as mock_read_config, \
          patch('process_temp_readings.Status.read_status') as mock_read_status, \
-         patch('process_temp_readings.process_temperature_reading') as mock_process_reading, \
+         patch('process_temp_readings.ingest_readings') as mock_ingest, \
+         patch('process_temp_readings.evaluate_readings') as mock_evaluate, \
          patch('process_temp_readings.process_scheduled_event') as mock_scheduled_event, \
          patch('process_temp_readings.time.time') as mock_time, \
+         patch('process_temp_readings.devices.read_manifest') as mock_read_manifest, \
          patch('process_temp_readings.send_alert') as mock_send_alert:
-        event1 = dict(Records = ['a', 'b', 'c'])
+        event1 = fakeaws.upload_event('eimer', 'observations/a', 'observations/b', 'observations/c')
+        mock_read_manifest.return_value = dict()
         mock_read_status.return_value = 42
-        mock_process_reading.return_value = process_temp_readings.Status(1,2,3)
+        mock_ingest.return_value = (['r'], 1000)
+        mock_evaluate.return_value = process_temp_readings.Status(1,2,3)
+        seen_status = []
+        mock_evaluate.side_effect = lambda x, r, now: seen_status.append(x.last_status) or DEFAULT
         mock_scheduled_event.return_value = process_temp_readings.Status(10,20,30)
         mock_time.return_value = 1000
+        xenv.s3.put_object.return_value = dict(ETag = '"s1"')
 
         process_temp_readings.process_events(xenv, event1, None)
         xenv.s3.get_object.assert_called_once_with(Bucket='eimer', Key=process_temp_readings.LambdaStatus)
-        assert xenv.last_status == 42
+        assert seen_status == [42]
+        assert xenv.last_status is mock_evaluate.return_value
+        assert xenv.status_etag == '"s1"'
         mock_read_config.assert_called_once_with(xenv)
         mock_read_status.assert_called_once_with(t['Body'])
-        mock_process_reading.assert_called_once_with(xenv, ['a', 'b', 'c'])
+        mock_ingest.assert_called_once_with(xenv, event1['Records'], '')
+        mock_evaluate.assert_called_once_with(xenv, ['r'], 1000)
         assert mock_scheduled_event.call_count == 0
         assert mock_send_alert.call_count == 0
+        # the status did not exist when it was read
         xenv.s3.put_object.assert_called_once_with(Bucket = xenv.lambda_bucket,
                                                    Key = process_temp_readings.LambdaStatus,
-                                                   Body = mock_process_reading.return_value.create_json().encode())
+                                                   Body = mock_evaluate.return_value.create_json().encode(),
+                                                   IfNoneMatch = '*')
         
         event2 = dict(source='aws.events')
-        for m in (xenv, xenv.s3.get_object, mock_read_config, mock_read_status, mock_process_reading, mock_scheduled_event, mock_send_alert, mock_time):
+        for m in (xenv.s3.get_object, mock_read_config, mock_read_status, mock_ingest, mock_evaluate, mock_scheduled_event, mock_send_alert, mock_time):
             m.reset_mock()
+        xenv.s3.put_object.reset_mock()
+        xenv.last_status = None
+        xenv.s3.get_object.return_value = dict(Body='status_body', ETag='"s2"')
             
         process_temp_readings.process_events(xenv, event2, None)
-        assert mock_process_reading.call_count == 0
+        assert mock_ingest.call_count == 0
         mock_scheduled_event.assert_called_once_with(xenv, event2)
         assert mock_send_alert.call_count == 0
         xenv.s3.put_object.assert_called_once_with(Bucket = xenv.lambda_bucket,
                                                    Key = process_temp_readings.LambdaStatus,
-                                                   Body = mock_scheduled_event.return_value.create_json().encode())
+                                                   Body = mock_scheduled_event.return_value.create_json().encode(),
+                                                   IfMatch = '"s2"')
 
         event3 = dict(type='dummy')
-        for m in (xenv, xenv.s3.get_object, mock_read_config, mock_read_status, mock_process_reading, mock_scheduled_event, mock_send_alert, mock_time):
+        for m in (xenv.s3, xenv.s3.get_object, mock_read_config, mock_read_status, mock_ingest, mock_evaluate, mock_scheduled_event, mock_send_alert, mock_time):
             m.reset_mock()
+        xenv.last_status = None
+        xenv.status_etag = None
 
         last_status = process_temp_readings.Status(9, 99, 999)
         mock_read_status.return_value = last_status
         process_temp_readings.process_events(xenv, event3, None)
-        assert mock_process_reading.call_count == 0
+        assert mock_ingest.call_count == 0
         assert mock_scheduled_event.call_count == 0
         mock_send_alert.assert_called_once_with(xenv, "Lambda function received an unexpected event.")        
         xenv.s3.put_object.assert_called_once_with(Bucket = xenv.lambda_bucket,
                                                    Key = process_temp_readings.LambdaStatus,
                                                    Body = process_temp_readings.Status(last_status.temp_reading,
                                                                                       last_status.last_reading_ts,
-                                                                                      mock_time.return_value).create_json().encode())
+                                                                                      mock_time.return_value).create_json().encode(),
+                                                   IfMatch = '"s2"')
         
+
+def test_multiple_sensors():
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    rdgs = [dict(timestamp=ts, temperature=5, sensor='28-a'),
+            dict(timestamp=ts, temperature=2, sensor='28-b'),
+            dict(timestamp=ts + 600, temperature=6, sensor='28-a')]
+    assert process_temp_readings.consolidate_readings(list(reversed(rdgs)) + rdgs) == [rdgs[0], rdgs[1], rdgs[2]]
+    s3data = dict(bucket = dict(name='eimer'), object=dict(key='s3objectkey'))
+    jsonrdgs = json.dumps(rdgs)
+    xenv = Mock()
+    xenv.s3.get_object.side_effect = [dict(Body=io.StringIO(jsonrdgs), ContentLength=len(jsonrdgs))]
+    xenv.config.minimum_temperature = 3
+    xenv.config.rules = rules.RuleSet()
+    xenv.config.max_delay = 3
+    xenv.last_status = process_temp_readings.Status(0, 0, 42, {'28-c': [10, ts - 600]})
+    with patch('process_temp_readings.send_alert') as mock_send_alert, \
+         patch('process_temp_readings.time.time') as mock_time, \
+         patch('process_temp_readings.write_readings') as mock_write_readings, \
+         patch('process_temp_readings.rollups.update_rollups') as mock_update_rollups:
+        mock_time.return_value = ts + 610
+        status = process_temp_readings.process_temperature_reading(xenv, [dict(eventSource='aws:s3', s3=s3data)])
+        mock_send_alert.assert_called_once_with(xenv, "The latest temperature reading of 2 from sensor 28-b (as of 2018.03.08 22:33:44) has fallen below the threshold of 3")
+        assert status.temp_reading == 6
+        assert status.last_reading_ts == ts + 600
+        assert status.sensors == {'28-a': [6, ts + 600], '28-b': [2, ts], '28-c': [10, ts - 600]}
+        assert json.loads(status.create_json())['sensors'] == status.sensors
+
+def test_process_events_fake_s3():
+    xenv = fakeaws.make_env()
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    rdgs = [dict(timestamp=ts + 600 * i, temperature=t) for i, t in enumerate((5, 4, 2))]
+    xenv.s3.put('eimer', 'observations/obs1.json', json.dumps(rdgs[:2]))
+    xenv.s3.put('eimer', 'observations/obs2.json', json.dumps(rdgs))
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = ts + 1210
+        process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs1.json', 'observations/obs2.json', 'observations/missing.json'), None)
+    stored = dayfile.loads(xenv.s3.data('eimer', 'allreadings/day20180308.json'))
+    assert [(r['timestamp'], r['temperature']) for r in stored] == [(r['timestamp'], r['temperature']) for r in rdgs]
+    status = process_temp_readings.Status.read_status(io.BytesIO(xenv.s3.data('eimer', process_temp_readings.LambdaStatus)))
+    assert status.temp_reading == 2
+    assert status.last_alert_ts == ts + 1210
+    assert len(xenv.sns.messages) == 1
+    assert 'has fallen below the threshold of 3.0' in xenv.sns.messages[0][1]
+    # config, status, three event objects, the day file, the day file manifest and two rollups
+    assert xenv.s3.calls['GetObject'] == 9
+
+    # a failing request aborts the invocation before the status is written
+    xenv.s3.fail('PutObject', 'allreadings/*', 'SlowDown')
+    xenv.s3.put('eimer', 'observations/obs3.json', json.dumps([dict(timestamp=ts + 1800, temperature=6)]))
+    try:
+        process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs3.json'), None)
+        assert False
+    except botocore.exceptions.ClientError as e:
+        assert e.response['Error']['Code'] == 'SlowDown'
+    assert process_temp_readings.Status.read_status(io.BytesIO(xenv.s3.data('eimer', process_temp_readings.LambdaStatus))).temp_reading == 2
+
+def test_alert_rules():
+    # the rule states are kept in the status between invocations
+    config = dict(fakeaws.DefaultConfig, rules=[dict(type='threshold'), dict(type='drop_rate', per_hour=3, minutes=30)])
+    xenv = fakeaws.make_env(config = config)
+    ts = datetime(2018,3,8,22,0).timestamp()
+    for i, temperatures in enumerate(((20, 20, 20), (19, 17, 15))):
+        rdgs = [dict(timestamp=ts + 600 * (3 * i + j), temperature=t) for j, t in enumerate(temperatures)]
+        xenv.s3.put('eimer', 'observations/obs{}.json'.format(i), json.dumps(rdgs))
+        with patch('process_temp_readings.time.time') as mock_time:
+            mock_time.return_value = rdgs[-1]['timestamp'] + 10
+            process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs{}.json'.format(i)), None)
+        status = json.loads(xenv.s3.data('eimer', process_temp_readings.LambdaStatus))
+        assert status['rules']['drop_rate']['']['last_ts'] == rdgs[-1]['timestamp']
+    assert [m for _, m in xenv.sns.messages] == ["2018.03.08 22:50:10 UTC: The temperature is dropping by 6.7 degrees per hour, it was 15 at 2018.03.08 22:50:00"]
+
+def test_day_manifest():
+    # write_readings() keeps an entry for each day file it writes, the manifest command rebuilds them
+    xenv = fakeaws.make_env()
+    ts = datetime(2018,3,8,23,0).timestamp()
+    rdgs = [dict(timestamp=ts + 1200 * i, temperature=10) for i in range(6)]
+    for i in range(2):
+        xenv.s3.put('eimer', 'observations/obs{}.json'.format(i), json.dumps(rdgs[3 * i:3 * i + 3]))
+        with patch('process_temp_readings.time.time') as mock_time:
+            mock_time.return_value = rdgs[3 * i + 2]['timestamp'] + 10
+            process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs{}.json'.format(i)), None)
+    days = daymanifest.read_manifest(xenv, 'eimer')['days']
+    assert sorted(days.keys()) == ['20180308', '20180309']
+    for day, count, first, last in (('20180308', 3, 0, 2), ('20180309', 3, 3, 5)):
+        entry = days[day]
+        data = xenv.s3.data('eimer', 'allreadings/day{}.json'.format(day))
+        assert (entry['count'], entry['first'], entry['last']) == (count, rdgs[first]['timestamp'], rdgs[last]['timestamp'])
+        assert entry['bytes'] == len(data) and entry['etag'] == xenv.s3.objects[('eimer', 'allreadings/day{}.json'.format(day))].etag
+        # JSON is the default, consumers outside of this repo read the day files
+        assert entry['format'] == 'json' and len(json.loads(data.decode())) == count
+    # a stale entry is dropped by a full rebuild, the others come out the same
+    stale = dict(days, **{'20180301': days['20180308']})
+    daymanifest.write_manifest(xenv, 'eimer', dict(days = stale))
+    daymanifest.rebuild_manifest(xenv, 'eimer', local.list_day_files(xenv, 'eimer'), replace = True)
+    rebuilt = daymanifest.read_manifest(xenv, 'eimer')['days']
+    assert sorted(rebuilt.keys()) == ['20180308', '20180309']
+    assert all(dict(rebuilt[d], updated=0) == dict(days[d], updated=0) for d in days)
+
+def test_rollup_failure(capsys):
+    # the readings are stored and the status is updated, the failed rollup is reported for the rollups command
+    xenv = fakeaws.make_env()
+    ts = datetime(2018,3,8,22,0).timestamp()
+    xenv.s3.put('eimer', 'observations/obs1.json', json.dumps([dict(timestamp=ts, temperature=10)]))
+    xenv.s3.fail('PutObject', 'rollups/daily/*')
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = ts + 10
+        process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs1.json'), None)
+    assert len(dayfile.loads(xenv.s3.data('eimer', 'allreadings/day20180308.json'))) == 1
+    assert json.loads(xenv.s3.data('eimer', 'rollups/hourly/month201803.json'))['sensors']['']['2018030822'][0] == 1
+    assert ('eimer', 'rollups/daily/year2018.json') not in xenv.s3.objects
+    assert json.loads(xenv.s3.data('eimer', process_temp_readings.LambdaStatus))['last_reading_timestamp'] == ts
+    out = capsys.readouterr().out
+    assert 'rollups/daily/year2018.json miss readings, run the rollups command of local.py with --file allreadings/day20180308.json' in out
+    metrics = [json.loads(line) for line in out.splitlines() if line.startswith('{"_aws"')]
+    assert metrics[-1]['rollup_failures'] == 1
+
+def test_summary_readings():
+    # a summary of a sampling reader alerts on its min and counts as all of its samples
+    xenv = fakeaws.make_env()
+    ts = datetime(2018,3,8,22,0).timestamp()
+    summary = dict(type='summary', timestamp=ts + 1800, temperature=4.2, min=2.5, max=5.0, count=180, start=ts)
+    xenv.s3.put('eimer', 'observations/obs1.json', json.dumps([summary]))
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = ts + 1810
+        process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs1.json'), None)
+    assert [m for _, m in xenv.sns.messages] == ["2018.03.08 22:30:10 UTC: The lowest temperature reading of 2.5 (between 2018.03.08 22:00:00 and 2018.03.08 22:30:00) has fallen below the threshold of 3.0"]
+    stored = dayfile.loads(xenv.s3.data('eimer', 'allreadings/day20180308.json'))
+    assert stored == [dict(summary, received=ts + 1810)]
+    hourly = json.loads(xenv.s3.data('eimer', 'rollups/hourly/month201803.json'))['sensors']['']
+    assert hourly == {'2018030822': [180, 2.5, 5.0, 4.2 * 180, ts, ts + 1800]}
+
+def test_metrics_line(capsys):
+    xenv = fakeaws.make_env()
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    xenv.s3.put('eimer', 'observations/obs1.json', json.dumps([dict(timestamp=ts, temperature=5), dict(timestamp=ts + 600, temperature=6)]))
+    event = fakeaws.upload_event('eimer', 'observations/obs1.json')
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = ts + 610
+        process_temp_readings.process_events(xenv, event, None)
+        process_temp_readings.process_events(xenv, event, None)
+    lines = [json.loads(l) for l in capsys.readouterr().out.splitlines() if l.startswith('{"_aws"')]
+    assert len(lines) == 2
+    first, second = lines
+    assert first['EventType'] == 'upload'
+    assert first['cold_start'] and not second['cold_start']
+    assert first['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['EventType']]
+    names = set(m['Name'] for m in first['_aws']['CloudWatchMetrics'][0]['Metrics'])
+    assert {'config_ms', 'status_read_ms', 'fetch_ms', 'write_days_ms', 'rollups_ms', 'status_write_ms', 'total_ms'} <= names
+    assert first['readings_received'] == 2 and first['readings_added'] == 2 and first['duplicates_dropped'] == 0
+    assert second['readings_added'] == 0 and second['duplicates_dropped'] == 2
+    assert first['bytes_read'] > 0 and first['bytes_written'] > 0
+
+    xenv.metrics_enabled = False
+    process_temp_readings.process_events(xenv, event, None)
+    assert '"_aws"' not in capsys.readouterr().out
+
+def test_status_conflict():
+    xenv = fakeaws.make_env()
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    now = ts + 60
+    xenv.s3.put('eimer', 'observations/obs1.json', json.dumps([dict(timestamp=ts, temperature=1, sensor='28-a')]))
+    other = process_temp_readings.Status(4, ts + 30, now - 10, {'28-b': [4, ts + 30]})
+    updated = []
+    def concurrent_update(operation, key):
+        # another invocation stores its status and sends its alert while this one is evaluating
+        if operation == 'PutObject' and key == process_temp_readings.LambdaStatus and not updated:
+            updated.append(key)
+            xenv.s3.put('eimer', key, other.create_json())
+        return 0
+    xenv.s3.latency = concurrent_update
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = now
+        process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs1.json'), None)
+    status = process_temp_readings.Status.read_status(io.BytesIO(xenv.s3.data('eimer', process_temp_readings.LambdaStatus)))
+    # the newer reading and the sensor of the other invocation are kept, its alert is not repeated
+    assert (status.temp_reading, status.last_reading_ts) == (4, ts + 30)
+    assert status.sensors == {'28-a': [1, ts], '28-b': [4, ts + 30]}
+    assert xenv.sns.messages == []
+    assert xenv.metrics.values['status_conflicts'] == 1
+
+def test_status_warm_conflict():
+    # a warm container evaluates with its cached status and only reads the status again
+    # when another container has written it in the meantime
+    s3 = fakeaws.FakeS3()
+    xenv, other = fakeaws.make_env(s3 = s3), fakeaws.make_env(s3 = s3)
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    for i, sensor in enumerate(('28-a', '28-b', '28-a')):
+        s3.put('eimer', 'observations/obs{}.json'.format(i), json.dumps([dict(timestamp=ts + 60 * i, temperature=10, sensor=sensor)]))
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = ts + 200
+        process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs0.json'), None)
+        s3.reset_counters()
+        process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs0.json'), None)
+        assert s3.calls['GetObject'] == 2
+        assert xenv.metrics.values.get('status_conflicts', 0) == 0
+        process_temp_readings.process_events(other, fakeaws.upload_event('eimer', 'observations/obs1.json'), None)
+        process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs2.json'), None)
+    assert xenv.metrics.values['status_conflicts'] == 1
+    status = process_temp_readings.Status.read_status(io.BytesIO(s3.data('eimer', process_temp_readings.LambdaStatus)))
+    assert status.sensors == {'28-a': [10, ts + 120], '28-b': [10, ts + 60]}
+
+def test_concurrent_invocations():
+    # invocations in separate containers that store readings of the same day at the same time
+    ts = datetime(2018,3,8,22,0).timestamp()
+    now = ts + 3600
+    s3 = fakeaws.FakeS3(latency = lambda operation, key: 0.01 if operation == 'GetObject' else 0.001)
+    envs = [fakeaws.make_env(s3 = s3) for _ in range(12)]
+    for i in range(len(envs)):
+        rdgs = [dict(timestamp=ts + 60 * i + 30 * j, temperature=1 if i in (5, 7) else 10) for j in range(2)]
+        s3.put('eimer', 'observations/obs{:02}.json'.format(i), json.dumps(rdgs))
+    start = threading.Barrier(len(envs))
+    errors = []
+    def invoke(i):
+        try:
+            start.wait()
+            process_temp_readings.process_events(envs[i], fakeaws.upload_event('eimer', 'observations/obs{:02}.json'.format(i)), None)
+        except Exception as e:
+            errors.append(e)
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = now
+        threads = [threading.Thread(target = invoke, args = (i,)) for i in range(len(envs))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    assert errors == []
+    assert sum(e.metrics.values.get('write_conflicts', 0) + e.metrics.values.get('status_conflicts', 0) for e in envs) > 0
+    stored = dayfile.loads(s3.data('eimer', 'allreadings/day20180308.json'))
+    assert [r['timestamp'] for r in stored] == [ts + 30 * i for i in range(2 * len(envs))]
+    daily = json.loads(s3.data('eimer', 'rollups/daily/year2018.json'))['sensors']['']
+    assert daily['20180308'][0] == 2 * len(envs)
+    status = process_temp_readings.Status.read_status(io.BytesIO(s3.data('eimer', process_temp_readings.LambdaStatus)))
+    assert status.last_reading_ts == ts + 30 * (2 * len(envs) - 1)
+    assert status.last_alert_ts == now
+    # both low readings are reported by one SMS at most, the second one is within repeat_alert_hours
+    assert len([m for e in envs for m in e.sns.messages]) == 1
+
+def test_compressed_uploads():
+    xenv = fakeaws.make_env()
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    rdgs = [dict(timestamp=ts + 600 * i, temperature=10 + i) for i in range(4)]
+    # new readers send gzip with a content encoding, old ones plain JSON with indentation
+    xenv.s3.put('eimer', 'observations/obs1.json', gzip.compress(json.dumps(rdgs[:2], separators=(',', ':')).encode()), content_type='application/json', content_encoding='gzip')
+    xenv.s3.put('eimer', 'observations/obs2.json', json.dumps(rdgs[2:3], indent=2))
+    xenv.s3.put('eimer', 'observations/obs3.json', gzip.compress(json.dumps(rdgs[3:]).encode()))
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = ts + 1900
+        process_temp_readings.process_events(xenv, fakeaws.upload_event('eimer', 'observations/obs1.json', 'observations/obs2.json', 'observations/obs3.json'), None)
+    stored = dayfile.loads(xenv.s3.data('eimer', 'allreadings/day20180308.json'))
+    assert [(r['timestamp'], r['temperature']) for r in stored] == [(r['timestamp'], r['temperature']) for r in rdgs]
+
+def test_direct_invocation():
+    xenv = fakeaws.make_env()
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    rdgs = [dict(timestamp=ts, temperature=5), dict(timestamp=ts + 600, temperature=2)]
+    event = dict(source='heating.reader', readings=rdgs)
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = ts + 610
+        assert process_temp_readings.process_events(xenv, event, None) == dict(readings=2)
+    stored = dayfile.loads(xenv.s3.data('eimer', 'allreadings/day20180308.json'))
+    assert [(r['timestamp'], r['temperature'], r['received']) for r in stored] == [(r['timestamp'], r['temperature'], ts + 610) for r in rdgs]
+    assert len(xenv.sns.messages) == 1
+    assert 'has fallen below the threshold of 3.0' in xenv.sns.messages[0][1]
+    # no observation object is read, the readings are archived in one compressed object
+    archived = [k for b, k in xenv.s3.objects.keys() if k.startswith('rawreadings/2018/03/0')]
+    assert len(archived) == 1
+    assert json.loads(gzip.decompress(xenv.s3.data('eimer', archived[0]))) == [dict(r, received=ts + 610) for r in rdgs]
+    assert xenv.s3.calls['GetObject'] == 6
+
+    # a failed direct invocation is reported to the reader, other events are only logged
+    xenv.s3.fail('PutObject', 'allreadings/*', 'SlowDown')
+    with patch('process_temp_readings.init_lambda', return_value=xenv):
+        try:
+            process_temp_readings.lambda_handler(dict(event, readings=[dict(timestamp=ts + 1200, temperature=6)]), None)
+            assert False
+        except botocore.exceptions.ClientError:
+            pass
+        xenv.s3.fail('PutObject', 'allreadings/*', 'SlowDown')
+        xenv.s3.put('eimer', 'observations/obs1.json', json.dumps([dict(timestamp=ts + 1200, temperature=6)]))
+        assert process_temp_readings.lambda_handler(fakeaws.upload_event('eimer', 'observations/obs1.json'), None) is None
+
+def test_init_lambda(monkeypatch):
+    # the clients are created on the first invocation, the SNS client only when an alert is sent
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('CONFIG_BUCKET', 'eimer')
+    monkeypatch.setattr(process_temp_readings, 'LambdaEnv', None)
+    with patch('botocore.session.Session.create_client') as mock_create_client:
+        xenv = process_temp_readings.init_lambda()
+        assert process_temp_readings.init_lambda() is xenv
+        assert [c[0][0] for c in mock_create_client.call_args_list] == ['s3']
+        assert xenv.get_sns_client() is xenv.get_sns_client()
+        assert [c[0][0] for c in mock_create_client.call_args_list] == ['s3', 'sns']
+    assert xenv.lambda_bucket == 'eimer' and xenv.init_duration >= 0
+    assert 'argparse' not in vars(process_temp_readings) and 'boto3' not in vars(process_temp_readings)
+
+def test_devices():
+    config = dict(fakeaws.DefaultConfig, devices={'pi-b': dict(phonenumber='+15551111111', minimum_temperature=8)})
+    xenv = fakeaws.make_env(config = config)
+    ts = datetime(2018,3,8,22,33,44).timestamp()
+    for key, temperature in (('observations/obs1.json', 10), ('observations/pi-a/obs1.json', 6), ('observations/pi-b/obs1.json', 6), ('observations/../obs1.json', 1)):
+        xenv.s3.put('eimer', key, json.dumps([dict(timestamp=ts, temperature=temperature)]))
+    with patch('process_temp_readings.time.time') as mock_time:
+        mock_time.return_value = ts + 10
+        event = fakeaws.upload_event('eimer', 'observations/obs1.json', 'observations/pi-a/obs1.json', 'observations/pi-b/obs1.json', 'observations/../obs1.json')
+        assert process_temp_readings.process_events(xenv, event, None) == dict(readings=3)
+        # one status, day file and rollups per device
+        for partition, temperature in (('', 10), ('devices/pi-a/', 6), ('devices/pi-b/', 6)):
+            assert [r['temperature'] for r in dayfile.loads(xenv.s3.data('eimer', partition + 'allreadings/day20180308.json'))] == [temperature]
+            assert json.loads(xenv.s3.data('eimer', partition + 'rollups/daily/year2018.json'))['sensors']['']['20180308'][0] == 1
+            assert process_temp_readings.Status.read_status(io.BytesIO(xenv.s3.data('eimer', partition + process_temp_readings.LambdaStatus))).temp_reading == temperature
+        assert json.loads(xenv.s3.data('eimer', 'lambda_internal/devices.json')) == dict(devices={'pi-a': ts, 'pi-b': ts})
+        assert xenv.sns.messages == [('+15551111111', 'Device pi-b: 2018.03.08 22:33:54 UTC: The latest temperature reading of 6 (as of 2018.03.08 22:33:44) has fallen below the threshold of 8.0')]
+
+        # readings within ManifestInterval of the manifest entry do not change it
+        xenv.s3.reset_counters()
+        assert process_temp_readings.process_events(xenv, dict(source='heating.reader', device='pi-a', readings=[dict(timestamp=ts + 600, temperature=7)]), None) == dict(readings=1)
+        assert xenv.s3.calls['PutObject'] == 6
+        assert len([k for b, k in xenv.s3.objects.keys() if k.startswith('devices/pi-a/rawreadings/2018/03/08/')]) == 1
+
+        # the scheduled check only reads the device manifest, the container has the statuses it wrote
+        xenv.s3.reset_counters()
+        process_temp_readings.process_events(xenv, dict(source='aws.events'), None)
+        assert xenv.s3.calls['GetObject'] == 1
+        xenv.s3.reset_counters()
+        mock_time.return_value = ts + 16 * 3600
+        xenv.config_checked = mock_time.return_value
+        process_temp_readings.process_events(xenv, dict(source='aws.events'), None)
+        assert xenv.s3.calls['GetObject'] == 1
+        assert sorted(m for _, m in xenv.sns.messages[1:]) == ['2018.03.09 14:33:44 UTC: Failed to receive temperature readings for 16:00:00',
+                                                               'Device pi-a: 2018.03.09 14:33:44 UTC: Failed to receive temperature readings for 15:50:00',
+                                                               'Device pi-b: 2018.03.09 14:33:44 UTC: Failed to receive temperature readings for 16:00:00']
@@ -0,0 +1,366 @@
+import read_temp
+import ringbuffer
+
+import gzip
+import io
+import json
+import logging
+import os
+import time
+
+from unittest.mock import *
+
+def test_watermark(tmpdir):
+    fname = str(tmpdir.join('watermark'))
+    assert read_temp.read_watermark(fname) == 0
+    read_temp.write_watermark(fname, 1520548424)
+    assert read_temp.read_watermark(fname) == 1520548424
+    assert not os.path.exists(fname + '.tmp')
+
+def test_upload_only_new_readings(tmpdir):
+    hdir = tmpdir.mkdir('history')
+    for i, (ts, t) in enumerate(((100, 20.5), (200, 21.0), (300, 21.5))):
+        hdir.join('reading{:02}'.format(i)).write('{} {}\n'.format(ts, t))
+    sensor = tmpdir.join('sensor')
+    sensor.write('2d 00 4b 46 ff ff 08 10 fe : crc=fe YES\n2d 00 4b 46 ff ff 08 10 fe t=22250\n')
+    params = Mock()
+    params.sensorfile = str(sensor)
+    params.sensors = None
+    params.crc_retries = 3
+    params.local_history = str(hdir)
+    params.local_file_prefix = 'reading'
+    params.max_readings = 20
+    params.loglevel = 'info'
+    params.Logfiles = str(tmpdir.join('log'))
+    params.history_file = str(hdir.join('history.dat'))
+    params.watermark_file = str(hdir.join('watermark'))
+    params.spool_file = str(hdir.join('spool.ndjson'))
+    params.spool_limit = 100
+    params.upload_retries = 0
+    read_temp.write_watermark(params.watermark_file, 200)
+    with patch('read_temp.read_config') as mock_read_config, \
+         patch('read_temp.aws_upload') as mock_upload, \
+         patch('read_temp.create_s3_client') as mock_create_s3_client, \
+         patch('read_temp.create_lambda_client', return_value = None), \
+         patch('read_temp.time.time') as mock_time, \
+         patch('read_temp.sys.argv', ['read_temp.py', 'config.ini']):
+        mock_read_config.return_value = params
+        mock_time.return_value = 400
+        read_temp.main()
+        uploaded = json.loads(mock_upload.call_args[0][2])
+        assert uploaded == [dict(timestamp=300, temperature=21.5), dict(timestamp=400, temperature=22.25)]
+        assert read_temp.read_watermark(params.watermark_file) == 400
+
+        # a failed upload leaves the watermark alone, the next run catches up
+        mock_upload.reset_mock()
+        mock_upload.side_effect = Exception('network down')
+        mock_time.return_value = 500
+        read_temp.main()
+        assert read_temp.read_watermark(params.watermark_file) == 400
+        mock_upload.side_effect = None
+        mock_time.return_value = 600
+        read_temp.main()
+        uploaded = json.loads(mock_upload.call_args[0][2])
+        assert [r['timestamp'] for r in uploaded] == [500, 600]
+        assert read_temp.read_watermark(params.watermark_file) == 600
+
+def spool_params(tmpdir, max_readings):
+    sensor = tmpdir.join('sensor')
+    params = Mock()
+    params.sensorfile = str(sensor)
+    params.sensors = None
+    params.crc_retries = 0
+    params.local_history = str(tmpdir)
+    params.local_file_prefix = 'reading'
+    params.max_readings = max_readings
+    params.history_file = str(tmpdir.join('history.dat'))
+    params.watermark_file = str(tmpdir.join('watermark'))
+    params.spool_file = str(tmpdir.join('spool.ndjson'))
+    params.spool_limit = 5
+    params.upload_retries = 3
+    params.retry_delay = 10
+    params.retry_delay_max = 25
+    params.aws_params.device = None
+    return params
+
+def test_upload_spool(tmpdir):
+    # the ring only holds two readings, an outage of five runs is bridged by the spool
+    params = spool_params(tmpdir, 2)
+    s3 = Mock()
+    s3.put_object.side_effect = Exception('network down')
+    delays = []
+    with patch('read_temp.time.time') as mock_time:
+        for ts in range(100, 600, 100):
+            mock_time.return_value = ts
+            write_sensor(tmpdir.join('sensor'), ts * 10)
+            read_temp.take_reading(params, s3, delays.append)
+    # every run tries four times, with growing delays that stay below the cap
+    assert s3.put_object.call_count == 20
+    assert len(delays) == 15
+    for i, d in enumerate(delays[:3]):
+        assert min(25, 10 * 2 ** i) * 0.5 <= d <= min(25, 10 * 2 ** i)
+    assert all(d <= 25 for d in delays)
+    assert [r['timestamp'] for r in read_temp.read_spool(params.spool_file)] == [100, 200, 300, 400, 500]
+    assert read_temp.read_watermark(params.watermark_file) == 0
+
+    # the next successful run uploads everything in one object and empties the spool
+    s3.reset_mock()
+    s3.put_object.side_effect = [Exception('timeout'), None]
+    with patch('read_temp.time.time') as mock_time:
+        mock_time.return_value = 600
+        write_sensor(tmpdir.join('sensor'), 6000)
+        read_temp.take_reading(params, s3, delays.append)
+    assert s3.put_object.call_count == 2
+    assert s3.put_object.call_args[1]['ContentEncoding'] == 'gzip'
+    uploaded = json.loads(gzip.decompress(s3.put_object.call_args[1]['Body']).decode())
+    assert uploaded == [dict(timestamp=ts, temperature=ts / 100) for ts in range(100, 700, 100)]
+    assert not os.path.exists(params.spool_file)
+    assert read_temp.read_watermark(params.watermark_file) == 600
+
+def test_upload_spool_limit(tmpdir):
+    params = spool_params(tmpdir, 10)
+    params.upload_retries = 0
+    params.spool_limit = 3
+    s3 = Mock()
+    s3.put_object.side_effect = Exception('network down')
+    with patch('read_temp.time.time') as mock_time:
+        for ts in range(100, 600, 100):
+            mock_time.return_value = ts
+            write_sensor(tmpdir.join('sensor'), ts * 10)
+            read_temp.take_reading(params, s3)
+    # the oldest readings are dropped from the spool, the newest are kept
+    assert [r['timestamp'] for r in read_temp.read_spool(params.spool_file)] == [300, 400, 500]
+
+    # a sleep that returns True gives up without using the remaining retries
+    params.upload_retries = 5
+    s3.reset_mock()
+    read_temp.upload_pending(s3, params, [dict(timestamp=1, temperature=2)], lambda seconds: True)
+    assert s3.put_object.call_count == 1
+
+def test_direct_invoke(tmpdir):
+    params = spool_params(tmpdir, 10)
+    params.upload_retries = 0
+    params.direct_max_readings = 2
+    params.compress_uploads = False
+    params.aws_params.function = 'heating_lambda'
+    s3 = Mock()
+    client = Mock()
+    client.invoke.return_value = dict(StatusCode = 200, Payload = io.BytesIO(b'{"readings": 1}'))
+    with patch('read_temp.time.time') as mock_time:
+        mock_time.return_value = 100
+        write_sensor(tmpdir.join('sensor'), 1000)
+        read_temp.take_reading(params, s3, lambda_client = client)
+        args = client.invoke.call_args[1]
+        assert (args['FunctionName'], args['InvocationType']) == ('heating_lambda', 'RequestResponse')
+        assert json.loads(args['Payload'].decode()) == dict(source = 'heating.reader', readings = [dict(timestamp=100, temperature=1.0)])
+        assert s3.put_object.call_count == 0
+        assert read_temp.read_watermark(params.watermark_file) == 100
+        params.aws_params.device = 'pi-a'
+        read_temp.invoke_lambda(client, params.aws_params, [])
+        assert json.loads(client.invoke.call_args[1]['Payload'].decode())['device'] == 'pi-a'
+        params.aws_params.device = None
+
+        # a failed invocation falls back to S3
+        client.invoke.return_value = dict(StatusCode = 200, FunctionError = 'Unhandled', Payload = io.BytesIO(b'{"errorMessage": "boom"}'))
+        mock_time.return_value = 200
+        read_temp.take_reading(params, s3, lambda_client = client)
+        assert [r['timestamp'] for r in json.loads(s3.put_object.call_args[1]['Body'].decode())] == [200]
+        assert read_temp.read_watermark(params.watermark_file) == 200
+
+        # and so do batches that are too large for an invocation
+        client.reset_mock()
+        read_temp.write_watermark(params.watermark_file, 0)
+        mock_time.return_value = 300
+        read_temp.take_reading(params, s3, lambda_client = client)
+        assert client.invoke.call_count == 0
+        assert [r['timestamp'] for r in json.loads(s3.put_object.call_args[1]['Body'].decode())] == [100, 200, 300]
+
+def test_aws_upload():
+    params = Mock()
+    params.path = 'observations'
+    params.prefix = 'obs'
+    params.bucket = 'eimer'
+    params.device = None
+    s3 = Mock()
+    rdgs = [dict(timestamp=1520548424 + 600 * i, temperature=20.5) for i in range(100)]
+    msg = read_temp.create_aws_message(rdgs)
+    read_temp.aws_upload(s3, params, msg)
+    args = s3.put_object.call_args[1]
+    assert args['Key'].startswith('observations/obs') and args['Key'].endswith('.json')
+    assert (args['ContentType'], args['ContentEncoding']) == ('application/json', 'gzip')
+    assert json.loads(gzip.decompress(args['Body']).decode()) == rdgs
+    assert len(args['Body']) * 5 < len(json.dumps(rdgs, indent=2))
+    read_temp.aws_upload(s3, params, msg, compress=False)
+    assert 'ContentEncoding' not in s3.put_object.call_args[1]
+    assert json.loads(s3.put_object.call_args[1]['Body'].decode()) == rdgs
+    # the Lambda function takes the device id from the key
+    params.device = 'pi-a'
+    read_temp.aws_upload(s3, params, msg)
+    assert s3.put_object.call_args[1]['Key'].startswith('observations/pi-a/obs')
+
+def test_ringbuffer(tmpdir):
+    fname = str(tmpdir.join('history.dat'))
+    with ringbuffer.RingBuffer.create(fname, 3) as ring:
+        assert len(ring) == 0
+        assert ring.last(5) == []
+        assert ring.since(0) == []
+        for i in range(1, 6):
+            ring.append(100 * i, -1000 * i)
+        assert ring.count == 5
+        assert len(ring) == 3
+        assert ring.last(2) == [(400, -4000), (500, -5000)]
+        assert ring.since(0) == [(300, -3000), (400, -4000), (500, -5000)]
+        assert ring.since(400) == [(500, -5000)]
+        assert ring.since(500) == []
+    assert os.path.getsize(fname) == ringbuffer.HeaderFormat.size + 3 * ringbuffer.RecordFormat.size
+    with ringbuffer.RingBuffer(fname, readonly = True) as ring:
+        assert ring.capacity == 3
+        assert ring.last(3) == [(300, -3000), (400, -4000), (500, -5000)]
+
+def test_import_reading_files(tmpdir):
+    hdir = tmpdir.mkdir('history')
+    for i, (ts, t) in enumerate(((300, 21.5), (100, 20.5), (200, 21.0))):
+        hdir.join('reading{:02}'.format(i)).write('{} {}\n'.format(ts, t))
+    hdir.join('readingnotes').write('not a reading')
+    with ringbuffer.RingBuffer.create(str(tmpdir.join('history.dat')), 2) as ring:
+        assert ringbuffer.import_reading_files(ring, str(hdir), 'reading') == 2
+        assert ring.last(2) == [(200, 21000), (300, 21500)]
+        assert ringbuffer.import_reading_files(ring, str(hdir), 'reading') == 0
+
+def test_daemon():
+    params = Mock()
+    params.interval = 0.01
+    params.sample_interval = None
+    params.loglevel = 'info'
+    with patch('read_temp.create_s3_client') as mock_create_s3_client, \
+         patch('read_temp.create_lambda_client') as mock_create_lambda_client, \
+         patch('read_temp.read_config') as mock_read_config, \
+         patch('read_temp.take_reading') as mock_take_reading, \
+         patch('read_temp.signal.signal'):
+        mock_create_s3_client.side_effect = lambda p: Mock()
+        daemon = read_temp.Daemon('config.ini', params)
+        s3 = daemon.s3
+        newparams = Mock()
+        newparams.interval = 0.01
+        newparams.sample_interval = None
+        newparams.loglevel = 'debug'
+        mock_read_config.return_value = newparams
+        def take_reading(params, s3, sleep, lambda_client):
+            if mock_take_reading.call_count == 2:
+                daemon.request_reload(None, None)
+            elif mock_take_reading.call_count == 4:
+                daemon.request_stop(None, None)
+        mock_take_reading.side_effect = take_reading
+        daemon.run()
+        assert mock_take_reading.call_count == 4
+        assert [c[0][0] for c in mock_take_reading.call_args_list] == [params, params, newparams, newparams]
+        mock_read_config.assert_called_once_with('config.ini')
+        # the s3 client is kept for the whole run, unless the aws settings change
+        assert mock_create_s3_client.call_count == 2
+        assert mock_take_reading.call_args_list[0][0][1] is s3
+        assert mock_take_reading.call_args_list[3][0][1] is daemon.s3
+        assert mock_take_reading.call_args_list[3][0][3] is daemon.lambda_client
+
+def test_daemon_loop_timing(caplog):
+    params = Mock()
+    params.interval = 0.05
+    params.sample_interval = None
+    with patch('read_temp.create_s3_client'), \
+         patch('read_temp.create_lambda_client'), \
+         patch('read_temp.take_reading') as mock_take_reading, \
+         patch('read_temp.signal.signal'):
+        daemon = read_temp.Daemon('config.ini', params)
+        def take_reading(params, s3, sleep, lambda_client):
+            # the second loop takes longer than the interval
+            if mock_take_reading.call_count == 2:
+                time.sleep(0.06)
+                daemon.request_stop(None, None)
+        mock_take_reading.side_effect = take_reading
+        with caplog.at_level(logging.INFO):
+            daemon.run()
+    timings = [(r.levelno, r.getMessage()) for r in caplog.records if r.getMessage().startswith('Loop took')]
+    assert len(timings) == 2
+    assert timings[0][0] == logging.INFO
+    assert timings[1][0] == logging.WARNING
+    assert timings[1][1].endswith('longer than the interval of 0.05 seconds')
+
+def test_sampler():
+    sampler = read_temp.Sampler(threshold = 3)
+    urgent = [sampler.add(None, r) for r in ((100, 5.5), (110, 4.5), (120, 2.5), (130, 2.0), (140, 6.0), (150, 1.0))]
+    # only the first sample of each run below the threshold asks for an upload
+    assert urgent == [False, False, True, False, False, True]
+    assert sampler.add('28-a', (110, 7.0)) is False
+    assert sampler.flush() == [
+        dict(type = 'summary', timestamp = 110, temperature = 7.0, min = 7.0, max = 7.0, count = 1, start = 110, sensor = '28-a'),
+        dict(timestamp = 120, temperature = 2.5),
+        dict(timestamp = 130, temperature = 2.0),
+        dict(type = 'summary', timestamp = 140, temperature = 5.333, min = 4.5, max = 6.0, count = 3, start = 100),
+        dict(timestamp = 150, temperature = 1.0)]
+    assert sampler.flush() == []
+
+def test_upload_summaries(tmpdir):
+    params = spool_params(tmpdir, 10)
+    params.direct_max_readings = 1000
+    params.compress_uploads = False
+    sampler = read_temp.Sampler()
+    for ts, t in ((100, 20.0), (160, 21.0), (220, 22.5)):
+        sampler.add(None, (ts, t))
+    s3 = Mock()
+    read_temp.take_reading(params, s3, sampler = sampler)
+    uploaded = json.loads(s3.put_object.call_args[1]['Body'].decode())
+    assert uploaded == [dict(type = 'summary', timestamp = 220, temperature = 21.167, min = 20.0, max = 22.5, count = 3, start = 100)]
+    assert read_temp.read_watermark(params.watermark_file) == 220
+    # the history keeps the mean
+    with ringbuffer.RingBuffer(params.history_file) as history:
+        assert history.last(1) == [(220, 21167)]
+    # a summary that could not be uploaded is spooled as it is
+    s3.put_object.side_effect = Exception('network down')
+    sampler.add(None, (280, 19.0))
+    read_temp.take_reading(params, s3, lambda seconds: True, sampler = sampler)
+    assert read_temp.read_spool(params.spool_file)[0]['type'] == 'summary'
+    s3.put_object.side_effect = None
+    read_temp.take_reading(params, s3, sampler = sampler)
+    assert json.loads(s3.put_object.call_args[1]['Body'].decode())[0]['count'] == 1
+
+def write_sensor(path, millidegrees, crc = 'YES'):
+    path.write('2d 00 4b 46 ff ff 08 10 fe : crc=fe {}\n2d 00 4b 46 ff ff 08 10 fe t={}\n'.format(crc, millidegrees))
+
+def test_read_sensors(tmpdir):
+    w1 = tmpdir.mkdir('w1')
+    for sensor, t in (('28-000001', 5125), ('28-000002', -1250)):
+        write_sensor(w1.mkdir(sensor).join('w1_slave'), t)
+    write_sensor(w1.mkdir('28-000003').join('w1_slave'), 85000, crc = 'NO')
+    w1.mkdir('w1_bus_master1')
+    params = Mock()
+    params.sensors = ['auto']
+    params.sensor_dir = str(w1)
+    sensors = read_temp.find_sensors(params)
+    assert [s for s, _ in sensors] == ['28-000001', '28-000002', '28-000003']
+    params.sensors = ['28-000002']
+    assert read_temp.find_sensors(params) == [('28-000002', str(w1.join('28-000002', 'w1_slave')))]
+    with patch('read_temp.time.time') as mock_time:
+        mock_time.return_value = 1000
+        readings = read_temp.read_sensors(sensors, 2)
+    # the sensor with the failing CRC check is left out
+    assert readings == [('28-000001', (1000, 5.125)), ('28-000002', (1000, -1.25))]
+
+def test_crc_retry(tmpdir):
+    sensor = tmpdir.join('w1_slave')
+    write_sensor(sensor, 12000, crc = 'NO')
+    calls = []
+    original = read_temp.read_current_temperature
+    def flaky(srcfile):
+        calls.append(srcfile)
+        if len(calls) == 3:
+            write_sensor(sensor, 12000)
+        return original(srcfile)
+    with patch('read_temp.read_current_temperature') as mock_read:
+        mock_read.side_effect = flaky
+        assert read_temp.read_sensor(str(sensor), 3)[1] == 12.0
+        assert len(calls) == 3
+    write_sensor(sensor, 12000, crc = 'NO')
+    try:
+        read_temp.read_sensor(str(sensor), 1)
+        assert False
+    except read_temp.CrcError:
+        pass
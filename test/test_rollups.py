@@ -0,0 +1,76 @@
+import dayfile
+import fakeaws
+import rollups
+
+from datetime import *
+import io
+import json
+
+import botocore.exceptions
+
+from unittest.mock import *
+
+def dict_s3(objects):
+    s3 = Mock()
+    def get_object(Bucket, Key):
+        if Key not in objects:
+            raise botocore.exceptions.ClientError(dict(Error = dict(Code = 'NoSuchKey')), 'GetObject')
+        return dict(Body = io.BytesIO(objects[Key]))
+    def put_object(Bucket, Key, Body, **kwargs):
+        objects[Key] = Body
+    s3.get_object.side_effect = get_object
+    s3.put_object.side_effect = put_object
+    return s3
+
+def test_update_rollups():
+    objects = dict()
+    xenv = Mock()
+    xenv.s3 = dict_s3(objects)
+    base = datetime(2018,3,8,22,30)
+    rdgs = [dict(timestamp=(base + timedelta(minutes=20 * i)).timestamp(), temperature=t) for i, t in enumerate((5, 3, 4, 8))]
+    rollups.update_rollups(xenv, 'eimer', rdgs[:2])
+    rollups.update_rollups(xenv, 'eimer', rdgs[2:] + [dict(rdgs[0], sensor='28-a')])
+    hourly = json.loads(objects['rollups/hourly/month201803.json'])['sensors']
+    assert hourly[''] == {'2018030822': [2, 3, 5, 8, rdgs[0]['timestamp'], rdgs[1]['timestamp']],
+                          '2018030823': [2, 4, 8, 12, rdgs[2]['timestamp'], rdgs[3]['timestamp']]}
+    assert hourly['28-a'] == {'2018030822': [1, 5, 5, 5, rdgs[0]['timestamp'], rdgs[0]['timestamp']]}
+    daily = json.loads(objects['rollups/daily/year2018.json'])['sensors']
+    assert daily[''] == {'20180308': [4, 3, 8, 20, rdgs[0]['timestamp'], rdgs[3]['timestamp']]}
+    stats = rollups.range_stats(xenv, 'eimer', date(2018,3,1), date(2018,3,31))
+    assert rollups.mean(stats['20180308']) == 5
+
+    # rebuilding from the day files gives the same result
+    objects['allreadings/day20180308.json'] = dayfile.dumps(rdgs + [dict(rdgs[0], sensor='28-a')])
+    before = dict(objects)
+    objects['rollups/daily/year2018.json'] = json.dumps(dict(sensors={'': {'20180308': [99, 0, 0, 0, 0, 0], '20180307': [1, 1, 1, 1, 1, 1]}})).encode()
+    rollups.rebuild_rollups(xenv, 'eimer', ['allreadings/day20180308.json'])
+    assert json.loads(objects['rollups/hourly/month201803.json']) == json.loads(before['rollups/hourly/month201803.json'])
+    daily = json.loads(objects['rollups/daily/year2018.json'])['sensors']
+    assert daily[''] == {'20180308': [4, 3, 8, 20, rdgs[0]['timestamp'], rdgs[3]['timestamp']], '20180307': [1, 1, 1, 1, 1, 1]}
+
+def test_merge_stats():
+    a = rollups.new_stats(dict(timestamp=10, temperature=2))
+    b = rollups.add_reading(rollups.new_stats(dict(timestamp=5, temperature=4)), dict(timestamp=20, temperature=-1))
+    assert rollups.merge_stats(a, b) == rollups.merge_stats(b, a) == [3, -1, 4, 5, 5, 20]
+    assert rollups.merge_stats(None, a) == a
+    summary = dict(type='summary', timestamp=30, temperature=2.5, min=1, max=4, count=4, start=25)
+    assert rollups.merge_stats(a, rollups.new_stats(summary)) == [5, 1, 4, 12, 10, 30]
+
+def test_rebuild_rollups_conflict():
+    xenv = fakeaws.make_env()
+    base = datetime(2018,3,8,22,30)
+    rdgs = [dict(timestamp=(base + timedelta(minutes=20 * i)).timestamp(), temperature=t) for i, t in enumerate((5, 3))]
+    xenv.s3.put('eimer', 'allreadings/day20180308.json', dayfile.dumps(rdgs))
+    # another day that the Lambda function adds while the rollup is rebuilt is kept
+    added = dict(sensors = {'': {'20180309': [1, 2, 2, 2, 0, 0]}})
+    get_object = xenv.s3.get_object
+    def get(Bucket, Key, **kwargs):
+        try:
+            return get_object(Bucket = Bucket, Key = Key, **kwargs)
+        finally:
+            if Key == 'rollups/daily/year2018.json' and xenv.s3.calls['PutObject'] == 0:
+                xenv.s3.put('eimer', Key, json.dumps(added))
+    xenv.s3.get_object = get
+    rollups.rebuild_rollups(xenv, 'eimer', ['allreadings/day20180308.json'])
+    daily = json.loads(xenv.s3.data('eimer', 'rollups/daily/year2018.json'))['sensors']
+    assert daily[''] == {'20180308': [2, 3, 5, 8, rdgs[0]['timestamp'], rdgs[1]['timestamp']], '20180309': [1, 2, 2, 2, 0, 0]}
@@ -0,0 +1,107 @@
+import rules
+
+from datetime import *
+import json
+
+import pytest
+
+ts = datetime(2018,3,8,22,0).timestamp()
+
+def readings(temperatures, minutes = 10, start = ts, **extra):
+    return [dict(timestamp=start + 60 * minutes * i, temperature=t, **extra) for i, t in enumerate(temperatures)]
+
+def test_default_threshold():
+    ruleset = rules.RuleSet()
+    states, msgs = ruleset.evaluate(dict(), readings((5, 2)) + readings((1, 6), sensor='28-a'), 3)
+    assert msgs == ["The latest temperature reading of 2 (as of 2018.03.08 22:10:00) has fallen below the threshold of 3"]
+    assert states == dict()
+    # late readings are still checked, there is no state
+    assert len(ruleset.evaluate(states, readings((2,)), 3)[1]) == 1
+
+def test_summary_threshold():
+    summary = dict(type='summary', timestamp=ts + 1800, temperature=4.2, min=2.5, max=5.0, count=180, start=ts)
+    assert rules.RuleSet().evaluate(None, [summary], 3)[1] == ["The lowest temperature reading of 2.5 (between 2018.03.08 22:00:00 and 2018.03.08 22:30:00) has fallen below the threshold of 3"]
+    assert rules.RuleSet().evaluate(None, [dict(summary, min=3.5)], 3)[1] == []
+
+def test_sensor_overrides():
+    ruleset = rules.RuleSet([dict(type='threshold', below=3),
+                             dict(type='threshold', below=8, sensor='28-a'),
+                             dict(type='flatline', minutes=30),
+                             dict(type='flatline', sensor='28-b', enabled=False)])
+    assert [r.name for r in ruleset.for_sensor('')] == ['threshold', 'flatline']
+    assert [r.below for r in ruleset.for_sensor('28-a')[:1]] == [8]
+    assert [r.name for r in ruleset.for_sensor('28-b')] == ['threshold']
+    states, msgs = ruleset.evaluate(None, readings((5,), sensor='28-a') + readings((5,), sensor='28-b'), 10)
+    assert msgs == ["The latest temperature reading of 5 from sensor 28-a (as of 2018.03.08 22:00:00) has fallen below the threshold of 8"]
+    assert states == dict(flatline = {'28-a': dict(last_ts=ts, temperature=5, since=ts)})
+
+def test_invalid_rules():
+    with pytest.raises(ValueError):
+        rules.RuleSet([dict(type='humidity')])
+    with pytest.raises(ValueError):
+        rules.RuleSet([dict(type='drop_rate')])
+
+def test_drop_rate():
+    ruleset = rules.RuleSet([dict(type='drop_rate', per_hour=2, minutes=30)])
+    states, msgs = ruleset.evaluate(None, readings((20, 20, 20, 20)), 3)
+    assert msgs == [] and states['drop_rate']['']['rate'] == 0
+    # 1.5 degrees per 10 minutes, smoothed over 30 minutes
+    states, msgs = ruleset.evaluate(states, readings((18.5, 17, 15.5, 14), start = ts + 2400), 3)
+    assert msgs == ["The temperature is dropping by 6.6 degrees per hour, it was 14 at 2018.03.08 23:10:00"]
+
+def test_window_mean():
+    ruleset = rules.RuleSet([dict(type='window_mean', below=5, minutes=60)])
+    # not checked before the readings cover the window
+    states, msgs = ruleset.evaluate(None, readings((2, 2, 2)), 3)
+    assert msgs == []
+    states, msgs = ruleset.evaluate(states, readings((2, 2, 2, 2), start = ts + 1800), 3)
+    assert msgs == ["The mean temperature over the last 60 minutes is 2.0, below 5.0"]
+    states, msgs = ruleset.evaluate(states, readings([10] * 12, start = ts + 4200), 3)
+    assert len(msgs) == 1
+    states, msgs = ruleset.evaluate(states, readings((10,), start = ts + 11400), 3)
+    assert msgs == [] and states['window_mean']['']['mean'] > 5
+
+def test_flatline():
+    ruleset = rules.RuleSet([dict(type='flatline', minutes=60, tolerance=0.1)])
+    states, msgs = ruleset.evaluate(None, readings((15, 15.05, 15, 14.95, 15, 15)), 3)
+    assert msgs == []
+    states, msgs = ruleset.evaluate(states, readings((15,), start = ts + 3600, sensor=''), 3)
+    assert msgs == ["The sensor has reported 15 since 2018.03.08 22:00:00, it may be stuck"]
+    states, msgs = ruleset.evaluate(states, readings((15.5,), start = ts + 4200), 3)
+    assert msgs == [] and states['flatline']['']['since'] == ts + 4200
+
+def test_incremental():
+    # evaluating in batches gives the same state as all at once, repeated readings are skipped
+    ruleset = rules.RuleSet([dict(type='drop_rate', per_hour=1), dict(type='window_mean', below=0), dict(type='flatline')])
+    rdgs = readings([20 - 0.3 * i for i in range(12)]) + readings([15 + i for i in range(12)], sensor='28-a')
+    all_at_once, _ = ruleset.evaluate(None, rdgs, 3)
+    states = None
+    for i in range(0, 12, 5):
+        states, _ = ruleset.evaluate(json.loads(json.dumps(states)), rdgs[i:i + 5] + rdgs[12 + i:12 + i + 5], 3)
+    assert ruleset.evaluate(states, rdgs, 3)[0] == states
+    assert json.dumps(states, sort_keys=True) == json.dumps(all_at_once, sort_keys=True)
+    # the state of a rule that is no longer configured is dropped
+    assert list(rules.RuleSet().evaluate(states, [], 3)[0].keys()) == []
+
+def test_trend():
+    ruleset = rules.RuleSet([dict(type='trend', below=3, horizon_minutes=120, minutes=60, min_rate=0.5, confirm=2)])
+    # steady, then noisy around a steady level
+    states, msgs = ruleset.evaluate(None, readings([10] * 7 + [10.4, 9.6, 10.3, 9.7]), 3)
+    assert msgs == [] and states['trend']['']['hits'] == 0
+    # falling by 3 degrees per hour, the smoothed trend needs a while to catch up
+    falling = readings([10 - 0.5 * i for i in range(1, 12)], start = ts + 6600)
+    states, msgs = ruleset.evaluate(states, falling[:8], 3)
+    assert msgs == [] and states['trend']['']['hits'] == 1
+    states, msgs = ruleset.evaluate(states, falling[8:9], 3)
+    assert msgs == ["The temperature is falling by 2.0 degrees per hour and expected to reach 3 in about 87 minutes"]
+    slope, level = rules.Trend.fit(states['trend'][''])
+    assert abs(level - falling[8]['temperature']) < 0.5
+
+def test_trend_flat():
+    # a stuck sensor fits a slope of exactly 0, without min_rate nothing stops the division by it
+    ruleset = rules.RuleSet([dict(type='trend', below=3, horizon_minutes=120, minutes=60, min_rate=0)])
+    states, msgs = ruleset.evaluate(None, readings([10] * 20), 3)
+    assert rules.Trend.fit(states['trend'][''])[0] == 0
+    assert msgs == [] and states['trend']['']['hits'] == 0
+    states, msgs = ruleset.evaluate(states, readings([10.5] * 3, start = ts + 12000), 3)
+    assert msgs == []
@@ -1,18 +1,55 @@
 import argparse
-import datetime
+import collections
+import json
+import math
 import sys
 
 import boto3
 
+import logutil
+
 Funcname='ktsr42_heating_lambda'
 Profile="root"
 
-def print_aws_timestamp(awsts):
-    return datetime.datetime.fromtimestamp(int(awsts) / 1000).strftime("%Y.%m.%dD%H:%M:%S.%f")
+print_aws_timestamp = logutil.print_aws_timestamp
+
+def metrics_lines(events):
+    # the Lambda function prints one embedded metric format JSON line per invocation
+    for event in events:
+        msg = event['message'].strip()
+        if msg.startswith('{') and '"_aws"' in msg:
+            try:
+                yield json.loads(msg)
+            except ValueError:
+                pass
+
+def percentile(values, p):
+    # nearest rank
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summarize_metrics(lines):
+    groups = collections.defaultdict(lambda: collections.defaultdict(list))
+    for line in lines:
+        group = '{} {}'.format(line.get('EventType', '?'), 'cold' if line.get('cold_start') else 'warm')
+        for m in line['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            groups[group][m['Name']].append(line.get(m['Name'], 0))
+    for group, values in sorted(groups.items()):
+        print("{} ({} invocations)".format(group, len(values.get('total_ms', []))))
+        print("  {:22} {:>10} {:>10} {:>10} {:>10}".format('', 'p50', 'p90', 'p99', 'max'))
+        for name, v in sorted(values.items()):
+            print("  {:22} {:10.1f} {:10.1f} {:10.1f} {:10.1f}".format(name, percentile(v, 50), percentile(v, 90), percentile(v, 99), max(v)))
 
 def parse_commandline(cmdline):
     parser = argparse.ArgumentParser("List AWS Lambda event logs from AWS Cloudwatch")
     parser.add_argument("--profile", type=str, default="default", help="Which AWS setup profile to use")
+    parser.add_argument("--metrics", action="store_true", help="Summarize the metrics lines instead of dumping the log")
+    parser.add_argument("--streams", type=int, default=1, help="Number of most recent log streams to read")
+    parser.add_argument("--start", type=str, help="Only events after this time, e.g. 2018-03-08T22:00 or 6h (ago)")
+    parser.add_argument("--end", type=str, help="Only events before this time")
+    parser.add_argument("--pattern", type=str, help="CloudWatch filter pattern the events have to match")
+    parser.add_argument("--workers", type=int, default=logutil.MaxWorkers, help="Number of log streams read concurrently")
+    parser.add_argument("--cache", type=str, help="Directory to keep the events of closed log streams in")
     parser.add_argument("funcname", type=str, help="Which Lambda function to dump the log for")
     return parser.parse_args(cmdline)
 
@@ -21,13 +58,29 @@ def main():
     session = boto3.Session(profile_name = args.profile)
     cwlogs = session.client('logs')
     logGroupName ='/aws/lambda/' + args.funcname
-    lastlog = cwlogs.describe_log_streams(logGroupName = logGroupName, orderBy='LastEventTime', descending=True)['logStreams'][0]
-    logStreamName = lastlog['logStreamName']
-    log = cwlogs.get_log_events(logGroupName=logGroupName, logStreamName = logStreamName)['events']
-    print("Dumping {}, created on {}".format(logStreamName, print_aws_timestamp(lastlog['creationTime'])))
-    for event in log:
-        print("{}: {}".format(print_aws_timestamp(event['timestamp']), event['message'].rstrip()))
+    start = None if args.start is None else logutil.parse_time(args.start)
+    end = None if args.end is None else logutil.parse_time(args.end)
+    if args.pattern or start is not None or end is not None:
+        # searched on the server across all streams of the time range
+        events = logutil.iter_filtered_events(cwlogs, logGroupName, args.pattern, start, end)
+        if args.metrics:
+            summarize_metrics(metrics_lines(events))
+            return
+        for event in events:
+            print("{} {}: {}".format(print_aws_timestamp(event['timestamp']), event['logStreamName'], event['message'].rstrip()))
+            sys.stdout.flush()
+        return
+    cache = None if args.cache is None else logutil.StreamCache(args.cache, logGroupName)
+    streams = logutil.iter_streams(cwlogs, logGroupName, args.streams)
+    fetched = logutil.stream_map(lambda s: logutil.stream_events(cwlogs, logGroupName, s, cache), streams, args.workers)
+    if args.metrics:
+        summarize_metrics(metrics_lines(e for _, log in fetched for e in log))
+        return
+    for stream, log in fetched:
+        print("Dumping {}, created on {}".format(stream['logStreamName'], print_aws_timestamp(stream['creationTime'])))
+        for event in log:
+            print("{}: {}".format(print_aws_timestamp(event['timestamp']), event['message'].rstrip()))
+            sys.stdout.flush()
 
 if __name__ == '__main__':
     main()
-    
@@ -0,0 +1,99 @@
+import argparse
+import bisect
+import itertools
+import statistics
+import sys
+
+import boto3
+
+import dayfile
+import rules
+
+# Replays stored day files through the trend rule (see aws/rules.py) for a grid of
+# parameters and reports how many threshold crossings it warned about, how early,
+# and how many warnings were not followed by a crossing within the horizon.
+#
+#   aws s3 sync s3://<bucket>/allreadings days
+#   PYTHONPATH=aws python tools/evaluate_trend.py --below 3 --horizon 60 180 --minutes 60 120 days/*.json
+
+def read_day_files(paths, bucket = None, profile = 'default'):
+    readings = []
+    if bucket is not None:
+        s3 = boto3.Session(profile_name = profile).client('s3')
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket = bucket, Prefix = 'allreadings/day'):
+            for obj in page.get('Contents', []):
+                readings.extend(dayfile.load(s3.get_object(Bucket = bucket, Key = obj['Key'])['Body']))
+    for path in paths:
+        with open(path, 'rb') as f:
+            readings.extend(dayfile.load(f))
+    by_sensor = dict()
+    for r in sorted(readings, key = lambda r: r['timestamp']):
+        by_sensor.setdefault(rules.sensor_id(r), []).append(r)
+    return by_sensor
+
+def crossings(readings, below):
+    # timestamps of the readings where the temperature fell below the threshold
+    return [b['timestamp'] for a, b in zip(readings, readings[1:]) if a['temperature'] >= below > b['temperature']]
+
+def replay(rule, readings, below):
+    # timestamps of the readings with a warning and of the first ones of each run of them
+    state = None
+    warnings, starts = [], []
+    previous = None
+    for r in readings:
+        if state is not None and r['timestamp'] <= state['last_ts']:
+            continue
+        state, msg = rule.update(state, r, below)
+        if msg is not None:
+            if len(warnings) == 0 or warnings[-1] != previous:
+                starts.append(r['timestamp'])
+            warnings.append(r['timestamp'])
+        previous = r['timestamp']
+    return warnings, starts
+
+def score(warnings, starts, cross, horizon):
+    caught, leads = 0, []
+    for c in cross:
+        # the first warning within the horizon before the crossing
+        i = bisect.bisect_left(warnings, c - horizon)
+        if i < len(warnings) and warnings[i] < c:
+            caught += 1
+            leads.append((c - warnings[i]) / 60)
+    # runs of warnings without a crossing within the horizon after they started
+    false = sum(1 for w in starts if bisect.bisect_right(cross, w + horizon) == bisect.bisect_right(cross, w))
+    return caught, leads, false
+
+def evaluate(by_sensor, below, grid):
+    results = []
+    for horizon, minutes, min_rate, confirm in grid:
+        rule = rules.Trend(dict(type = 'trend', below = below, horizon_minutes = horizon, minutes = minutes, min_rate = min_rate, confirm = confirm))
+        total, caught, leads, false = 0, 0, [], 0
+        for readings in by_sensor.values():
+            cross = crossings(readings, below)
+            c, l, f = score(*replay(rule, readings, below), cross, horizon * 60)
+            total, caught, leads, false = total + len(cross), caught + c, leads + l, false + f
+        results.append((horizon, minutes, min_rate, confirm, caught, total, statistics.median(leads) if leads else 0, false))
+    return results
+
+def parse_commandline(cmdline):
+    parser = argparse.ArgumentParser("Tune the parameters of the trend alert rule with stored day files")
+    parser.add_argument("--below", type=float, required=True, help="Threshold the trend should warn about")
+    parser.add_argument("--horizon", type=float, nargs='+', default=[180], help="Values of horizon_minutes to try")
+    parser.add_argument("--minutes", type=float, nargs='+', default=[60, 120], help="Values of minutes to try")
+    parser.add_argument("--min-rate", type=float, nargs='+', default=[0.2], help="Values of min_rate to try")
+    parser.add_argument("--confirm", type=int, nargs='+', default=[1, 2, 3], help="Values of confirm to try")
+    parser.add_argument("--bucket", type=str, help="Also read all day files of this bucket")
+    parser.add_argument("--profile", type=str, default="default", help="Which AWS setup profile to use")
+    parser.add_argument("files", nargs='*', help="Day files")
+    return parser.parse_args(cmdline)
+
+def main():
+    args = parse_commandline(sys.argv[1:])
+    by_sensor = read_day_files(args.files, args.bucket, args.profile)
+    grid = itertools.product(args.horizon, args.minutes, args.min_rate, args.confirm)
+    print("{:>8} {:>8} {:>8} {:>8} {:>10} {:>10} {:>8}".format('horizon', 'minutes', 'min_rate', 'confirm', 'caught', 'lead_min', 'false'))
+    for horizon, minutes, min_rate, confirm, caught, total, lead, false in evaluate(by_sensor, args.below, grid):
+        print("{:8g} {:8g} {:8g} {:8d} {:>10} {:10.0f} {:8d}".format(horizon, minutes, min_rate, confirm, '{}/{}'.format(caught, total), lead, false))
+
+if __name__ == '__main__':
+    main()
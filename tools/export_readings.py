@@ -0,0 +1,203 @@
+import argparse
+import csv
+import datetime
+import hashlib
+import json
+import os
+import sys
+import time
+
+import boto3
+import botocore.config
+import botocore.exceptions
+
+import conditional
+import dayfile
+import devices
+import logutil
+
+# Exports the readings of a range of days from the allreadings day files as CSV or NDJSON.
+# Finished days are kept in a local cache and not requested again, the day files of the
+# last FinishedAfter seconds are checked with a conditional GET against the cached ETag.
+#
+#   PYTHONPATH=aws python tools/export_readings.py --bucket <bucket> --every 3600 2018-03-01 2018-03-31 > march.csv
+#
+# The cache holds each day file once under its ETag (the MD5 of its content) in
+# <cache>/objects and maps <bucket>/<key> to it in <cache>/index.json.
+
+# a day file can still get late readings from a reader spool for a while after the day is over
+FinishedAfter = 2 * 86400
+DefaultCache = os.path.join(os.path.expanduser('~'), '.cache', 'heating')
+
+def day_keys(first, last, partition = ''):
+    day = first
+    while day <= last:
+        yield day, partition + day.strftime('allreadings/day%Y%m%d.json')
+        day += datetime.timedelta(days = 1)
+
+def finished(day, now = None):
+    now = time.time() if now is None else now
+    end = datetime.datetime(day.year, day.month, day.day, tzinfo = datetime.timezone.utc) + datetime.timedelta(days = 1)
+    return end.timestamp() + FinishedAfter < now
+
+def strip_etag(etag):
+    return etag.strip('"')
+
+class DayCache():
+    def __init__(self, directory, bucket):
+        self.directory = directory
+        self.bucket = bucket
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok = True)
+        try:
+            with open(os.path.join(directory, 'index.json')) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = dict()
+
+    def fname(self, etag):
+        return os.path.join(self.directory, 'objects', strip_etag(etag))
+
+    def lookup(self, key):
+        # returns (known, ETag), the ETag is None for a day without a file
+        name = self.bucket + '/' + key
+        if name not in self.index:
+            return False, None
+        etag = self.index[name]
+        return etag is None or os.path.exists(self.fname(etag)), etag
+
+    def put(self, key, etag, data = None):
+        # data is None if the cached content is still valid or there is no day file
+        if data is not None:
+            # single part uploads have the MD5 of the content as ETag
+            if '-' not in etag and hashlib.md5(data).hexdigest() != strip_etag(etag):
+                raise ValueError('Content of {} does not match its ETag {}'.format(key, etag))
+            with open(self.fname(etag) + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(self.fname(etag) + '.tmp', self.fname(etag))
+        self.index[self.bucket + '/' + key] = etag
+
+    def save(self):
+        fname = os.path.join(self.directory, 'index.json')
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent = 1, sort_keys = True)
+        os.replace(fname + '.tmp', fname)
+
+def fetch_day(s3, cache, bucket, day, key, revalidate = False):
+    # returns whether S3 was asked, the ETag and the content if it was downloaded,
+    # the ETag is None if there is no day file
+    known, etag = cache.lookup(key)
+    if known and finished(day) and not revalidate:
+        return False, etag, None
+    args = dict(Bucket = bucket, Key = key)
+    if known and etag is not None:
+        args['IfNoneMatch'] = etag
+    try:
+        obj = s3.get_object(**args)
+    except botocore.exceptions.ClientError as e:
+        if conditional.not_modified(e):
+            return True, etag, None
+        if e.response.get('Error', {}).get('Code') == 'NoSuchKey':
+            return True, None, None
+        raise
+    return True, obj['ETag'], obj['Body'].read()
+
+def iter_readings(fnames, sensor = None):
+    for fname in fnames:
+        if fname is None:
+            continue
+        with open(fname, 'rb') as f:
+            for r in dayfile.iter_load(f):
+                if sensor is None or r.get('sensor', '') == sensor:
+                    yield r
+
+def downsample(readings, every):
+    # the mean of the readings of each sensor in each period of every seconds
+    periods = dict()
+    def result(sensor, start, count, total):
+        r = dict(timestamp = start, temperature = round(total / count, 3), count = count)
+        if sensor != '':
+            r['sensor'] = sensor
+        return r
+    for r in readings:
+        sensor, start = r.get('sensor', ''), r['timestamp'] // every * every
+        count = r.get('count', 1) if r.get('type') == 'summary' else 1
+        current = periods.get(sensor)
+        if current is not None and current[0] != start:
+            yield result(sensor, *current)
+            current = None
+        if current is None:
+            current = [start, 0, 0.0]
+        current[1] += count
+        current[2] += r['temperature'] * count
+        periods[sensor] = current
+    for sensor, current in sorted(periods.items()):
+        yield result(sensor, *current)
+
+def write_csv(readings, out):
+    writer = csv.writer(out)
+    writer.writerow(['timestamp', 'time', 'sensor', 'temperature'])
+    for r in readings:
+        writer.writerow([r['timestamp'], datetime.datetime.utcfromtimestamp(r['timestamp']).strftime('%Y-%m-%dT%H:%M:%S'), r.get('sensor', ''), r['temperature']])
+
+def write_ndjson(readings, out):
+    for r in readings:
+        print(json.dumps(r, separators = (',', ':')), file = out)
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+def parse_commandline(cmdline):
+    parser = argparse.ArgumentParser("Export the stored readings of a range of days")
+    parser.add_argument("--bucket", type=str, required=True, help="Bucket with the day files")
+    parser.add_argument("--profile", type=str, default="default", help="Which AWS setup profile to use")
+    parser.add_argument("--device", type=str, default='', help="Device to export, default is the readers without a device id")
+    parser.add_argument("--sensor", type=str, help="Only the readings of this sensor, '' for the readings without a sensor id")
+    parser.add_argument("--format", choices=['csv', 'ndjson'], default='csv', help="Output format")
+    parser.add_argument("--every", type=int, help="Export the mean of every this many seconds instead of all readings")
+    parser.add_argument("--cache", type=str, default=DefaultCache, help="Directory of the local cache of the day files")
+    parser.add_argument("--revalidate", action='store_true', help="Check the cached finished days against S3 as well")
+    parser.add_argument("--workers", type=int, default=logutil.MaxWorkers * 2, help="Number of concurrent downloads")
+    parser.add_argument("--output", type=str, help="Write to this file instead of stdout")
+    parser.add_argument("first", type=parse_date, help="First day, YYYY-MM-DD")
+    parser.add_argument("last", type=parse_date, nargs='?', help="Last day, default is the first one")
+    return parser.parse_args(cmdline)
+
+def export_days(s3, cache, bucket, first, last, partition = '', sensor = None, revalidate = False, workers = logutil.MaxWorkers, stats = None):
+    # the readings of the days first to last, the downloads run ahead and the readings
+    # are passed on as the days arrive in order; counts the days and requests in stats
+    stats = dict() if stats is None else stats
+    for k in ('cached', 'requests', 'downloads'):
+        stats.setdefault(k, 0)
+    def fetch(day_key):
+        return fetch_day(s3, cache, bucket, day_key[0], day_key[1], revalidate)
+    def cached_files():
+        for (day, key), (requested, etag, data) in logutil.bounded_map(fetch, day_keys(first, last, partition), workers):
+            stats['requests'] += requested
+            stats['downloads'] += data is not None
+            stats['cached'] += etag is not None and data is None
+            if requested:
+                cache.put(key, etag, data)
+            yield None if etag is None else cache.fname(etag)
+    return iter_readings(cached_files(), sensor)
+
+def main():
+    args = parse_commandline(sys.argv[1:])
+    start = time.perf_counter()
+    s3 = boto3.Session(profile_name = args.profile).client('s3', config = botocore.config.Config(max_pool_connections = args.workers))
+    cache = DayCache(args.cache, args.bucket)
+    stats = dict()
+    readings = export_days(s3, cache, args.bucket, args.first, args.last or args.first, devices.partition(args.device),
+                           args.sensor, args.revalidate, args.workers, stats)
+    if args.every:
+        readings = downsample(readings, args.every)
+    out = open(args.output, 'w', newline = '') if args.output else sys.stdout
+    try:
+        (write_csv if args.format == 'csv' else write_ndjson)(readings, out)
+    finally:
+        cache.save()
+        if args.output:
+            out.close()
+    print('{} days from the cache, {} downloaded, {} S3 requests in {:.2f}s'.format(stats['cached'], stats['downloads'], stats['requests'], time.perf_counter() - start), file = sys.stderr)
+
+if __name__ == '__main__':
+    main()
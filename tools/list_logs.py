@@ -1,18 +1,20 @@
 import argparse
-import datetime
 import sys
 
 import boto3
 
+import logutil
+
 Funcname='ktsr42_heating_lambda'
 Profile="root"
 
-def print_aws_timestamp(awsts):
-    return datetime.datetime.fromtimestamp(int(awsts) / 1000).strftime("%Y.%m.%dD%H:%M:%S.%f")
+print_aws_timestamp = logutil.print_aws_timestamp
 
 def parse_commandline(cmdline):
     parser = argparse.ArgumentParser("List AWS Lambda event logs from AWS Cloudwatch")
     parser.add_argument("--profile", type=str, default="default", help="Which AWS setup profile to use")
+    parser.add_argument("--limit", type=int, help="List at most this many streams")
+    parser.add_argument("--start", type=str, help="Only streams with events after this time, e.g. 2018-03-08T22:00 or 2d (ago)")
     parser.add_argument("funcname", type=str, help="Which Lambda function to dump the log for")
     return parser.parse_args(cmdline)
 
@@ -21,10 +23,10 @@ def main():
     session = boto3.Session(profile_name = args.profile)
     cwlogs = session.client('logs')
     logGroupName ='/aws/lambda/' + args.funcname
-    streams = cwlogs.describe_log_streams(logGroupName = logGroupName, orderBy='LastEventTime', descending=True)['logStreams']
-    for s in streams:
-        print("{}, created {}, lastEvent {}".format(s['logStreamName'], print_aws_timestamp(s['creationTime']), print_aws_timestamp(s['lastEventTimestamp'])))
+    start = None if args.start is None else logutil.parse_time(args.start)
+    for s in logutil.iter_streams(cwlogs, logGroupName, args.limit, start):
+        print("{}, created {}, lastEvent {}".format(s['logStreamName'], print_aws_timestamp(s['creationTime']), print_aws_timestamp(s.get('lastEventTimestamp', s['creationTime']))))
+        sys.stdout.flush()
 
 if __name__ == '__main__':
     main()
-    
@@ -0,0 +1,172 @@
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import queue
+import re
+import time
+import urllib.parse
+
+# CloudWatch Logs helpers for dump_log.py and list_logs.py. Everything is paginated and
+# returned as generators, so the output starts with the first page.
+
+MaxWorkers = 4
+# a Lambda log stream gets no new events once its container is gone, which takes hours at most
+ClosedAfter = 6 * 3600
+
+def print_aws_timestamp(awsts):
+    return datetime.datetime.fromtimestamp(int(awsts) / 1000).strftime("%Y.%m.%dD%H:%M:%S.%f")
+
+def parse_time(value, now = None):
+    # '2018-03-08', '2018-03-08T22:30', '2018-03-08T22:30:15' or relative to now like '90m', '6h', '2d'
+    # returns milliseconds since the epoch as CloudWatch uses them
+    now = time.time() if now is None else now
+    m = re.match(r'^(\d+)([smhd])$', value)
+    if m:
+        return int((now - int(m.group(1)) * dict(s = 1, m = 60, h = 3600, d = 86400)[m.group(2)]) * 1000)
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return int(datetime.datetime.strptime(value, fmt).timestamp() * 1000)
+        except ValueError:
+            pass
+    raise ValueError('Cannot parse the time ' + value)
+
+def iter_streams(cwlogs, group, limit = None, start = None):
+    # the streams of the group, most recent first, stops at the first one without events after start
+    pages = cwlogs.get_paginator('describe_log_streams').paginate(logGroupName = group, orderBy = 'LastEventTime', descending = True)
+    count = 0
+    for page in pages:
+        for stream in page['logStreams']:
+            if limit is not None and count >= limit:
+                return
+            if start is not None and stream.get('lastEventTimestamp', 0) < start:
+                return
+            count += 1
+            yield stream
+
+def iter_stream_events(cwlogs, group, stream, start = None, end = None):
+    # get_log_events has no paginator, it signals the end by returning the token it was given
+    args = dict(logGroupName = group, logStreamName = stream, startFromHead = True)
+    if start is not None:
+        args['startTime'] = start
+    if end is not None:
+        args['endTime'] = end
+    while True:
+        resp = cwlogs.get_log_events(**args)
+        for event in resp['events']:
+            yield event
+        if resp.get('nextForwardToken') in (None, args.get('nextToken')):
+            return
+        args['nextToken'] = resp['nextForwardToken']
+
+def iter_filtered_events(cwlogs, group, pattern = None, start = None, end = None, streams = None):
+    args = dict(logGroupName = group)
+    if pattern:
+        args['filterPattern'] = pattern
+    if start is not None:
+        args['startTime'] = start
+    if end is not None:
+        args['endTime'] = end
+    if streams:
+        args['logStreamNames'] = streams
+    for page in cwlogs.get_paginator('filter_log_events').paginate(**args):
+        for event in page['events']:
+            yield event
+
+class StreamCache():
+    # the events of closed streams in <directory>/<group>/<stream>.ndjson, they do not change anymore
+    def __init__(self, directory, group):
+        self.directory = os.path.join(directory, urllib.parse.quote(group, safe = ''))
+        os.makedirs(self.directory, exist_ok = True)
+
+    def fname(self, stream):
+        return os.path.join(self.directory, urllib.parse.quote(stream['logStreamName'], safe = '') + '.ndjson')
+
+    def closed(self, stream, now = None):
+        now = time.time() if now is None else now
+        return stream.get('lastIngestionTime', stream.get('lastEventTimestamp', 0)) < (now - ClosedAfter) * 1000
+
+    def get(self, stream):
+        # an iterator over the cached events, None if the stream is not in the cache
+        try:
+            f = open(self.fname(stream))
+        except FileNotFoundError:
+            return None
+        return read_ndjson(f)
+
+    def put(self, stream, events):
+        with open(self.fname(stream) + '.tmp', 'w') as f:
+            for event in events:
+                print(json.dumps(event), file = f)
+        os.replace(self.fname(stream) + '.tmp', self.fname(stream))
+
+def read_ndjson(f):
+    with f:
+        for line in f:
+            yield json.loads(line)
+
+def stream_events(cwlogs, group, stream, cache = None, start = None, end = None):
+    # The events of a stream as the pages arrive, from the cache if it is closed and has
+    # been read before. Only the events of a closed stream are collected, for the cache.
+    if cache is None or start is not None or end is not None:
+        yield from iter_stream_events(cwlogs, group, stream['logStreamName'], start, end)
+        return
+    cached = cache.get(stream)
+    if cached is not None:
+        yield from cached
+        return
+    collected = [] if cache.closed(stream) else None
+    for event in iter_stream_events(cwlogs, group, stream['logStreamName']):
+        if collected is not None:
+            collected.append(event)
+        yield event
+    if collected is not None:
+        cache.put(stream, collected)
+
+def bounded_map(func, items, workers = MaxWorkers):
+    # like map() with up to workers calls running ahead of the consumer, results in order
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= workers:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+End = object()
+
+def stream_map(func, items, workers = MaxWorkers):
+    # like bounded_map() for a func that returns an iterator: the consumer gets the elements
+    # of each result as they arrive, while the next workers - 1 results are read ahead
+    def read(item, q):
+        try:
+            for x in func(item):
+                q.put((x, None))
+        except Exception as e:
+            q.put((End, e))
+            return
+        q.put((End, None))
+    def drain(q):
+        while True:
+            x, error = q.get()
+            if x is End:
+                if error is not None:
+                    raise error
+                return
+            yield x
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+        pending = collections.deque()
+        for item in items:
+            q = queue.Queue()
+            pool.submit(read, item, q)
+            pending.append((item, q))
+            if len(pending) >= workers:
+                item, q = pending.popleft()
+                yield item, drain(q)
+        while pending:
+            item, q = pending.popleft()
+            yield item, drain(q)